@@ -1,6 +1,5 @@
-import pickle
-import socket
-import time
+import asyncio
+import threading
 from buildbot.buildslave.base import AbstractLatentBuildSlave
 from twisted.internet import threads
 from pcwaker_common import *
@@ -9,35 +8,60 @@ from pcconfig import pcwakerListeningPort
 from twisted.python import log
 
 
+# single persistent connection to the daemon process shared by all slaves
+# (requests of all slaves are multiplexed over it; the connection
+# is served by asyncio event loop running in its own thread)
+_daemonLoop=None
+_daemonConnection=None
+_daemonLock=threading.Lock()
+
+
+def _get_daemon_connection():
+   global _daemonLoop
+   global _daemonConnection
+   with _daemonLock:
+      if _daemonLoop==None:
+         _daemonLoop=asyncio.new_event_loop()
+         threading.Thread(target=_daemonLoop.run_forever,daemon=True).start()
+      if _daemonConnection==None or _daemonConnection.is_closed():
+         connection=RequestConnection()
+         asyncio.run_coroutine_threadsafe(connection.connect('127.0.0.1',pcwakerListeningPort),_daemonLoop).result()
+         _daemonConnection=connection
+      return _daemonConnection
+
+
 class PCWakerLatentBuildSlave(AbstractLatentBuildSlave):
 
    def pcwaker_send_single_command(self,args):
 
-      # make connection to the daemon process
-      s=socket.socket()
-      s.connect(('127.0.0.1',pcwakerListeningPort))
-      stream=Stream(s)
-
-      # send command to daemon
-      data=pickle.dumps(args,protocol=2)
-      stream.send(MSG_WAKER,data)
-
-      # receive and print response
-      recvData=b''
-      while True:
-         msgType,data=stream.recv()
-         if msgType==MSG_EOF:
-            break
-         if msgType==MSG_WAKER:
-            recvData+=pickle.loads(data)
+      # send command to daemon over the shared connection and wait for the response
+      connection=_get_daemon_connection()
+      response=asyncio.run_coroutine_threadsafe(connection.request(args),_daemonLoop).result()
+
+      # collect the response
+      recvData=''
+      for msgType,data in response:
+         if msgType==MSG_USER:
+            if type(data)==dict and 'computers' in data:
+               data='\n'.join(c['status'] for c in data['computers'])
+            recvData+=data
          if msgType==MSG_LOG:
             pass
 
-      # finalize application
-      stream.close()
-
       return True,recvData;
 
+   def pcwaker_wait_for_status(self,states,timeout):
+
+      # wait until the computer gets to one of the states
+      # (the daemon replies right on the transition; returns the state or None on timeout)
+      connection=_get_daemon_connection()
+      command=['wait',self.slavename,','.join(states),'--timeout',str(timeout)]
+      response=asyncio.run_coroutine_threadsafe(connection.request(command),_daemonLoop).result()
+      for msgType,data in response:
+         if msgType==MSG_USER and type(data)==dict and data.get('reached'):
+            return data['status']
+      return None
+
 
    def start_instance(self,build):
 
@@ -58,39 +82,27 @@ class PCWakerLatentBuildSlave(AbstractLatentBuildSlave):
       r,data=self.pcwaker_send_single_command(command)
 
       # wait for power up (timeout 5s)
-      powered=False
-      for i in range(0,2*5):
-         command=['status','--machine-readable',self.slavename]
-         r,data=self.pcwaker_send_single_command(command)
-         if data=='Booting':
-            powered=True
-            break
-         time.sleep(0.5)
-      if not powered:
+      # (the daemon replies right on the state transition, no polling)
+      if self.pcwaker_wait_for_status(['STARTING','ON'],5)==None:
          log.msg('Computer '+self.slavename+' failed to power up.')
          return False
 
       # wait for the machine to boot (timeout 180s)
-      for i in range(0,2*180):
-         command=['status','--machine-readable',self.slavename]
-         r,data=self.pcwaker_send_single_command(command)
-         if data=='ON':
-
-            # print success
-            log.msg('Computer '+self.slavename+' started.')
+      if self.pcwaker_wait_for_status(['ON'],180)==None:
 
-            # start buildslave
-            command=['command',self.slavename,'buildslave','start','/cygdrive/c/buildbot-slave']
-            self.pcwaker_send_single_command(command)
+         # machine did not came on-line in time
+         log.msg('Computer '+self.slavename+' powered up but failed to boot or connect to the buildbot machine.')
+         return False
 
-            # return success
-            return True
+      # print success
+      log.msg('Computer '+self.slavename+' started.')
 
-         time.sleep(0.5)
+      # start buildslave
+      command=['command',self.slavename,'buildslave','start','/cygdrive/c/buildbot-slave']
+      self.pcwaker_send_single_command(command)
 
-      # machine did not came on-line in time
-      log.msg('Computer '+self.slavename+' powered up but failed to boot or connect to the buildbot machine.')
-      return False
+      # return success
+      return True
 
    def stop_instance(self,fast=False):
 
@@ -1,4 +1,4 @@
-%module bdaqctrl
+%module(directors="1",threads="1") bdaqctrl
 
 %include <typemaps.i>
 %include <python/cwstring.i>
@@ -13,5 +13,12 @@
 #include "build/inc/bdaqctrl.h"
 %}
 
+/* Python implementation of change-of-state listener (see pcwaker_hardware.py) */
+/* (threads are needed as the listener is called from the driver thread) */
+%feature("director") Automation::BDaq::DiSnapEventListener;
+
 /* Parse the header file to generate wrappers */
 %include "build/inc/bdaqctrl.h"
+
+/* collection returned by InstantDiCtrl::getDiCosintPorts() */
+%template(DiCosintPortCollection) Automation::BDaq::ICollection<Automation::BDaq::DiCosintPort>;
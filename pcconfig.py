@@ -1,6 +1,10 @@
 # listening port of pcwakerd (buildbot uses 9989)
 pcwakerListeningPort=9988
 
+# local port of metrics of pcwakerd in Prometheus text format
+# (served on http://127.0.0.1:port/metrics; zero disables the metrics server)
+pcwakerMetricsPort=9990
+
 # server ip:port address of pcwakerd
 pcwakerServerAddress=('cadwork-pi.fit.vutbr.cz',pcwakerListeningPort)
 
@@ -18,7 +22,30 @@ class OperatingSystem:
 		self.cmdBootToThisOne=cmdBootToThisOne
 		self.cmdBootToBootManager=cmdBootToBootManager
 
+# power button pulse profile
+# (pressLength - how long the power button is pressed to start the computer,
+#  confirmationWindow - how long to wait for power LED after the press before the start is considered failed,
+#  killHoldLimit - the longest time the power button is held on kill;
+#  the button is released as soon as power LED goes off; all times in seconds)
+class PulseProfile:
+	pressLength=0.5
+	confirmationWindow=1.5
+	killHoldLimit=6.0
+	def __init__(self,pressLength=0.5,confirmationWindow=1.5,killHoldLimit=6.0):
+		self.pressLength=pressLength
+		self.confirmationWindow=confirmationWindow
+		self.killHoldLimit=killHoldLimit
+
+# pulse profile used by computers without pulseProfile attribute
+defaultPulseProfile=PulseProfile()
+
+# interval between power button presses when more computers are started
+# (staggering limits inrush current on shared circuits; in seconds)
+powerOnInterval=1.0
+
 # computers
+# (optional pulseProfile attribute overrides defaultPulseProfile;
+#  optional tags attribute lists group names the computer belongs to, all computers belong to group all)
 class pcCoffeeLake:
 	name='cadwork-i9'
 	names=[name,'i9','CoffeeLake']
@@ -1,15 +1,17 @@
 #!/usr/bin/env python3
 
 import asyncio
+import json
 import os
-import pickle
 import subprocess
 import signal
 import sys
+import time
 from pcwaker_common import *
 from pcconfig import pcwakerListeningPort
 
 debug=False
+exitCode=0
 
 
 async def clientConnectionHandler(message):
@@ -17,8 +19,9 @@ async def clientConnectionHandler(message):
 	# open connection
 	if debug:
 		print('Connecting to port '+str(port)+'...')
+	connection=RequestConnection()
 	try:
-		reader,writer=await asyncio.open_connection('127.0.0.1',port)
+		await connection.connect('127.0.0.1',port)
 	except ConnectionRefusedError as e:
 		if len(sys.argv)>=3 and sys.argv[1]=='daemon' and sys.argv[2]=='stop':
 			print('Daemon process already stopped.')
@@ -31,22 +34,107 @@ async def clientConnectionHandler(message):
 		      '   ('+type(e).__name__+': '+e.strerror+')')
 		exit(1)
 
+	# print received messages
+	# (MSG_STREAM chunks, such as command output, are written to stdout as they arrive)
+	dataStreams={}
+	def printMessage(msgType,message):
+		global exitCode
+		if msgType==MSG_STREAM:
+			receiver=dataStreams.get(message[0])
+			if receiver==None:
+				receiver=DataStreamReceiver()
+				dataStreams[message[0]]=receiver
+			data=receiver.receive(message)
+			if outputFile!=None:
+				outputFile.write(data)
+			else:
+				sys.stdout.flush()
+				sys.stdout.buffer.write(data)
+				sys.stdout.buffer.flush()
+			if receiver.ended:
+				del dataStreams[message[0]]
+		elif msgType==MSG_USER and type(message)==dict and 'computers' in message:
+			printStatus(message['computers'])
+		elif msgType==MSG_USER and type(message)==dict and 'event' in message:
+			printTransition(message)
+		elif msgType==MSG_USER and type(message)==dict and 'error' in message:
+			print(message['error'])
+			exitCode=1
+		elif msgType==MSG_USER and type(message)==dict and 'reached' in message:
+			if message['reached']:
+				print('Computer '+message['name']+' is '+message['status']+' (waited {:.3f} s).'.format(message['waitTime']))
+			else:
+				print('Computer '+message['name']+' did not get to the state in {:.3f} s (state: '.format(message['waitTime'])+
+				      message['status']+').')
+				exitCode=1
+		else:
+			print(str(message))
+
 	# send message
+	# (the request is finished by MSG_DONE; only daemon stop, restart and upgrade
+	# are finished by closing the connection)
 	if debug:
 		print('Sending message '+str(message)+'.')
-	stream_write_message(writer,MSG_USER,message)
-	writer.write_eof()
-
-	# receive messages
-	while not reader.at_eof():
-		msgType,message=await stream_read_message(reader)
-		if msgType==MSG_EOF:
-			break
-		print(str(message))
+	try:
+		await connection.request(message,printMessage)
+	except ConnectionResetError:
+		if not (len(message)>=2 and message[0]=='daemon' and message[1] in ['stop','restart','upgrade']):
+			print('Error: Connection to the daemon process was closed before the request was finished.')
+			global exitCode
+			exitCode=1
 
 	if debug:
 		print('Closing the connection.')
-	writer.close()
+	await connection.close()
+
+
+def formatDuration(seconds):
+	seconds=int(seconds)
+	if seconds<60: return str(seconds)+'s'
+	if seconds<3600: return str(seconds//60)+'m '+str(seconds%60)+'s'
+	if seconds<86400: return str(seconds//3600)+'h '+str(seconds//60%60)+'m'
+	return str(seconds//86400)+'d '+str(seconds//3600%24)+'h'
+
+
+def printStatus(computers):
+
+	# render structured status reply
+	# (--json prints the reply as it is, --machine-readable prints one status per line)
+	if jsonOutput:
+		print(json.dumps(computers,indent=3))
+		return
+	for c in computers:
+		if machineReadable:
+			print(c['status'])
+			continue
+		print('Computer '+c['name']+':')
+		print('   Status: '+c['status']+' (for '+formatDuration(c['timeInState'])+')')
+		if c['currentOS']!=None:
+			print('   OS:     '+c['currentOS'])
+		if c['requestedOS']!=None and c['requestedOS']!=c['currentOS']:
+			print('   Requested OS: '+c['requestedOS'])
+		if c['lastPowerEdge']!=None:
+			t=c['lastPowerEdge']
+			s=time.strftime('%Y-%m-%d %H:%M:%S',time.localtime(t))+'.{:03d}'.format(int(t*1000)%1000)
+			print('   Last power edge: '+s+(' (power on)' if c['powered'] else ' (power off)'))
+		if c['pingRoundTripTime']!=None:
+			print('   Ping RTT: {:.1f} ms (p50 {:.1f} ms, p90 {:.1f} ms, p99 {:.1f} ms)'.format(
+			      c['pingRoundTripTime']*1000,c['roundTripTimeP50']*1000,c['roundTripTimeP90']*1000,c['roundTripTimeP99']*1000))
+		if c.get('clockOffset')!=None:
+			print('   Clock offset: {:+.1f} ms'.format(c['clockOffset']*1000))
+
+
+def printTransition(transition):
+
+	# render state transition streamed by watch request
+	# (the first message of each computer holds its current state)
+	t=transition['time']
+	s=time.strftime('%Y-%m-%d %H:%M:%S',time.localtime(t))+'.{:03d}'.format(int(t*1000)%1000)
+	if transition['event']==None:
+		print(s+'  '+transition['name']+': '+transition['status'],flush=True)
+	else:
+		print(s+'  '+transition['name']+': '+transition['oldStatus']+' -> '+transition['status']+
+		      ' ('+transition['event']+')',flush=True)
 
 
 # -h and --help or no arguments
@@ -63,9 +151,18 @@ if len(sys.argv)<=1 or '-h' in sys.argv or '--help' in sys.argv:
          '   daemon start|stop|restart [--debug]\n'
          '      Starts, stops or restarts daemon process (pcwakerd).\n'
          '      Optional --debug parameter causes debug messages to be printed.\n'
-         '   status [computer-names]\n'
+         '   daemon reload\n'
+         '      Reloads pcconfig.py without restarting the daemon process.\n'
+         '      Computers that were not removed keep their state and connections.\n'
+         '   daemon upgrade\n'
+         '      Hands the daemon over to a new daemon process started from the current\n'
+         '      code. Connections of the computers and their states are kept.\n'
+         '   daemon log\n'
+         '      Prints the log file of the daemon process.\n'
+         '   status [--machine-readable|--json] [computer-names]\n'
          '      Prints status of all computers. If computer name(s) are given,\n'
-         '      it prints only status of computers listed.\n'
+         '      it prints only status of computers listed. --machine-readable\n'
+         '      prints one state per line, --json prints all the details.\n'
          '   start [computer-name] [operating-system]\n'
          '      Starts the computer given by computer-name. If operating-system is\n'
          '      specified, it is booted. Usual os names are win, linux, boot.\n'
@@ -74,14 +171,39 @@ if len(sys.argv)<=1 or '-h' in sys.argv or '--help' in sys.argv:
          '      Restarts the computer given by computer-name. If operating-system is\n'
          '      specified, it is booted. Usual os names are win, linux, boot.\n'
          '      See pcconfig.py for list of operating systems for each computer.\n'
+         '   start|stop|kill [computer-names-or-tags]\n'
+         '      Starts, stops or kills more computers at once. Tags are given\n'
+         '      in pcconfig.py, tag all means all computers. Power buttons are\n'
+         '      pressed one after another with the interval of powerOnInterval.\n'
+         '      A summary of the outcome for each computer is printed at the end.\n'
          '   stop [computer-name]\n'
          '      Stops computer given by computer-name.\n'
          '   kill [computer-name]\n'
          '      Forcefully powers off the computer. The operation is equal to\n'
-         '      pressing power button for five seconds. Use this on frozen computers.\n'
+         '      holding power button until the computer powers off. Use this\n'
+         '      on frozen computers. The exact power off time is reported.\n'
          '   command [computer-name] [command] [command-parameters]\n'
          '      Executes the command on the computer. Command-parameters might\n'
-         '      by empty or contain multiple parameters.\n'
+         '      by empty or contain multiple parameters. The output of the command\n'
+         '      is printed as it is produced.\n'
+         '   history [computer-name]\n'
+         '      Prints power on and power off edges of the computer\n'
+         '      detected during the last minutes.\n'
+         '   watch [computer-names-or-tags]\n'
+         '      Prints the current state of the computers and then each state\n'
+         '      transition as it happens, until interrupted. All computers\n'
+         '      are watched if no names are given.\n'
+         '   wait [computer-name] [states] [--timeout seconds]\n'
+         '      Waits until the computer gets to one of the states given\n'
+         '      as a comma separated list, such as ON or OFF,FROZEN. It returns\n'
+         '      right on the transition. Exit code is 1 on timeout.\n'
+         '   connections\n'
+         '      Prints connections of the daemon, their outgoing queue depths,\n'
+         '      and dropped and merged log messages.\n'
+         '   trace dump [file-name]\n'
+         '      Writes spans of the recent requests and boots of the computers\n'
+         '      in Chrome trace event format to the file or to stdout. Load it\n'
+         '      by chrome://tracing or Perfetto UI.\n'
          '\n')
    exit(99)
 
@@ -128,8 +250,18 @@ if len(sys.argv)>=2 and sys.argv[1]=='daemon':
       else:
          exit(1)
 
-# parse --machine-readable if present
+# parse --machine-readable and --json if present
 machineReadable=len(sys.argv)>=3 and sys.argv[1]=='status' and sys.argv[2]=='--machine-readable'
+jsonOutput=len(sys.argv)>=3 and sys.argv[1]=='status' and sys.argv[2]=='--json'
+
+# open output file of trace dump if given
+outputFile=None
+if len(sys.argv)>=4 and sys.argv[1]=='trace' and sys.argv[2]=='dump':
+   try:
+      outputFile=open(sys.argv[3],'wb')
+   except OSError as e:
+      print('Error: Can not open file \"'+sys.argv[3]+'\" ('+e.strerror+').')
+      exit(1)
 
 # open listeningPortFile
 if listeningPortFilePath:
@@ -157,20 +289,17 @@ message=sys.argv[1:]
 
 # run main loop
 loop = asyncio.get_event_loop()
-loop.run_until_complete(clientConnectionHandler(message))
+try:
+   loop.run_until_complete(clientConnectionHandler(message))
+except KeyboardInterrupt:
+   # (watch runs until interrupted)
+   pass
 
 loop.close()
+if outputFile!=None:
+   outputFile.close()
+   print('Trace written to \"'+sys.argv[3]+'\".')
 
 
-sys.exit(0)
-
+sys.exit(exitCode)
 
-# receive and print response
-while True:
-   msgType,data=stream.recv()
-   if msgType==MSG_EOF:
-      break
-   if msgType==MSG_USER:
-      print(pickle.loads(data),end='')
-   if msgType==MSG_LOG and not machineReadable:
-      print(data.decode(errors='replace'),end='')
@@ -4,33 +4,33 @@
 # http://stackoverflow.com/questions/32404/is-it-possible-to-run-a-python-script-as-a-service-in-windows-if-possible-how
 # http://stackoverflow.com/questions/34328/how-do-i-make-windows-aware-of-a-service-i-have-written-in-python
 # http://code.activestate.com/recipes/551780/
+#
+# installation:
+# pcwaker_client.py needs pcconfig.py and pcwaker_common.py in the same folder
+# (all three files are taken from the pcwaker share of the server and must be updated together;
+# see pcwaker_client.service for Linux computers, on Windows and Cygwin copy them by hand
+# or by the script that starts the client)
 
 import asyncio
+import codecs
 import os
-import pickle
 import signal
 import socket
-import struct
 import subprocess
 import sys
 import time
 from pcconfig import *
-
-# taken from pcwaker_common.py:
-# message ids used for stream message content identification
-MSG_EOF=0          # opposite side closed the stream and will only receive until we sent EOF as well
-MSG_LOG=1          # log messages that could be printed on the screen for the user or ignored
-MSG_USER=2         # messages exchanged between pcwaker.py (user interacting utility) and pcwakerd.py (daemon)
-MSG_COMPUTER=3     # messages exchanged bettwen pcwaker_client.py (client computer) and pcwakerd.py (daemon)
-MSG_PING_SCHEDULE=4  # message used for connection ping
-MSG_PING_REQUEST=5   # message used for connection ping
-MSG_PING_ANSWER=6    # message used for connection ping
+try:
+	from pcwaker_common import *
+except ImportError as e:
+	print('Error: Can not load pcwaker_common module ('+str(e)+').\n'
+	      '   Put pcwaker_common.py of the server next to pcwaker_client.py.')
+	sys.exit(1)
 
 
 terminatingSignalHandled=False
-reader=None
-timeOfLastPingRequest=0
-timeOfLastPingAnswer=0
+stream=None
+heartbeatWheel=None
 
 
 @asyncio.coroutine
@@ -38,16 +38,21 @@ def connectionHandler():
 
 	# repeat connection attempts whenever connection gets broken
 	exitRequested=False
-	global reader
-	global timeOfLastPingRequest
-	global timeOfLastPingAnswer
+	global stream
+	global heartbeatWheel
 	lastReconnectTime=time.monotonic()-20
+	connectStart=None
+	connectAttempts=0
 	while not exitRequested:
 
 		# open connection
+		# (connecting is traced from the first attempt until "Got alive" is sent)
+		if connectStart==None:
+			connectStart=time.monotonic()
+		connectAttempts+=1
 		print('Connecting to the server '+pcwakerServerAddress[0]+':'+str(pcwakerServerAddress[1])+'...')
 		try:
-			reader,writer=yield from asyncio.open_connection(pcwakerServerAddress[0],port=pcwakerServerAddress[1])
+			_,stream=yield from asyncio.get_event_loop().create_connection(MessageStream,pcwakerServerAddress[0],pcwakerServerAddress[1])
 		except (ConnectionRefusedError,OSError) as e:
 			print('Can not connect to '+pcwakerServerAddress[0]+':'+str(pcwakerServerAddress[1])+
 			      '. Will try again in 30 seconds...')
@@ -58,9 +63,9 @@ def connectionHandler():
 		try:
 			try:
 				# set keep-alive on socket
-				s=writer.get_extra_info('socket')
+				s=stream.get_extra_info('socket')
 				if s is None:
-					wlog.error('Can not get socket out of writer. Socket TCP keep-alive parameters will not be set.')
+					wlog.error('Can not get socket out of stream. Socket TCP keep-alive parameters will not be set.')
 				else:
 					s.setsockopt(socket.SOL_SOCKET,socket.SO_KEEPALIVE,1)
 					if hasattr(socket, "TCP_KEEPIDLE") and hasattr(socket, "TCP_KEEPINTVL") and hasattr(socket, "TCP_KEEPCNT"):
@@ -77,61 +82,50 @@ def connectionHandler():
 				if sys.platform=='win32':  partition=format(os.stat("C:\\").st_dev,'X')
 				else:  partition=subprocess.run(['findmnt','/','--output','SOURCE','--noheading'],stdout=subprocess.PIPE).stdout.decode('utf-8').strip()
 				print('Sending \"Got alive\" message (this computer name: '+hostName+', platform: '+sys.platform+', partition: '+partition+').')
-				stream_write_message(writer,MSG_COMPUTER,pickle.dumps(['Got alive',hostName,sys.platform,partition],protocol=2))
-
-				# send the first ping request
-				#timeOfLastPingRequest=time.monotonic()
-				#timeOfLastPingAnswer=0
-				#stream_write_message(writer,MSG_PING_REQUEST,timeOfLastPingRequest)
+				# (it is sent by pickle codec understood by all daemon versions; supported codecs are offered
+				# and the daemon answers by MSG_CODEC if it supports any of them, then both sides switch to it;
+				# the daemons of the previous versions do not answer and pickle codec stays in use)
+				stream_write_message(stream,MSG_COMPUTER,['Got alive',hostName,sys.platform,partition,supportedCodecs,supportedFeatures])
+				tracer.record('connect','client',connectStart,time.monotonic(),args={'attempts':connectAttempts})
+				connectStart=None
+				connectAttempts=0
+
+				# start heartbeat
+				# (ping requests of the daemon are answered by the stream itself;
+				# the connection is closed if the daemon stops answering our ping requests)
+				def heartbeatFailed(heartbeat,phi):
+					print('Connection lost (heartbeat timeout, phi {:.1f}).'.format(phi))
+					heartbeat.stream.close()
+				if heartbeatWheel==None:
+					heartbeatWheel=TimerWheel()
+				Heartbeat(heartbeatWheel,stream,heartbeatFailed).start()
 
 				# message loop
 				while True:
 
-					# read msgType
-					data=yield from reader.read(4)
-					if len(data)!=4:
-						if len(data)==0 and reader.at_eof(): break
-						raise OSError(84,'Illegal byte sequence.')
-					msgType,=struct.unpack_from('!I',data,0)
-
-					# read msgSize
-					data=yield from reader.read(4)
-					if len(data)!=4: raise OSError(84,'Illegal byte sequence.')
-					msgSize,=struct.unpack_from('!I',data,0)
-
 					# read message
-					data=yield from reader.read(msgSize)
-					if len(data)!=msgSize: OSError(84,'Illegal byte sequence.')
-					message=pickle.loads(data)
+					# (messages are parsed in batches by MessageStream,
+					# thus most of the calls return without waiting)
+					msgType,message,requestId=yield from stream.read_message()
+					context=stream.traceContext
 
 					# EOF - connection closed
 					if msgType==MSG_EOF:
 						print('Server closed the connection.')
 						break
 
-					# pingHandler scheduled sending of ping
-					elif msgType==MSG_PING_SCHEDULE:
-						if timeOfLastPingRequest!=timeOfLastPingAnswer:
-							print('Connection lost (ping timeout).')
-							break # close connection
-						timeOfLastPingRequest=message
-						stream_write_message(writer,MSG_PING_REQUEST,message)
-						continue
-
-					# peer sent ping request
-					elif msgType==MSG_PING_REQUEST:
-						stream_write_message(writer,MSG_PING_ANSWER,message)
-						continue
-
-					# peer sent ping answer
-					elif msgType==MSG_PING_ANSWER:
-						timeOfLastPingAnswer=message
+					# daemon negotiated codec
+					elif msgType==MSG_CODEC:
+						if message in supportedCodecs:
+							stream.codec=message
+							print('Using codec '+str(message)+'.')
+							sendSpans()
 						continue
 
 					elif msgType==MSG_COMPUTER:
 
-						# decode data
-						params=pickle.loads(message)
+						# message was already decoded by MessageStream
+						params=message
 
 						# ignore empty messages
 						if len(params)==0:
@@ -140,6 +134,7 @@ def connectionHandler():
 						# shutdown message
 						if params[0]=='shutdown':
 							print('Scheduling shutdown in 1 minute...')
+							span=tracer.begin('schedule shutdown','client',context)
 							if sys.platform.startswith('cygwin'):
 								subprocess.call(['shutdown','--shutdown','60'])
 							elif sys.platform.startswith('win32'):
@@ -148,12 +143,15 @@ def connectionHandler():
 								subprocess.call(['/usr/bin/sudo','shutdown','--poweroff','+1','pcwaker scheduled shutdown in one minute. Use \"shutdown -c\" to cancel.'])
 							else:
 								print('Error: No shutdown code for this operating system.')
+							tracer.end(span)
+							sendSpans()
 							print('Done.')
 							exitRequested=True
 							break
 
 						if params[0]=='restart':
 							print('Scheduling restart in 1 minute...')
+							span=tracer.begin('schedule restart','client',context)
 							if sys.platform.startswith('cygwin'):
 								subprocess.call(['shutdown','--reboot','60'])
 							elif sys.platform.startswith('win32'):
@@ -162,46 +160,63 @@ def connectionHandler():
 								subprocess.call(['/usr/bin/sudo','shutdown','--reboot','+1','pcwaker scheduled shutdown in one minute. Use \"shutdown -c\" to cancel.'])
 							else:
 								print('Error: No restart code for this operating system.')
+							tracer.end(span)
+							sendSpans()
 							print('Done.')
 							exitRequested=True
 							break
 
 						# execute command on this computer
+						# (output is printed as it is produced; if the daemon passed stream id as the request id,
+						# the output is sent back to the daemon in MSG_STREAM chunks as well;
+						# the command is traced as the child of the span of the daemon that sent it)
 						elif params[0]=='command':
 							if len(params)==1:
 								print('Error: No command specified.')
 							else:
+								if requestId!=None:
+									sender=DataStreamSender(stream,requestId)
+								else:
+									sender=None
+								span=tracer.begin('command '+os.path.basename(params[1]),'client',context)
 								try:
 
 									# run command
 									print('Executing command: '+str(params[1:])+'.')
 									p=subprocess.Popen(params[1:],stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
-									t,_=p.communicate()
+
+									# print and send output
+									# (pipe is read in executor not to block the event loop)
+									loop=asyncio.get_event_loop()
+									decoder=codecs.getincrementaldecoder('utf-8')(errors='replace')
+									newLine=True
+									while True:
+										data=yield from loop.run_in_executor(None,p.stdout.read1,dataStreamChunkSize)
+										if len(data)==0:
+											break
+										print(decoder.decode(data),end='')
+										newLine=data.endswith(b'\n')
+										if sender:
+											yield from sender.send(data)
+									yield from loop.run_in_executor(None,p.wait)
 
 									# print return code
 									if p.returncode==0:
-										print('Command '+str(params[1:])+' succeeded',end='')
-									else:
-										print('Command '+str(params[1:])+' returned error code '+str(p.returncode),end='')
-
-									# print output
-									if(len(t)==0):
-										print('.')
+										t='Command '+str(params[1:])+' succeeded.'
 									else:
-
-										# decode string
-										t=t.decode("utf-8")
-
-										# remove ending new line
-										l=len(t)-1
-										if(t[l]=='\n'):
-											t=t[:l]
-
-										# print output
-										print(' with output:\n'+t)
+										t='Command '+str(params[1:])+' returned error code '+str(p.returncode)+'.'
+									if not newLine:
+										t='\n'+t
 
 								except OSError:
-									print('Error: Failed to run command: '+str(params[1:])+'.')
+									t='Error: Failed to run command: '+str(params[1:])+'.'
+
+								# print result and finish the stream
+								print(t)
+								if sender:
+									yield from sender.close((t+'\n').encode('utf-8'))
+								tracer.end(span)
+								sendSpans()
 							continue
 
 						# unknown param
@@ -220,10 +235,10 @@ def connectionHandler():
 
 			finally:
 				# close connection
-				writer.close()
-				reader=None
-				timeOfLastPingRequest=0
-				timeOfLastPingAnswer=0
+				if stream.heartbeat!=None:
+					stream.heartbeat.stop()
+				stream.close()
+				stream=None
 
 		except ConnectionResetError as e:
 			# log connection reset
@@ -247,45 +262,18 @@ def connectionHandler():
 			lastReconnectTime=time.monotonic()
 
 
-@asyncio.coroutine
-def pingHandler():
-
-	try:
-		while True:
-
-			# sleep 10s
-			yield from asyncio.sleep(10)
-
-			# do not do anything if no connection yet
-			if reader==None:
-				continue
-
-			# prepare data to send
-			data3=pickle.dumps(time.monotonic(),protocol=2)
-			data1=struct.pack('!I',MSG_PING_SCHEDULE)
-			data2=struct.pack('!I',len(data3))
-			data=data1+data2+data3
-
-			# feed data to the reader
-			reader.feed_data(data)
-
-	except asyncio.CancelledError:
-		pass
-
+def sendSpans():
 
-# taken from pcwaker_common.py:
-def stream_write_message(writer,msgType,message):
-	data=pickle.dumps(message,protocol=2)
-	writer.write(struct.pack('!I',msgType))
-	writer.write(struct.pack('!I',len(data)))
-	writer.write(data)
+	# send finished spans to the daemon
+	# (only to daemons that negotiated binary codec; the previous versions ignore MSG_TRACE)
+	if stream!=None and stream.codec==CODEC_BINARY and tracer.spans:
+		stream_write_message(stream,MSG_TRACE,tracer.takeRecords())
 
 
 def signalCallback(text):
 	# print message and cancel connectionHandler task
 	print(text)
 	connectionTask.cancel()
-	pingTask.cancel()
 
 
 def signalHandler(signum,stackframe):
@@ -343,7 +331,6 @@ def consoleCtrlHandler(signum,func=None):
 # initialization
 loop=asyncio.get_event_loop()
 connectionTask=loop.create_task(connectionHandler())
-#pingTask=loop.create_task(pingHandler()) <- This might cause some data connection inconsistency. Probably.
 try:
 	# set line buffering for stdout
 	# (otherwise text is buffered for long time and appears only after flush)
@@ -370,8 +357,6 @@ except asyncio.CancelledError:
 	pass # just catch and ignore the exception
 finally:
 	print("Cleaning up...")
-#	pingTask.cancel()
-#	loop.run_until_complete(pingTask)
 	loop.close()
 
 print('Terminating pcwaker client daemon successfully.')
@@ -1,45 +1,1170 @@
+import asyncio
+import collections
+import contextlib
+import contextvars
+import io
+import math
 import pickle
-import select
+import random
 import struct
+import time
 
 
 # file paths of server process
 listeningPortFilePath=''
 logFilePath='/var/log/pcwaker/pcwakerd.log'
+journalFilePath='/var/lib/pcwaker/pcwakerd.journal'
 
 # message ids used for stream message content identification
 MSG_EOF=0          # opposite side closed the stream and will only receive until we sent EOF as well
 MSG_LOG=1          # log messages that could be printed on the screen for the user or ignored
 MSG_USER=2         # messages exchanged between pcwaker.py (user interacting utility) and pcwakerd.py (daemon)
 MSG_COMPUTER=3     # messages exchanged bettwen pcwaker_client.py (client computer) and pcwakerd.py (daemon)
-MSG_PING_SCHEDULE=4  # message used for connection ping
-MSG_PING_REQUEST=5   # message used for connection ping
-MSG_PING_ANSWER=6    # message used for connection ping
+MSG_PING_SCHEDULE=4  # not used any more (formerly injected into the stream to schedule ping)
+MSG_PING_REQUEST=5   # heartbeat; answered by MessageStream itself, see Heartbeat
+MSG_PING_ANSWER=6    # heartbeat answer: [time of the request, wall clock time of the answering peer]
+MSG_CODEC=7        # codec negotiation; the message is the codec that the sender uses from now on
+MSG_DONE=8         # end of the response to the request carrying the same request id
+MSG_STREAM=9       # chunk of a data stream: [streamId,sequenceNumber,flags,data]
+MSG_TRACE=10       # finished spans of the client: list of [name,category,traceId,spanId,parentId,start,duration,args]
 
+# data streams
+# (large data are sent as a sequence of MSG_STREAM chunks of at most dataStreamChunkSize bytes;
+# sequence numbers start from zero for each stream, the last chunk carries STREAM_END flag)
+dataStreamChunkSize=64*1024
+STREAM_END=0x01
 
-def stream_write_message(writer,msgType,message):
-	data=pickle.dumps(message,protocol=2)
-	writer.write(struct.pack('!I',msgType))
-	writer.write(struct.pack('!I',len(data)))
-	writer.write(data)
+# codecs of message bodies (stored in bits 16..23 of msgType in the frame header)
+CODEC_PICKLE=0     # pickle protocol 2, understood by all pcwaker versions
+CODEC_BINARY=1     # compact schema based binary codec, see encode_message()
+supportedCodecs=[CODEC_BINARY]
+
+# optional features offered by the client in "Got alive" message
+# (trace - the client accepts trace context in frame headers and sends its spans by MSG_TRACE)
+supportedFeatures=['trace']
+
+# frame header: msgType and msgSize, followed by msgSize bytes of message body;
+# if MSG_FLAG_REQUEST_ID is set in msgType, u32 request id follows msgSize
+# (request id correlates requests and responses multiplexed over a single connection);
+# if MSG_FLAG_TRACE_CONTEXT is set, u64 trace id and u64 span id follow
+# (the span of the sender that the receiver's spans are children of; sent only to peers offering trace feature)
+headerStruct=struct.Struct('!II')
+requestIdStruct=struct.Struct('!I')
+traceContextStruct=struct.Struct('!QQ')
+MSG_FLAG_REQUEST_ID=0x80000000
+MSG_FLAG_TRACE_CONTEXT=0x40000000
+maxMessageSize=16*1024*1024
+
+
+# binary codec
+#
+# Body of each message starts by codec version and message kind (one byte each).
+# Message kind determines the schema of the rest of the body:
+#    KIND_TEXT - string (log messages and text replies)
+#    KIND_PING - double (ping timestamps)
+#    KIND_ARGS - list of strings (command line arguments, commands for the computers)
+#    KIND_STATUS..KIND_GOT_ALIVE - list of strings whose first item is the keyword
+#                                  given by the kind; only the remaining items are stored
+#    KIND_CHUNK - MSG_STREAM chunk: u32 streamId, u32 sequenceNumber, u8 flags, and data till the end of the body
+#    KIND_VALUE - any other value composed of None, bool, int, float, str, bytes, list and dict
+# Strings are stored as u32 length followed by utf-8 data, lists as u16 count followed by items.
+# Values nested deeper than maxValueDepth are refused.
+binaryCodecVersion=1
+maxValueDepth=32
+KIND_VALUE=0
+KIND_TEXT=1
+KIND_PING=2
+KIND_ARGS=3
+KIND_STATUS=4
+KIND_START=5
+KIND_STOP=6
+KIND_KILL=7
+KIND_RESTART=8
+KIND_COMMAND=9
+KIND_SHUTDOWN=10
+KIND_GOT_ALIVE=11
+KIND_CHUNK=12
+_keyword2kind={
+	'status':    KIND_STATUS,
+	'start':     KIND_START,
+	'stop':      KIND_STOP,
+	'kill':      KIND_KILL,
+	'restart':   KIND_RESTART,
+	'command':   KIND_COMMAND,
+	'shutdown':  KIND_SHUTDOWN,
+	'Got alive': KIND_GOT_ALIVE,
+}
+_kind2keyword={v:k for k,v in _keyword2kind.items()}
+_binaryHeaderStruct=struct.Struct('!BB')
+_chunkHeaderStruct=struct.Struct('!BBIIB')
+_u16Struct=struct.Struct('!H')
+_u32Struct=struct.Struct('!I')
+_i64Struct=struct.Struct('!q')
+_f64Struct=struct.Struct('!d')
+_VALUE_NONE=0
+_VALUE_FALSE=1
+_VALUE_TRUE=2
+_VALUE_INT=3
+_VALUE_FLOAT=4
+_VALUE_STR=5
+_VALUE_BYTES=6
+_VALUE_LIST=7
+_VALUE_DICT=8
+
+
+def encode_message(codec,msgType,message):
+	if codec==CODEC_BINARY:
+		if msgType==MSG_STREAM:
+			streamId,sequenceNumber,flags,data=message
+			return _chunkHeaderStruct.pack(binaryCodecVersion,KIND_CHUNK,streamId,sequenceNumber,flags)+data
+		return _encode_binary(message)
+	if codec==CODEC_PICKLE:
+		if msgType==MSG_COMPUTER:
+			# previous versions pickled MSG_COMPUTER messages twice
+			message=pickle.dumps(message,protocol=2)
+		return pickle.dumps(message,protocol=2)
+	raise ValueError('Unknown codec '+str(codec)+'.')
+
+
+def decode_message(codec,msgType,data):
+	if codec==CODEC_BINARY:
+		try:
+			return _decode_binary(data)
+		except (struct.error,UnicodeDecodeError,IndexError,KeyError,ValueError,RecursionError):
+			raise OSError(84,'Illegal byte sequence.')
+	if codec==CODEC_PICKLE:
+		try:
+			message=_RestrictedUnpickler(io.BytesIO(data)).load()
+			if msgType==MSG_COMPUTER and type(message)==bytes:
+				message=_RestrictedUnpickler(io.BytesIO(message)).load()
+		except Exception:
+			raise OSError(84,'Illegal byte sequence.')
+		return message
+	raise OSError(84,'Illegal byte sequence.')
+
+
+# unpickler of messages of the previous versions
+# (they hold only None, bool, numbers, strings, bytes, lists, tuples, dicts and sets;
+# protocol 2 pickles bytes as a call of _codecs.encode and refers to builtins as __builtin__;
+# any other global, such as a class or a function, is refused)
+class _RestrictedUnpickler(pickle.Unpickler):
+
+	allowedGlobals={('_codecs','encode'),('builtins','set'),('builtins','frozenset'),('builtins','bytearray'),
+	                ('__builtin__','set'),('__builtin__','frozenset'),('__builtin__','bytearray')}
+
+	def find_class(self,module,name):
+		if (module,name) not in self.allowedGlobals:
+			raise pickle.UnpicklingError('Global '+module+'.'+name+' is not allowed.')
+		return pickle.Unpickler.find_class(self,module,name)
+
+
+def _encode_binary(message):
+	t=type(message)
+	if t==str:
+		out=bytearray(_binaryHeaderStruct.pack(binaryCodecVersion,KIND_TEXT))
+		_encode_str(out,message)
+	elif t==float:
+		out=bytearray(_binaryHeaderStruct.pack(binaryCodecVersion,KIND_PING))
+		out+=_f64Struct.pack(message)
+	elif t==list and all(type(x)==str for x in message):
+		kind=_keyword2kind.get(message[0]) if message else None
+		if kind is None:
+			kind=KIND_ARGS
+			items=message
+		else:
+			items=message[1:]
+		out=bytearray(_binaryHeaderStruct.pack(binaryCodecVersion,kind))
+		out+=_u16Struct.pack(len(items))
+		for x in items:
+			_encode_str(out,x)
+	else:
+		out=bytearray(_binaryHeaderStruct.pack(binaryCodecVersion,KIND_VALUE))
+		_encode_value(out,message)
+	return out
+
+
+def _encode_str(out,s):
+	data=s.encode('utf-8')
+	out+=_u32Struct.pack(len(data))
+	out+=data
+
+
+def _encode_value(out,value):
+	t=type(value)
+	if value is None:
+		out.append(_VALUE_NONE)
+	elif t==bool:
+		out.append(_VALUE_TRUE if value else _VALUE_FALSE)
+	elif t==int:
+		out.append(_VALUE_INT)
+		out+=_i64Struct.pack(value)
+	elif t==float:
+		out.append(_VALUE_FLOAT)
+		out+=_f64Struct.pack(value)
+	elif t==str:
+		out.append(_VALUE_STR)
+		_encode_str(out,value)
+	elif t==bytes or t==bytearray:
+		out.append(_VALUE_BYTES)
+		out+=_u32Struct.pack(len(value))
+		out+=value
+	elif t==list or t==tuple:
+		out.append(_VALUE_LIST)
+		out+=_u32Struct.pack(len(value))
+		for x in value:
+			_encode_value(out,x)
+	elif t==dict:
+		out.append(_VALUE_DICT)
+		out+=_u32Struct.pack(len(value))
+		for k,v in value.items():
+			_encode_str(out,k)
+			_encode_value(out,v)
+	else:
+		raise TypeError('Type '+t.__name__+' can not be encoded by binary codec.')
+
+
+def _decode_binary(data):
+	version,kind=_binaryHeaderStruct.unpack_from(data,0)
+	if version!=binaryCodecVersion:
+		raise ValueError('Unsupported binary codec version.')
+	pos=_binaryHeaderStruct.size
+	if kind==KIND_TEXT:
+		message,pos=_decode_str(data,pos)
+	elif kind==KIND_PING:
+		message,=_f64Struct.unpack_from(data,pos)
+		pos+=_f64Struct.size
+	elif kind==KIND_VALUE:
+		message,pos=_decode_value(data,pos)
+	elif kind==KIND_CHUNK:
+		_,_,streamId,sequenceNumber,flags=_chunkHeaderStruct.unpack_from(data,0)
+		message=[streamId,sequenceNumber,flags,bytes(data[_chunkHeaderStruct.size:])]
+		pos=len(data)
+	else:
+		if kind==KIND_ARGS:
+			message=[]
+		elif kind in _kind2keyword:
+			message=[_kind2keyword[kind]]
+		else:
+			raise ValueError('Unknown message kind.')
+		count,=_u16Struct.unpack_from(data,pos)
+		pos+=_u16Struct.size
+		for i in range(count):
+			s,pos=_decode_str(data,pos)
+			message.append(s)
+	if pos!=len(data):
+		raise ValueError('Trailing data in the message.')
+	return message
+
+
+def _decode_str(data,pos):
+	n,=_u32Struct.unpack_from(data,pos)
+	pos+=_u32Struct.size
+	if pos+n>len(data):
+		raise ValueError('Truncated message.')
+	return str(data[pos:pos+n],'utf-8'),pos+n
+
+
+def _decode_value(data,pos,depth=0):
+	if depth>maxValueDepth:
+		raise ValueError('Value nested too deep.')
+	tag=data[pos]
+	pos+=1
+	if tag==_VALUE_NONE:
+		return None,pos
+	if tag==_VALUE_FALSE:
+		return False,pos
+	if tag==_VALUE_TRUE:
+		return True,pos
+	if tag==_VALUE_INT:
+		return _i64Struct.unpack_from(data,pos)[0],pos+_i64Struct.size
+	if tag==_VALUE_FLOAT:
+		return _f64Struct.unpack_from(data,pos)[0],pos+_f64Struct.size
+	if tag==_VALUE_STR:
+		return _decode_str(data,pos)
+	if tag==_VALUE_BYTES:
+		n,=_u32Struct.unpack_from(data,pos)
+		pos+=_u32Struct.size
+		if pos+n>len(data):
+			raise ValueError('Truncated message.')
+		return bytes(data[pos:pos+n]),pos+n
+	if tag==_VALUE_LIST:
+		n,=_u32Struct.unpack_from(data,pos)
+		pos+=_u32Struct.size
+		value=[]
+		for i in range(n):
+			x,pos=_decode_value(data,pos,depth+1)
+			value.append(x)
+		return value,pos
+	if tag==_VALUE_DICT:
+		n,=_u32Struct.unpack_from(data,pos)
+		pos+=_u32Struct.size
+		value={}
+		for i in range(n):
+			k,pos=_decode_str(data,pos)
+			value[k],pos=_decode_value(data,pos,depth+1)
+		return value,pos
+	raise ValueError('Unknown value tag.')
+
+
+def stream_write_message(writer,msgType,message,requestId=None,traceContext=None):
+	writer.send_nowait(msgType,message,requestId,traceContext)
 
 
 async def stream_read_message(reader):
+	return await reader.read_message()
+
+
+# sender of a data stream
+# (data are split to chunks of at most dataStreamChunkSize bytes,
+# send() waits while the outgoing queue of the connection is full)
+class DataStreamSender:
+
+	def __init__(self,stream,streamId,requestId=None):
+		self.stream=stream
+		self.streamId=streamId
+		self.requestId=requestId
+		self.sequenceNumber=0
+
+	async def send(self,data,flags=0):
+		pos=0
+		while True:
+			chunk=data[pos:pos+dataStreamChunkSize]
+			pos+=len(chunk)
+			last=pos>=len(data)
+			await self.stream.send(MSG_STREAM,[self.streamId,self.sequenceNumber,flags if last else 0,chunk],self.requestId)
+			self.sequenceNumber+=1
+			if last:
+				break
+
+	async def close(self,data=b''):
+		await self.send(data,STREAM_END)
+
+
+# receiver of a data stream
+# (it checks sequence numbers and returns data of each chunk)
+class DataStreamReceiver:
+
+	def __init__(self):
+		self.sequenceNumber=0
+		self.ended=False
+
+	def receive(self,message):
+		streamId,sequenceNumber,flags,data=message
+		if sequenceNumber!=self.sequenceNumber or self.ended:
+			raise OSError(84,'Illegal byte sequence.')
+		self.sequenceNumber+=1
+		self.ended=flags&STREAM_END!=0
+		return data
+
+
+# protocol engine of pcwaker connections
+#
+# Data are received directly into a single receive buffer (asyncio.BufferedProtocol).
+# All complete frames are parsed out of the buffer through memoryviews
+# on each buffer update and handed out to the reader in batches.
+# The object serves as the writer of the connection as well.
+#
+# Messages are written using codec attribute. The codec is switched to binary codec
+# on the first binary message received. Since then, pickled messages are refused.
+# Pickled messages of the previous versions are unpickled by _RestrictedUnpickler.
+#
+# Outgoing messages are put into the bounded outgoing queue and written
+# by a single writelines() call per event loop iteration. send() waits while
+# the queue is above maxQueuedMessages (high-water mark) or the transport
+# paused writing. send_nowait() never waits; above the high-water mark,
+# MSG_LOG messages are merged with the last queued log message or dropped.
+# Other messages are queued up to maxOutgoingMessages (hard limit); a peer
+# that does not read them is disconnected and counted in overflowedConnections.
+#
+# Messages sent with trace context are recorded as network write spans (from queueing
+# to the write) and the context is put into the frame header if peerTracing is set.
+# Trace context received with the message is available in traceContext after read_message().
+class MessageStream(asyncio.BufferedProtocol):
+
+	initialBufferSize=64*1024
+	minFreeBufferSpace=4096
+	maxPendingMessages=256  # reading is paused when the reader does not keep up
+	maxQueuedMessages=256   # high-water mark of the outgoing queue
+	maxOutgoingMessages=4096  # hard limit of the outgoing queue
+	maxMergedLogSize=64*1024
+	overflowedConnections=0  # connections aborted on the hard limit (of all streams)
+
+	def __init__(self,connectionHandler=None,codec=CODEC_PICKLE):
+		self.connectionHandler=connectionHandler
+		self.transport=None
+		self.codec=codec
+		self.pickleAllowed=True
+		self._buffer=bytearray(self.initialBufferSize)
+		self._view=memoryview(self._buffer)
+		self._start=0  # beginning of unparsed data in the buffer
+		self._end=0    # end of received data in the buffer
+		self._needed=headerStruct.size  # amount of unparsed data needed for the next frame
+		self._messages=collections.deque()
+		self._waiter=None
+		self._eof=False
+		self._eofWaiter=None
+		self._exception=None
+		self._readingPaused=False
+		self._detached=False
+		self.heartbeat=None  # Heartbeat of the connection, if any
+		self.peerTracing=False  # peer accepts trace context in frame headers
+		self.traceContext=None  # trace context of the message returned by the last read_message()
+		self._outgoing=collections.deque()  # (msgType,message,codec,requestId,trace) items
+		self._flushScheduled=False
+		self._writingPaused=False
+		self._drainWaiter=None
+		self.droppedMessages=0
+		self.mergedMessages=0
+		self.bytesSent=0
+		self.bytesReceived=0
+
+	def connection_made(self,transport):
+		self.transport=transport
+		if self.connectionHandler:
+			self.handlerTask=asyncio.get_event_loop().create_task(self.connectionHandler(self))
+
+	def get_buffer(self,sizehint):
+
+		# reuse the buffer from its beginning if everything was parsed
+		if self._start==self._end:
+			self._start=0
+			self._end=0
+
+		# make space for the next frame
+		free=len(self._buffer)-self._end
+		if free<self.minFreeBufferSpace or self._start+self._needed>len(self._buffer):
+			pending=self._end-self._start
+			size=len(self._buffer)
+			while size<self._needed+self.minFreeBufferSpace:
+				size*=2
+			if size!=len(self._buffer):
+				# grow the buffer
+				buffer=bytearray(size)
+				buffer[:pending]=self._view[self._start:self._end]
+				self._buffer=buffer
+				self._view=memoryview(buffer)
+			else:
+				# move unparsed data to the beginning of the buffer
+				self._buffer[:pending]=bytes(self._view[self._start:self._end])
+			self._start=0
+			self._end=pending
+
+		return self._view[self._end:]
+
+	def buffer_updated(self,nbytes):
+		self._end+=nbytes
+		self.bytesReceived+=nbytes
+		try:
+			self._parse_frames()
+		except Exception as e:
+			self._set_exception(e)
+			self.transport.close()
+
+	def _parse_frames(self):
+
+		# parse all complete frames
+		view=self._view
+		start=self._start
+		end=self._end
+		count=0
+		while end-start>=headerStruct.size:
+			msgType,msgSize=headerStruct.unpack_from(view,start)
+			if msgSize>maxMessageSize:
+				raise OSError(84,'Illegal byte sequence.')
+			headerSize=headerStruct.size
+			if msgType&MSG_FLAG_REQUEST_ID:
+				headerSize+=requestIdStruct.size
+			if msgType&MSG_FLAG_TRACE_CONTEXT:
+				headerSize+=traceContextStruct.size
+			frameEnd=start+headerSize+msgSize
+			if frameEnd>end:
+				self._needed=headerSize+msgSize
+				break
+			pos=start+headerStruct.size
+			if msgType&MSG_FLAG_REQUEST_ID:
+				requestId,=requestIdStruct.unpack_from(view,pos)
+				pos+=requestIdStruct.size
+			else:
+				requestId=None
+			if msgType&MSG_FLAG_TRACE_CONTEXT:
+				traceContext=traceContextStruct.unpack_from(view,pos)
+			else:
+				traceContext=None
+			codec=(msgType>>16)&0xff
+			msgType&=0xffff
+			if codec==CODEC_PICKLE:
+				if not self.pickleAllowed:
+					raise OSError(84,'Illegal byte sequence.')
+			elif codec==CODEC_BINARY:
+				# peer uses binary codec, answer it by binary codec as well
+				self.codec=codec
+				self.pickleAllowed=False
+			else:
+				raise OSError(84,'Illegal byte sequence.')
+			message=decode_message(codec,msgType,view[start+headerSize:frameEnd])
+			start=frameEnd
+
+			# heartbeats are processed right away
+			# (ping requests are answered and ping answers passed to the heartbeat,
+			# thus they are not delayed by a busy reader of the messages)
+			if msgType==MSG_PING_REQUEST:
+				self.send_nowait(MSG_PING_ANSWER,[message,time.time()])
+				continue
+			if msgType==MSG_PING_ANSWER:
+				if self.heartbeat is not None:
+					self.heartbeat.answerReceived(message)
+				continue
+
+			self._messages.append((msgType,message,requestId,traceContext))
+			count+=1
+		else:
+			self._needed=headerStruct.size
+		self._start=start
+
+		# wake up the reader and pause reading if it does not keep up
+		if count:
+			self._wakeup()
+			if len(self._messages)>=self.maxPendingMessages and not self._readingPaused:
+				self._readingPaused=True
+				self.transport.pause_reading()
+
+	def eof_received(self):
+		self._eof=True
+		self._wakeup()
+		return True  # keep the transport open for writing
+
+	def connection_lost(self,exc):
+		self._eof=True
+		if exc is not None:
+			self._set_exception(exc)
+		self._wakeup()
+		self._outgoing.clear()
+		self._wakeup_drain()
+
+	def pause_writing(self):
+		self._writingPaused=True
+
+	def resume_writing(self):
+		self._writingPaused=False
+		self._schedule_flush()
+		self._wakeup_drain()
+
+	def _set_exception(self,exc):
+		if self._exception is None:
+			self._exception=exc
+		self._eof=True
+		self._wakeup()
+
+	def _wakeup(self):
+		waiter=self._waiter
+		if waiter is not None and not waiter.done():
+			waiter.set_result(None)
+		if self._eof:
+			waiter=self._eofWaiter
+			if waiter is not None and not waiter.done():
+				waiter.set_result(None)
+
+	async def wait_eof(self):
+		# (returns when the peer closed the connection or the connection was lost;
+		# used by requests lasting until the peer goes away)
+		if self._eof:
+			return
+		if self._eofWaiter is None:
+			self._eofWaiter=asyncio.get_event_loop().create_future()
+		await asyncio.shield(self._eofWaiter)
+
+	async def _wait_for_data(self):
+		if self._readingPaused and not self._detached:
+			self._readingPaused=False
+			self.transport.resume_reading()
+		self._waiter=asyncio.get_event_loop().create_future()
+		try:
+			await self._waiter
+		finally:
+			self._waiter=None
+
+	async def read_messages(self):
+
+		# wait for data
+		if not self._messages and not self._eof:
+			await self._wait_for_data()
+
+		# return all messages received so far
+		# (trace contexts are not returned)
+		if self._messages:
+			messages=[m[:3] for m in self._messages]
+			self._messages.clear()
+			if self._readingPaused and not self._detached:
+				self._readingPaused=False
+				self.transport.resume_reading()
+			return messages
+
+		# return EOF or raise the connection error
+		if self._exception is not None:
+			raise self._exception
+		return [(MSG_EOF,b'',None)]
+
+	async def read_message(self):
+
+		# wait for data
+		if not self._messages and not self._eof:
+			await self._wait_for_data()
+
+		# return the first message received
+		if self._messages:
+			msgType,message,requestId,self.traceContext=self._messages.popleft()
+			return msgType,message,requestId
+
+		# return EOF or raise the connection error
+		self.traceContext=None
+		if self._exception is not None:
+			raise self._exception
+		return MSG_EOF,b'',None
+
+	def at_eof(self):
+		return self._eof and not self._messages
+
+	def feed_data(self,data):
+		self._needed=max(self._needed,self._end-self._start+len(data))
+		self.get_buffer(len(data))[:len(data)]=data
+		self.buffer_updated(len(data))
+
+	def feed_eof(self):
+		self.eof_received()
+
+	def detach(self):
+		# (stops reading and returns (messages,data) - received messages not read yet and unparsed data;
+		# used to hand the connection over to another process, the socket itself is passed separately;
+		# heartbeat is stopped as nothing may be written to the detached connection;
+		# trace contexts of the messages are not kept)
+		self._detached=True
+		if self.heartbeat is not None:
+			self.heartbeat.stop()
+		if not self._readingPaused:
+			self._readingPaused=True
+			self.transport.pause_reading()
+		messages=[m[:3] for m in self._messages]
+		self._messages.clear()
+		data=bytes(self._view[self._start:self._end])
+		self._start=self._end
+		return messages,data
+
+	def restore(self,messages,data):
+		# (puts back messages and data returned by detach() and resumes reading)
+		self._detached=False
+		self._messages.extendleft(reversed([(msgType,message,requestId,None) for msgType,message,requestId in messages]))
+		if data:
+			self.feed_data(data)
+		if self._messages:
+			self._wakeup()
+		if self._readingPaused and self.transport!=None:
+			self._readingPaused=False
+			self.transport.resume_reading()
+		if self.heartbeat is not None:
+			self.heartbeat.start()
+
+	@property
+	def queueDepth(self):
+		return len(self._outgoing)
+
+	def send_nowait(self,msgType,message,requestId=None,traceContext=None):
+
+		# ignore messages sent to closed connection
+		if self.is_closing():
+			return
+
+		# apply drop or merge policy on log messages above high-water mark
+		if len(self._outgoing)>=self.maxQueuedMessages and msgType==MSG_LOG:
+			lastType,lastMessage,lastCodec,lastRequestId,lastTrace=self._outgoing[-1]
+			if lastType==MSG_LOG and lastCodec==self.codec and lastRequestId==requestId and lastTrace is None and \
+			   len(lastMessage)+len(message)<self.maxMergedLogSize:
+				self._outgoing[-1]=(MSG_LOG,lastMessage+'\n'+message,lastCodec,lastRequestId,None)
+				self.mergedMessages+=1
+			else:
+				self.droppedMessages+=1
+			return
+
+		# abort the connection when the hard limit is reached
+		# (the peer does not read messages, such as watched transitions, that can not wait)
+		if len(self._outgoing)>=self.maxOutgoingMessages:
+			MessageStream.overflowedConnections+=1
+			self._outgoing.clear()
+			self.transport.abort()
+			self._wakeup_drain()
+			return
+
+		# queue the message
+		# (traced messages remember the time of queueing for their network write span)
+		if traceContext is None:
+			trace=None
+		else:
+			trace=(traceContext[0],traceContext[1],time.monotonic())
+		self._outgoing.append((msgType,message,self.codec,requestId,trace))
+		self._schedule_flush()
+
+	async def send(self,msgType,message,requestId=None,traceContext=None):
+		while len(self._outgoing)>=self.maxQueuedMessages and not self.is_closing():
+			await self._wait_for_drain()
+		self.send_nowait(msgType,message,requestId,traceContext)
+
+	async def drain(self):
+		while (self._outgoing or self._writingPaused) and not self.is_closing():
+			await self._wait_for_drain()
+
+	async def _wait_for_drain(self):
+		if self._drainWaiter is None:
+			self._drainWaiter=asyncio.get_event_loop().create_future()
+		await asyncio.shield(self._drainWaiter)
+
+	def _wakeup_drain(self):
+		waiter=self._drainWaiter
+		if waiter is not None:
+			self._drainWaiter=None
+			if not waiter.done():
+				waiter.set_result(None)
+
+	def _schedule_flush(self):
+		if not self._flushScheduled and not self._writingPaused and self._outgoing:
+			self._flushScheduled=True
+			asyncio.get_event_loop().call_soon(self._flush)
+
+	def _flush(self,force=False):
+
+		# write all queued messages by a single writelines() call
+		self._flushScheduled=False
+		if (self._writingPaused and not force) or self.is_closing():
+			return
+		buffers=[]
+		traced=None
+		while self._outgoing:
+			msgType,message,codec,requestId,trace=self._outgoing.popleft()
+			data=encode_message(codec,msgType,message)
+			if requestId is None and (trace is None or not self.peerTracing):
+				buffers.append(headerStruct.pack(msgType|codec<<16,len(data)))
+			else:
+				flags=0
+				header=b''
+				if requestId is not None:
+					flags|=MSG_FLAG_REQUEST_ID
+					header+=requestIdStruct.pack(requestId)
+				if trace is not None and self.peerTracing:
+					flags|=MSG_FLAG_TRACE_CONTEXT
+					header+=traceContextStruct.pack(trace[0],trace[1])
+				buffers.append(headerStruct.pack(msgType|codec<<16|flags,len(data))+header)
+			buffers.append(data)
+			size=len(buffers[-2])+len(data)
+			self.bytesSent+=size
+			if trace is not None:
+				if traced is None:
+					traced=[]
+				traced.append((msgType,trace,size))
+		if buffers:
+			self.transport.writelines(buffers)
+		self._wakeup_drain()
+
+		# record network write spans of traced messages
+		if traced:
+			t=time.monotonic()
+			for msgType,trace,size in traced:
+				tracer.record('network write','network',trace[2],t,trace[:2],{'msgType':msgType,'bytes':size})
+
+	def write(self,data):
+		self._flush(force=True)
+		self.transport.write(data)
+
+	def writelines(self,data):
+		self._flush(force=True)
+		self.transport.writelines(data)
+
+	def write_eof(self):
+		self._flush(force=True)
+		self.transport.write_eof()
+
+	def can_write_eof(self):
+		return self.transport.can_write_eof()
+
+	def is_closing(self):
+		return self.transport is None or self.transport.is_closing()
+
+	def close(self):
+		if self.transport is not None:
+			self._flush(force=True)
+			self.transport.close()
+
+	def get_extra_info(self,name,default=None):
+		return self.transport.get_extra_info(name,default)
+
+
+# timer wheel
+#
+# Timers of many connections, such as their heartbeats, share a single timer of the event loop.
+# Timers are hashed into wheelSize slots by their deadline rounded up to tickInterval, each tick
+# processes one slot. The wheel ticks only while any timer is scheduled. Timers fire at most
+# tickInterval late, never early.
+class TimerWheel:
+
+	def __init__(self,tickInterval=0.1,wheelSize=64):
+		self.tickInterval=tickInterval
+		self.slots=[[] for i in range(wheelSize)]
+		self.count=0          # number of scheduled timers
+		self.lastTick=None    # number of the last processed tick
+		self.handle=None
+
+	def schedule(self,delay,callback):
+		# (returns timer to be passed to cancel(); callback is called without parameters)
+		tick=int((time.monotonic()+delay)/self.tickInterval)+1
+		timer=[tick,callback]
+		self.slots[tick%len(self.slots)].append(timer)
+		self.count+=1
+		if self.handle is None:
+			self.lastTick=int(time.monotonic()/self.tickInterval)
+			self._scheduleTick()
+		return timer
+
+	def cancel(self,timer):
+		# (cancelled timer is only marked, it is removed from its slot by the tick)
+		if timer is None or timer[1] is None:
+			return
+		timer[1]=None
+		self.count-=1
+		if self.count==0 and self.handle is not None:
+			self.handle.cancel()
+			self.handle=None
+
+	def _scheduleTick(self):
+		# (ticks run in an empty context, thus the timers do not inherit the current span
+		# of the code that happened to start the wheel)
+		delay=(self.lastTick+1)*self.tickInterval-time.monotonic()
+		self.handle=asyncio.get_event_loop().call_later(max(delay,0),self._tick,context=contextvars.Context())
+
+	def _tick(self):
+
+		# process slots of all ticks elapsed since the last one
+		# (each slot is processed at most once if the event loop was blocked for a long time)
+		self.handle=None
+		now=int(time.monotonic()/self.tickInterval)
+		first=max(self.lastTick+1,now-len(self.slots)+1)
+		self.lastTick=now
+		for tick in range(first,now+1):
+			slot=self.slots[tick%len(self.slots)]
+			expired=[timer for timer in slot if timer[0]<=now]
+			if not expired:
+				continue
+			slot[:]=[timer for timer in slot if timer[0]>now]
+			for timer in expired:
+				callback=timer[1]
+				if callback is None:
+					continue
+				timer[1]=None
+				self.count-=1
+				callback()
+
+		# tick again while any timer is scheduled
+		if self.count>0 and self.handle is None:
+			self._scheduleTick()
+
+
+# phi accrual failure detector
+#
+# Intervals between heartbeats are kept in a sliding window. Phi is -log10 of the probability
+# that the next heartbeat arrives even later than now, given the normal distribution of the observed
+# intervals (logistic approximation). Thus the suspicion grows with the silence relative to the usual
+# interval and its jitter: a steady connection is suspected soon, a jittery one only after a longer silence.
+# acceptablePause is added to the mean interval to tolerate short stalls of the peer.
+class PhiAccrualDetector:
+
+	def __init__(self,expectedInterval,windowSize=100,minStdDeviation=0.1,acceptablePause=2.0):
+		self.minStdDeviation=minStdDeviation
+		self.acceptablePause=acceptablePause
+		self.intervals=collections.deque(maxlen=windowSize)
+		self.sum=0.0
+		self.sumOfSquares=0.0
+		self.lastArrival=None
+
+		# bootstrap by the expected interval
+		# (phi is defined before the first heartbeats arrive)
+		self._add(expectedInterval*0.75)
+		self._add(expectedInterval*1.25)
+
+	def restart(self,t):
+		# (the next interval is measured from t; used when heartbeats are started)
+		self.lastArrival=t
+
+	def heartbeat(self,t):
+		if self.lastArrival is not None:
+			self._add(t-self.lastArrival)
+		self.lastArrival=t
+
+	def _add(self,interval):
+		if len(self.intervals)==self.intervals.maxlen:
+			old=self.intervals[0]
+			self.sum-=old
+			self.sumOfSquares-=old*old
+		self.intervals.append(interval)
+		self.sum+=interval
+		self.sumOfSquares+=interval*interval
+
+	def phi(self,t):
+		if self.lastArrival is None:
+			return 0.0
+		n=len(self.intervals)
+		mean=self.sum/n+self.acceptablePause
+		deviation=max(math.sqrt(max(self.sumOfSquares/n-(self.sum/n)**2,0.0)),self.minStdDeviation)
+		y=(t-self.lastArrival-mean)/deviation
+		z=y*(1.5976+0.070566*y*y)
+		if z>30:
+			return z/math.log(10)  # (avoids overflow; log10(1+exp(z)) equals z/ln(10) here)
+		return math.log10(1.0+math.exp(z))
+
+
+# heartbeat of a connection
+#
+# MSG_PING_REQUEST carrying the current time is sent every interval, driven by the timer wheel.
+# The peer's MessageStream answers it right away by MSG_PING_ANSWER carrying the same time
+# and the wall clock time of the peer. The answer gives the round trip time and NTP-style estimate
+# of the clock offset of the peer (the peer's clock at the answer minus our clock in the middle
+# of the exchange); the last windowSize values of both are kept for percentiles.
+# Arrivals of the answers feed the phi accrual detector;
+# when phi reaches phiThreshold on a beat, failureCallback(heartbeat,phi) is called and no more
+# pings are sent. Heartbeat is set as the heartbeat of the stream, thus answers reach it.
+class Heartbeat:
+
+	interval=1.0
+	phiThreshold=8.0
+	windowSize=100
+
+	def __init__(self,wheel,stream,failureCallback):
+		self.wheel=wheel
+		self.stream=stream
+		self.failureCallback=failureCallback
+		self.detector=PhiAccrualDetector(self.interval)
+		self.timer=None
+		self.roundTripTime=None  # seconds, measured by the latest answer
+		self.roundTripTimes=collections.deque(maxlen=self.windowSize)
+		self.clockOffsets=collections.deque(maxlen=self.windowSize)  # peer's clock minus ours, seconds
+		stream.heartbeat=self
+
+	def start(self):
+		if self.timer is None:
+			self.detector.restart(time.monotonic())
+			self.timer=self.wheel.schedule(0,self._beat)
+
+	def stop(self):
+		self.wheel.cancel(self.timer)
+		self.timer=None
+
+	def _beat(self):
+		self.timer=None
+		if self.stream.is_closing():
+			return
+		now=time.monotonic()
+		phi=self.detector.phi(now)
+		if phi>=self.phiThreshold:
+			self.failureCallback(self,phi)
+			return
+		self.stream.send_nowait(MSG_PING_REQUEST,now)
+		self.timer=self.wheel.schedule(self.interval,self._beat)
+
+	def answerReceived(self,message):
+
+		# (peers of older versions answer just by the time of the request)
+		now=time.monotonic()
+		if type(message)==list:
+			t,peerTime=message
+		else:
+			t,peerTime=message,None
+		self.detector.heartbeat(now)
+		self.roundTripTime=now-t
+		self.roundTripTimes.append(self.roundTripTime)
+		if peerTime is not None:
+			wallClockOffset=time.time()-now
+			self.clockOffsets.append(peerTime-((t+now)/2+wallClockOffset))
+
+	def statistics(self):
+
+		# round trip time percentiles and median clock offset
+		# (returns dict of seconds, values are None if nothing was measured yet)
+		def percentile(values,p):
+			if not values:
+				return None
+			values=sorted(values)
+			return values[min(len(values)-1,int(len(values)*p/100))]
+		return {'roundTripTimeP50':percentile(self.roundTripTimes,50),
+		        'roundTripTimeP90':percentile(self.roundTripTimes,90),
+		        'roundTripTimeP99':percentile(self.roundTripTimes,99),
+		        'clockOffset':percentile(self.clockOffsets,50)}
+
+
+# tracing
+#
+# A span measures the duration of an operation, such as a request, a power button pulse
+# or a command executed on a computer. Spans caused by one request form a trace: each span
+# carries the id of its trace and the id of its parent span (None for the root span).
+# The current span is kept in currentSpan context variable, thus it follows the code across awaits
+# and into the tasks and callbacks created meanwhile; spans begun without parent are children
+# of the current span and they start a new trace if there is no current span. Trace context
+# (trace id and span id) is passed to the peer in the frame header, thus the spans of the peer
+# join the trace. Finished spans are kept in the ring buffer of maxSpans spans.
+# Times are given by time.monotonic(); process is None for the spans of this process.
+currentSpan=contextvars.ContextVar('currentSpan',default=None)
+
+
+class Span:
+
+	__slots__=('name','category','traceId','spanId','parentId','start','end','args','process','thread')
+
+	def __init__(self,name,category,traceId,spanId,parentId,start,args,process=None,thread=None):
+		self.name=name
+		self.category=category
+		self.traceId=traceId
+		self.spanId=spanId
+		self.parentId=parentId
+		self.start=start
+		self.end=None     # None until the span is finished
+		self.args=args    # dict of str, int, float or bool values
+		self.process=process
+		self.thread=thread
+
+	@property
+	def context(self):
+		return (self.traceId,self.spanId)
+
+
+class Tracer:
+
+	def __init__(self,maxSpans=10000):
+		self.spans=collections.deque(maxlen=maxSpans)  # finished spans, the oldest first
+		self.openSpans={}  # spanId -> span not finished yet
+
+	def newId(self):
+		# (63 bits, thus the ids fit into signed integers of binary codec)
+		return random.getrandbits(63) or 1
+
+	def begin(self,name,category,parent=None,start=None,args=None,process=None,thread=None):
+		# (parent is a span or trace context (traceId,spanId); the span must be finished by end())
+		if parent is None:
+			parent=currentSpan.get()
+		if parent is None:
+			traceId,parentId=self.newId(),None
+		elif type(parent)==tuple:
+			traceId,parentId=parent
+		else:
+			traceId,parentId=parent.traceId,parent.spanId
+		span=Span(name,category,traceId,self.newId(),parentId,time.monotonic() if start is None else start,
+		          {} if args is None else args,process,thread)
+		self.openSpans[span.spanId]=span
+		return span
+
+	def end(self,span,end=None):
+		if span.end is not None:
+			return
+		span.end=time.monotonic() if end is None else end
+		self.openSpans.pop(span.spanId,None)
+		self.spans.append(span)
+
+	def record(self,name,category,start,end,parent=None,args=None,process=None,thread=None):
+		# (records span measured by other means, such as by the hardware thread)
+		span=self.begin(name,category,parent,start,args,process,thread)
+		self.end(span,end)
+		return span
+
+	@contextlib.contextmanager
+	def span(self,name,category,parent=None,args=None):
+		# (the span is the current span inside the with block)
+		span=self.begin(name,category,parent,args=args)
+		token=currentSpan.set(span)
+		try:
+			yield span
+		finally:
+			currentSpan.reset(token)
+			self.end(span)
+
+	def takeRecords(self):
+		# (removes finished spans and returns them as MSG_TRACE records;
+		# start is given by wall clock time, thus the peer can convert it by the clock offset)
+		wallClockOffset=time.time()-time.monotonic()
+		records=[[s.name,s.category,s.traceId,s.spanId,s.parentId,s.start+wallClockOffset,s.end-s.start,s.args]
+		         for s in self.spans]
+		self.spans.clear()
+		return records
+
+
+def traceContext():
+	# (returns trace context of the current span or None)
+	span=currentSpan.get()
+	return None if span is None else (span.traceId,span.spanId)
+
+
+tracer=Tracer()
+
+
+# connection to pcwakerd carrying many concurrent requests
+#
+# Each request gets its own request id. Responses of the requests arrive
+# interleaved and they are dispatched to the requests by their request ids.
+# The response of each request is terminated by MSG_DONE.
+class RequestConnection:
+
+	def __init__(self):
+		self.stream=None
+		self._requests={}
+		self._nextRequestId=1
+		self._readerTask=None
+
+	async def connect(self,host,port):
+		loop=asyncio.get_event_loop()
+		_,self.stream=await loop.create_connection(lambda: MessageStream(codec=CODEC_BINARY),host,port)
+		self._readerTask=loop.create_task(self._read_responses())
+
+	async def _read_responses(self):
+		try:
+			while True:
+				msgType,message,requestId=await self.stream.read_message()
+				if msgType==MSG_EOF:
+					break
+				queue=self._requests.get(requestId)
+				if queue is not None:
+					queue.put_nowait((msgType,message))
+		except OSError:
+			pass
+		finally:
+			# terminate all pending requests
+			for queue in self._requests.values():
+				queue.put_nowait((MSG_EOF,b''))
+
+	def is_closed(self):
+		return self.stream is None or self.stream.is_closing() or self._readerTask.done()
+
+	async def request(self,message,callback=None):
+
+		# allocate request id
+		requestId=self._nextRequestId
+		self._nextRequestId=requestId%0x7fffffff+1
+		queue=asyncio.Queue()
+		self._requests[requestId]=queue
+
+		# send request and collect the response
+		# (each response message is passed to callback if given, otherwise it is returned in the list)
+		try:
+			if self._readerTask.done():
+				raise ConnectionResetError(104,'Connection to the daemon was closed.')
+			await self.stream.send(MSG_USER,message,requestId)
+			response=[]
+			while True:
+				msgType,message=await queue.get()
+				if msgType==MSG_DONE:
+					break
+				if msgType==MSG_EOF:
+					raise ConnectionResetError(104,'Connection to the daemon was closed.')
+				if callback is None:
+					response.append((msgType,message))
+				else:
+					callback(msgType,message)
+			return response
+		finally:
+			del self._requests[requestId]
 
-	# read msgType
-	data=await reader.read(4)
-	if len(data)!=4:
-		if len(data)==0 and reader.at_eof(): return MSG_EOF,b''
-		raise OSError(84,'Illegal byte sequence.')
-	msgType,=struct.unpack_from('!I',data,0)
-
-	# read msgSize
-	data=await reader.read(4)
-	if len(data)!=4: raise OSError(84,'Illegal byte sequence.')
-	msgSize,=struct.unpack_from('!I',data,0)
-
-	# read message
-	data=await reader.read(msgSize)
-	if len(data)!=msgSize: OSError(84,'Illegal byte sequence.')
-	message=pickle.loads(data)
-	return msgType,message
+	async def close(self):
+		if self.stream is not None:
+			self.stream.close()
+			await self._readerTask
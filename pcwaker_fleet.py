@@ -0,0 +1,318 @@
+import array
+import collections
+import logging
+import time
+import traceback
+from pcwaker_common import tracer
+
+
+# computer states and events
+# (the transitions are given by transitionTable of pcwakerd.py)
+class Status:
+
+	OFF=1
+	STARTING=2
+	ON=3
+	STOPPING=4
+	FROZEN=5
+	START_AFTER_STOPPED=6
+	STOP_AFTER_STARTED=7
+
+	def str(status):
+		return _status2string.get(status,"unknown")
+
+_status2string={
+	Status.OFF:      "OFF",
+	Status.STARTING: "STARTING",
+	Status.ON:       "ON",
+	Status.STOPPING: "STOPPING",
+	Status.FROZEN:   "FROZEN",
+	Status.START_AFTER_STOPPED: "START_AFTER_STOPPED",
+	Status.STOP_AFTER_STARTED:  "STOP_AFTER_STARTED",
+}
+
+class NoRequestedOS:
+	name="None"
+
+noRequestedOS=NoRequestedOS
+
+class Event:
+
+	POWER_ON=1       # power signal appeared
+	POWER_LOST=2     # power signal disappeared
+	CONNECTED=3      # computer booted requested operating system and announced it is alive
+	DISCONNECTED=4   # connection of the computer is not present
+	PING_TIMEOUT=5   # connection of the computer does not answer to ping
+	START=6          # pcwaker start
+	RESTART=7        # pcwaker restart
+	STOP=8           # pcwaker stop
+	STARTED=9        # computer powered on by startAfterStopped procedure
+	START_FAILED=10  # computer failed to power on in startAfterStopped procedure
+
+	def str(event):
+		return _event2string.get(event,"unknown")
+
+_event2string={
+	Event.POWER_ON:     "POWER_ON",
+	Event.POWER_LOST:   "POWER_LOST",
+	Event.CONNECTED:    "CONNECTED",
+	Event.DISCONNECTED: "DISCONNECTED",
+	Event.PING_TIMEOUT: "PING_TIMEOUT",
+	Event.START:        "START",
+	Event.RESTART:      "RESTART",
+	Event.STOP:         "STOP",
+	Event.STARTED:      "STARTED",
+	Event.START_FAILED: "START_FAILED",
+}
+
+
+# transition record passed to the subscribers of the transition event bus
+Transition=collections.namedtuple('Transition',['time','pc','oldStatus','newStatus','event'])
+
+
+# fleet model
+#
+# States of all computers are stored in a compact array indexed by computer index (pc.index)
+# and in bitsets over computer indices, one bitset per state. Power inputs are mapped
+# to the bitset of powered computers by precomputed lookup tables (one table of 256 entries
+# for each byte of power inputs). Thus, all power-up and power-lost transitions
+# of the whole fleet are computed from a single input word by a few bit operations.
+#
+# State changes are driven by the transition table given on construction, either for a single
+# computer by dispatch() or for all computers receiving the same event at once by bit operations
+# over state bitsets.
+# Each transition is published to the subscribers of the transition event bus
+# (callbacks called in the event loop with Transition record; do not put any await
+# or yield calls in them). pc.status mirrors the state array for reading.
+class Fleet:
+
+	def __init__(self,computerList,transitionTable):
+
+		self.transitionTable=transitionTable
+		self.subscribers=[]
+
+		# transitions of each event
+		# (used for the events processed for all computers at once)
+		self.eventTransitions=collections.defaultdict(list)
+		for (status,event),(newStatus,action,message) in transitionTable.items():
+			if newStatus!=None:
+				self.eventTransitions[event].append((status,newStatus,action))
+
+		self.setComputers(computerList)
+
+	def setComputers(self,computerList):
+
+		# computer records
+		# (records that were already part of the fleet keep their state, new records start in OFF state;
+		# used on initialization and on configuration reload)
+		self.computers=list(computerList)
+		self.states=array.array('B',[Status.OFF]*len(self.computers))
+		self.stateBits=[0]*(max(_status2string)+1)
+		self.wiredBits=0       # computers with wires to detect their power state
+		self.connectedBits=0   # computers connected to the daemon
+		inputSize=1
+		for i,pc in enumerate(self.computers):
+			pc.index=i
+			if pc.status==None:
+				pc.status=Status.OFF
+				pc.stream=None
+				pc.requestedOS=noRequestedOS
+			if pc.timeOfStatusChange==None:
+				pc.timeOfStatusChange=time.monotonic()
+			self.states[i]=pc.status
+			self.stateBits[pc.status]|=1<<i
+			if pc.powerBitMask!=0:
+				self.wiredBits|=1<<i
+			if pc.stream!=None:
+				self.connectedBits|=1<<i
+			inputSize=max(inputSize,(pc.powerBitMask.bit_length()+7)//8)
+
+		# lookup tables mapping each byte of power inputs to the bitset of powered computers
+		self.poweredTables=[]
+		for byteIndex in range(inputSize):
+			table=[0]*256
+			for i,pc in enumerate(self.computers):
+				mask=(pc.powerBitMask>>(8*byteIndex))&0xff
+				if mask!=0:
+					for value in range(256):
+						if value&mask!=0:
+							table[value]|=1<<i
+			self.poweredTables.append(table)
+
+	def subscribe(self,callback):
+		self.subscribers.append(callback)
+
+	def unsubscribe(self,callback):
+		if callback in self.subscribers:
+			self.subscribers.remove(callback)
+
+	def dispatch(self,pc,event,wlog=None):
+
+		# process event of single computer by transition table
+		# (returns False if the event is not valid in the current state)
+		rule=self.transitionTable.get((pc.status,event))
+		if rule==None:
+			return False
+		newStatus,action,message=rule
+		if message!=None and wlog!=None:
+			wlog.info(message.format(pc.name))
+		if newStatus!=None:
+			oldStatus=pc.status
+			bit=1<<pc.index
+			self.stateBits[oldStatus]&=~bit
+			self.stateBits[newStatus]|=bit
+			self._setStatus(pc,oldStatus,newStatus,event)
+		if action!=None:
+			action(pc,wlog)
+		return True
+
+	def _setStatus(self,pc,oldStatus,newStatus,event):
+		self.states[pc.index]=newStatus
+		pc.status=newStatus
+		pc.timeOfStatusChange=time.monotonic()
+		if self.subscribers:
+			transition=Transition(time.time(),pc,oldStatus,newStatus,event)
+			for callback in list(self.subscribers):
+				try:
+					callback(transition)
+				except Exception:
+					logging.getLogger('main').critical('\nException raised in transition subscriber:\n'+traceback.format_exc())
+
+	def _dispatchAll(self,event,computerBits):
+
+		# process event of all computers in computerBits at once
+		# (moves are computed first, thus each computer makes at most one transition)
+		s=self.stateBits
+		moves=[]
+		for status,newStatus,action in self.eventTransitions[event]:
+			bits=s[status]&computerBits
+			if bits!=0:
+				moves.append((status,newStatus,action,bits))
+		changed=0
+		for status,newStatus,action,bits in moves:
+			s[status]&=~bits
+			s[newStatus]|=bits
+			changed|=bits
+			while bits:
+				bit=bits&-bits
+				bits^=bit
+				pc=self.computers[bit.bit_length()-1]
+				self._setStatus(pc,status,newStatus,event)
+				if action!=None:
+					action(pc,None)
+		return changed
+
+	def setStream(self,pc,stream):
+		pc.stream=stream
+		if pc.index<0:  # computer removed by configuration reload
+			return
+		if stream==None:
+			self.connectedBits&=~(1<<pc.index)
+		else:
+			self.connectedBits|=1<<pc.index
+
+	def evaluate(self,powerInputBits):
+
+		# get powered computers
+		powered=0
+		for byteIndex,table in enumerate(self.poweredTables):
+			powered|=table[(powerInputBits>>(8*byteIndex))&0xff]
+
+		# process power and connection events
+		# (power lost is not processed for computers that have powerBitMask set to zero - no wires to the computer)
+		changed=self._dispatchAll(Event.POWER_ON,powered)
+		changed|=self._dispatchAll(Event.POWER_LOST,self.wiredBits&~powered)
+		changed|=self._dispatchAll(Event.DISCONNECTED,~self.connectedBits)
+
+		# return changed computers
+		return changed
+
+
+# replies of watch request
+# (structured messages rendered by pcwaker.py; the first message of each computer
+# holds its current state, the following ones its transitions)
+def currentStatusReply(pc,t):
+	return {'name':pc.name,'oldStatus':None,'status':Status.str(pc.status),'event':None,'time':t}
+
+def transitionReply(transition):
+	return {'name':transition.pc.name,'oldStatus':Status.str(transition.oldStatus),
+	        'status':Status.str(transition.newStatus),'event':Event.str(transition.event),'time':transition.time}
+
+
+# wait request
+# (parameters are computer name, comma separated states and optional --timeout seconds;
+# returns (name,statuses,timeout) or raises ValueError with the text of the error reply)
+def parseWaitParameters(params):
+	p=list(params)
+	timeout=None
+	if '--timeout' in p:
+		i=p.index('--timeout')
+		try:
+			timeout=float(p[i+1])
+		except (IndexError,ValueError):
+			raise ValueError('Error: --timeout requires number of seconds.')
+		del p[i:i+2]
+	if len(p)!=2:
+		raise ValueError('Error: Computer name and state(s) expected.')
+	string2status={v:k for k,v in _status2string.items()}
+	statuses=set()
+	for name in p[1].split(','):
+		status=string2status.get(name.upper())
+		if status==None:
+			raise ValueError('Error: Unknown state '+name+' (use '+', '.join(_status2string.values())+').')
+		statuses.add(status)
+	return p[0],statuses,timeout
+
+def waitReply(pc,reachTime,startTime):
+	# (reachTime is None on timeout)
+	return {'name':pc.name,'status':Status.str(pc.status),'reached':reachTime!=None,
+	        'waitTime':(reachTime if reachTime!=None else time.monotonic())-startTime}
+
+
+# waiters for computer states
+# (transition() is the subscriber of the transition event bus waking up the waiters)
+class StatusWaiters:
+
+	def __init__(self,loop):
+		self.loop=loop
+		self.waiters={}  # computer -> list of (statuses,future)
+
+	def wait(self,pc,statuses,timeout=None):
+
+		# wait until the computer gets to one of the statuses
+		# (returns future of time.monotonic() of the transition, current time if already in one of the statuses,
+		# or None on timeout (None means no timeout); the waiter is woken up by transition() right
+		# on the transition; cancelling the future removes the waiter)
+		future=self.loop.create_future()
+		if pc.status in statuses:
+			future.set_result(time.monotonic())
+			return future
+		waiter=(statuses,future)
+		self.waiters.setdefault(pc,[]).append(waiter)
+		if timeout!=None:
+			timer=self.loop.call_later(timeout,lambda: future.done() or future.set_result(None))
+		else:
+			timer=None
+		span=tracer.begin('wait for '+','.join(sorted(Status.str(s) for s in statuses)),'wait',args={'computer':pc.name})
+		def removeWaiter(f):
+			if timer!=None:
+				timer.cancel()
+			waiters=self.waiters[pc]
+			waiters.remove(waiter)
+			if not waiters:
+				del self.waiters[pc]
+			span.args['reached']=not f.cancelled() and f.result()!=None
+			tracer.end(span)
+		future.add_done_callback(removeWaiter)
+		return future
+
+	def transition(self,transition):
+
+		# wake up waiters for the new state
+		waiters=self.waiters.get(transition.pc)
+		if waiters:
+			t=time.monotonic()
+			for statuses,future in waiters:
+				if transition.newStatus in statuses and not future.done():
+					future.set_result(t)
+
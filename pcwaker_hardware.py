@@ -0,0 +1,556 @@
+import asyncio
+import collections
+import errno
+import logging
+import queue
+import threading
+import time
+import bdaqctrl
+from pcwaker_common import currentSpan
+
+
+# USB-4761 hardware service
+#
+# USB-4761 device is owned by a dedicated thread. All device access is performed
+# by this thread, thus no USB round-trip blocks the event loop. Requests are put
+# into the request queue and their results are returned through asyncio futures.
+#
+# Requests are processed in the order they were issued, thus the read issued
+# after the write always sees the written value. All read requests waiting
+# in the queue together (usually the requests issued while the previous USB
+# transaction was in progress) are coalesced into a single USB transaction.
+#
+# Input bits reported by change-of-state interrupts are passed
+# to changeOfStateCallback(inputBits) in the event loop. Each USB transaction is timed
+# by the thread and passed to transactionCallback(kind,startTime,seconds,spans) in the event loop
+# (kind is 'read' or 'write', spans are the current spans of the requests served
+# by the transaction, if any). Change-of-state interrupts
+# are used only if the device supports them and bdaqctrl wrapper was built
+# with directors (see bdaqctrl.i).
+#
+# Once the service is not running (before open(), after the device failed to open
+# or after close()), requests fail by OSError; no future is left unresolved.
+class HardwareService:
+
+	def __init__(self,loop,deviceDescription='USB-4761,BID#0'):
+		self.loop=loop
+		self.deviceDescription=deviceDescription
+		self.requestQueue=queue.Queue()
+		self.thread=None
+		self.lock=threading.Lock()
+		self.stopped=True          # requests are refused (guarded by lock)
+		self.pendingRequests=0     # requests whose results were not returned to the event loop yet
+		self.inputBits=0           # the last value read from the device
+		self.changeOfStateCallback=None
+		self.changeOfStateEnabled=False
+		self.transactionCallback=None
+		self.readRequests=0        # number of read requests
+		self.readTransactions=0    # number of USB transactions performed to serve read requests
+		self.writeTransactions=0   # number of USB transactions performed to serve write requests
+
+	async def open(self):
+		# (raises OSError if the device can not be opened)
+		self.stopped=False
+		self.thread=threading.Thread(target=self._run,name='USB-4761',daemon=True)
+		self.thread.start()
+		await self._request('open',self.deviceDescription)
+
+	def close(self):
+		# (blocks until the device is disposed, thus it can be called when the event loop is not running)
+		if self.thread:
+			with self.lock:
+				self.stopped=True
+			self.requestQueue.put(('close',None,None,None))
+			self.thread.join()
+			self.thread=None
+
+	def read(self):
+		# (the returned future gives input bits or raises OSError on device error)
+		self.readRequests+=1
+		return self._request('read',None)
+
+	async def enableChangeOfState(self,mask):
+		# (raises NotImplementedError if change-of-state interrupts are not available;
+		# if they are already enabled, only the mask is changed)
+		await self._request('cos',mask)
+		self.changeOfStateEnabled=True
+
+	def write(self,outputBits):
+		# (the returned future gives error code of the write as returned by USB-4761 driver
+		# and time.monotonic() time of its completion; the write is performed even if the future is not awaited)
+		return self._request('write',outputBits)
+
+	def _request(self,requestType,arg):
+		future=self.loop.create_future()
+		with self.lock:
+			if self.stopped:
+				future.set_exception(self._notRunningError())
+			else:
+				self.requestQueue.put((requestType,arg,future,currentSpan.get()))
+				self.pendingRequests+=1
+		return future
+
+	@staticmethod
+	def _notRunningError():
+		return OSError(errno.ENODEV,'USB-4761 hardware service is not running.')
+
+	def _setResults(self,results,transactions):
+		# (runs in the event loop)
+		if self.transactionCallback:
+			for kind,startTime,duration,spans in transactions:
+				self.transactionCallback(kind,startTime,duration,spans)
+		self.pendingRequests-=len(results)
+		for requestType,future,value in results:
+			if requestType=='read' and not isinstance(value,Exception):
+				self.inputBits=value
+			if future.cancelled():
+				continue
+			if isinstance(value,Exception):
+				future.set_exception(value)
+			else:
+				future.set_result(value)
+
+	def _changeOfState(self,inputBits):
+		# (runs in the event loop)
+		self.inputBits=inputBits
+		if self.changeOfStateCallback:
+			self.changeOfStateCallback(inputBits)
+
+	def _run(self):
+
+		# the thread owning the device
+		dataInput=None
+		dataOutput=None
+		listener=None
+		inputBits=None
+		running=True
+		while running:
+
+			# get all requests waiting in the queue
+			requests=[self.requestQueue.get()]
+			try:
+				while True:
+					requests.append(self.requestQueue.get_nowait())
+			except queue.Empty:
+				pass
+
+			# process requests
+			# (consecutive reads are served by a single USB transaction)
+			results=[]
+			transactions=[]
+			value=None
+			for index,(requestType,arg,future,span) in enumerate(requests):
+				# (exception raised by the wrapper fails the request; the device is not used
+				# after open failed, thus the rest of the requests fail as on device error)
+				try:
+					if requestType=='read':
+						if value==None:
+							t=time.monotonic()
+							r=dataInput.Read(0,inputBits)
+							transactions.append(('read',t,time.monotonic()-t,[]))
+							self.readTransactions+=1
+							if r!=0: value=OSError(r,'USB-4761 device error (error code: '+hex(r)+').')
+							else: value=inputBits.value()
+						if span!=None:
+							transactions[-1][3].append(span)
+						results.append((requestType,future,value))
+
+					elif requestType=='write':
+						t=time.monotonic()
+						r=dataOutput.Write(0,arg)
+						t2=time.monotonic()
+						transactions.append(('write',t,t2-t,[span] if span!=None else []))
+						self.writeTransactions+=1
+						value=None
+						results.append((requestType,future,(r,t2)))
+
+					elif requestType=='open':
+						inputBits=bdaqctrl.uint8()
+						dataInput=bdaqctrl.AdxInstantDiCtrlCreate()
+						dataOutput=bdaqctrl.AdxInstantDoCtrlCreate()
+						deviceInformation=bdaqctrl.DeviceInformation(arg)
+						r=dataInput.setSelectedDevice(deviceInformation)
+						if r==0:
+							r=dataOutput.setSelectedDevice(deviceInformation)
+						if r!=0:
+							results.append((requestType,future,OSError(r,'Can not connect to USB-4761 device (error code: '+hex(r)+').')))
+							running=False
+						else:
+							results.append((requestType,future,None))
+
+					elif requestType=='cos' and listener!=None:
+
+						# change mask of running change-of-state interrupts
+						# (used on configuration reload)
+						dataInput.SnapStop()
+						r=dataInput.getDiCosintPorts().getItem(0).setMask(arg)
+						if r==0:
+							r=dataInput.SnapStart()
+						if r!=0: results.append((requestType,future,OSError(r,'USB-4761 device error (error code: '+hex(r)+').')))
+						else: results.append((requestType,future,None))
+
+					elif requestType=='cos':
+						try:
+							if not dataInput.getFeatures().getDiCosintSupported():
+								raise NotImplementedError('device does not support change-of-state interrupts')
+							try:
+								listener=ChangeOfStateListener(self)
+								port=dataInput.getDiCosintPorts().getItem(0)
+							except AttributeError:
+								raise NotImplementedError('bdaqctrl wrapper was built without change-of-state support')
+							r=port.setMask(arg)
+							if r==0:
+								r=dataInput.addChangeOfStateListener(listener)
+							if r==0:
+								r=dataInput.SnapStart()
+							if r!=0:
+								if listener:
+									dataInput.removeChangeOfStateListener(listener)
+								raise NotImplementedError('change-of-state interrupts failed to start (error code: '+hex(r)+')')
+							results.append((requestType,future,None))
+						except Exception as e:
+							listener=None
+							if not isinstance(e,NotImplementedError):
+								e=NotImplementedError('change-of-state interrupts failed to start ('+type(e).__name__+': '+str(e)+')')
+							results.append((requestType,future,e))
+
+					elif requestType=='close':
+						running=False
+				except Exception as e:
+					error=OSError(errno.EIO,'USB-4761 '+requestType+' request failed ('+type(e).__name__+': '+str(e)+').')
+					error.__cause__=e
+					if requestType=='read':
+						value=error
+					results.append((requestType,future,error))
+					if requestType=='open':
+						running=False
+
+				if not running:
+					break
+
+			# fail the requests that will not be served
+			# (the rest of the batch and the requests queued until the service refuses new ones)
+			if not running:
+				with self.lock:
+					self.stopped=True
+				rest=requests[index+1:]
+				try:
+					while True:
+						rest.append(self.requestQueue.get_nowait())
+				except queue.Empty:
+					pass
+				for requestType,arg,future,span in rest:
+					if future!=None:
+						results.append((requestType,future,self._notRunningError()))
+
+			# return results to the event loop
+			# (the loop might be already closed when the service is closed)
+			if results:
+				try:
+					self.loop.call_soon_threadsafe(self._setResults,results,transactions)
+				except RuntimeError:
+					pass
+
+		# dispose the device
+		if listener!=None:
+			dataInput.SnapStop()
+			dataInput.removeChangeOfStateListener(listener)
+		if dataInput!=None:
+			dataInput.Dispose()
+		if dataOutput!=None:
+			dataOutput.Dispose()
+
+
+# listener of change-of-state interrupts
+# (DiSnapEvent() is called by the driver in its own thread,
+# thus the input bits are only handed over to the event loop)
+class ChangeOfStateListener(bdaqctrl.DiSnapEventListener):
+
+	def __init__(self,service):
+		# (raises AttributeError if bdaqctrl wrapper was built without directors)
+		bdaqctrl.DiSnapEventListener.__init__(self)
+		self.service=service
+
+	def DiSnapEvent(self,sender,args):
+		inputBits=bdaqctrl.uint8.frompointer(args.PortData).value()
+		try:
+			self.service.loop.call_soon_threadsafe(self.service._changeOfState,inputBits)
+		except RuntimeError:
+			pass
+
+
+# power button pulse engine
+#
+# Pulses of power output bits are driven by loop.call_at() deadlines, thus any number
+# of overlapping pulses is handled without any task or sleep per pulse. Each bit is owned
+# by at most one pulse from its press until its release is written to the device.
+# All edges made in the same event loop iteration are merged into a single write
+# of the output port. The duration is held from the completion of the press write,
+# thus a press queued behind other USB transactions is not shortened. The achieved
+# duration of each pulse is measured between the completion of the writes of its press
+# and release.
+#
+# When a write fails (or the hardware service fails the request), the pulses of its edges
+# fail, but their bits stay owned: the output might still be driven, thus the release
+# is written again every releaseRetryInterval and the bits are freed only after
+# a successful write. Until then, presses of the bits are refused.
+class PulseEngine:
+
+	releaseRetryInterval=0.5
+
+	def __init__(self,hardware):
+		self.hardware=hardware
+		self.loop=hardware.loop
+		self.outputBits=0
+		self.ownedBits=0
+		self.edges=[]           # (pulse,press) edges waiting for the next write
+		self.writes=0           # number of writes performed
+		self.mergedEdges=0      # number of edges merged to the write of another edge
+
+	def press(self,mask,duration=None):
+		# (raises BlockingIOError if any of the bits is owned by another pulse;
+		# pulse without duration is held until release() is called)
+		if mask&self.ownedBits!=0:
+			raise BlockingIOError('Power output bits '+hex(mask&self.ownedBits)+' are owned by another pulse.')
+		pulse=Pulse(mask,duration,self.loop.create_future(),time.monotonic())
+		self.ownedBits|=mask
+		self.outputBits|=mask
+		self._addEdge(pulse,True)
+		return pulse
+
+	def release(self,pulse):
+		# (release of the pulse whose press was not written yet is postponed after the press write)
+		if pulse.released:
+			return
+		pulse.released=True
+		pulse.releaseRequestTime=time.monotonic()
+		if pulse.timer:
+			pulse.timer.cancel()
+			pulse.timer=None
+		if pulse.pressTime!=None:
+			self._release(pulse)
+
+	def _release(self,pulse):
+		self.outputBits&=~pulse.mask
+		self._addEdge(pulse,False)
+
+	def _addEdge(self,pulse,press):
+		if self.edges:
+			self.mergedEdges+=1
+		else:
+			self.loop.call_soon(self._flush)
+		self.edges.append((pulse,press))
+
+	def _flush(self):
+		edges=self.edges
+		self.edges=[]
+		self.writes+=1
+		future=self.hardware.write(self.outputBits)
+		future.add_done_callback(lambda future: self._written(future,edges))
+
+	def _written(self,future,edges):
+		try:
+			r,writeTime=future.result()
+			error=None if r==0 else OSError(r,'USB-4761 device error (error code: '+hex(r)+').')
+		except (Exception,asyncio.CancelledError) as e:
+			error=e if isinstance(e,OSError) else OSError(errno.EIO,'USB-4761 write failed ('+type(e).__name__+').')
+		for pulse,press in edges:
+
+			# write failed: fail the pulse and retry its release
+			# (the bits stay owned until the release is written)
+			if error!=None:
+				if pulse.timer:
+					pulse.timer.cancel()
+					pulse.timer=None
+				pulse.released=True
+				self.outputBits&=~pulse.mask
+				if not pulse.done.done():
+					pulse.done.set_exception(error)
+				self.loop.call_later(self.releaseRetryInterval,self._retryRelease,pulse)
+
+			# press written
+			# (the duration is held from the completion of the write)
+			elif press:
+				pulse.pressTime=writeTime
+				if pulse.released:
+					self._release(pulse)
+				elif pulse.duration!=None:
+					delay=pulse.duration-(time.monotonic()-writeTime)
+					pulse.timer=self.loop.call_at(self.loop.time()+delay,self.release,pulse)
+
+			# release written
+			else:
+				pulse.releaseTime=writeTime
+				self.ownedBits&=~pulse.mask
+				if not pulse.done.done():
+					pulse.done.set_result(pulse.releaseTime-pulse.pressTime)
+
+	def _retryRelease(self,pulse):
+		# (not retried once the hardware service is closed; the device is disposed then)
+		if not self.hardware.stopped:
+			self._addEdge(pulse,False)
+
+
+# pulse of power output bits
+# (done future gives the achieved duration of the pulse in seconds;
+# times are given by time.monotonic(), press and release times are the completions of their writes)
+class Pulse:
+
+	def __init__(self,mask,duration,done,pressRequestTime):
+		self.mask=mask
+		self.duration=duration
+		self.done=done
+		self.timer=None
+		self.released=False
+		self.pressRequestTime=pressRequestTime
+		self.releaseRequestTime=None
+		self.pressTime=None
+		self.releaseTime=None
+
+
+# power input sampler
+#
+# Input bits are read periodically at samplingRate. Each bit is debounced:
+# its debounced value changes only when debounceSamples consecutive samples
+# agree on the new value. All bits are debounced at once by bit operations
+# over the recent samples. Changes of debounced bits are passed
+# to inputChangedCallback(inputBits,changedBits) in the event loop.
+#
+# While change-of-state interrupts of the hardware are enabled, the periodic reading
+# is only a backstop at backstopRate. Each interrupt is taken by changeOfState() as a sample
+# and opens a window of debounceSamples periods sampled at samplingRate, thus the edge
+# is debounced in the same way as a polled one and it is dated by the interrupt.
+#
+# Debounced changes of the last historyLength seconds are kept together with their times.
+# Older changes are evicted by their time, thus the history covers historyLength
+# regardless of the sampling rate, such as raised by boost() or by change-of-state samples.
+class PowerSampler:
+
+	def __init__(self,hardware,samplingRate=20,debounceSamples=3,historyLength=600,backstopRate=2):
+		self.hardware=hardware
+		self.samplingRate=samplingRate
+		self.backstopRate=backstopRate
+		self.debounceSamples=debounceSamples
+		self.historyLength=historyLength
+		self.inputBits=0               # the latest debounced input bits
+		self.edgeTime=None             # time.monotonic() of the first sample of the latest debounced change
+		self.inputChangedCallback=None
+		self.recentSamples=collections.deque(maxlen=debounceSamples)
+		self.recentTimes=collections.deque(maxlen=debounceSamples)
+		self.boostRates=[]             # sampling rates requested by boost()
+		self.windowEnd=0               # loop time until samplingRate is used after change-of-state interrupt
+		self.readFailed=False
+		self.task=None
+		self.wakeup=None               # future of the sleep between the samples
+
+		# history of debounced changes
+		self.history=collections.deque()  # (edgeTime,inputBits,changedBits) items, the oldest first
+
+	def start(self,inputBits):
+		self.inputBits=inputBits
+		self.recentSamples.extend([inputBits]*self.debounceSamples)
+		self.recentTimes.extend([time.monotonic()]*self.debounceSamples)
+		self.task=self.hardware.loop.create_task(self._run())
+
+	async def stop(self):
+		if self.task:
+			self.task.cancel()
+			try:
+				await self.task
+			except asyncio.CancelledError:
+				pass
+			self.task=None
+
+	def boost(self,samplingRate):
+		# (samples with at least samplingRate until unboost() is called; used for precise edge timing)
+		self.boostRates.append(samplingRate)
+		self._wakeup()
+
+	def unboost(self,samplingRate):
+		self.boostRates.remove(samplingRate)
+
+	def changeOfState(self,rawBits):
+		# (called with input bits of each change-of-state interrupt)
+		self.addSample(rawBits)
+		self.windowEnd=self.hardware.loop.time()+self.debounceSamples/self.samplingRate
+		self._wakeup()
+
+	def currentRate(self):
+		if self.hardware.changeOfStateEnabled and self.hardware.loop.time()>=self.windowEnd:
+			rate=self.backstopRate
+		else:
+			rate=self.samplingRate
+		return max([rate]+self.boostRates)
+
+	def _wakeup(self):
+		if self.wakeup!=None and not self.wakeup.done():
+			self.wakeup.set_result(None)
+
+	def addSample(self,rawBits):
+
+		# debounce
+		# (bits that are one in all recent samples are set, bits that are zero in all of them are cleared)
+		sampleTime=time.monotonic()
+		self.recentSamples.append(rawBits)
+		self.recentTimes.append(sampleTime)
+		ones=0xff
+		zeros=0xff
+		for s in self.recentSamples:
+			ones&=s
+			zeros&=~s
+		inputBits=(self.inputBits|ones)&~zeros
+
+		# report changes and store them to history
+		# (the change is dated by the first of the agreeing recent samples)
+		changedBits=inputBits^self.inputBits
+		if changedBits!=0:
+			self.edgeTime=self.recentTimes[0]
+			self.inputBits=inputBits
+			self.history.append((self.edgeTime,inputBits,changedBits))
+			self._evictHistory(sampleTime)
+			if self.inputChangedCallback:
+				self.inputChangedCallback(inputBits,changedBits)
+
+	def edges(self,mask):
+		# (returns list of (time,inputBits) of changes of bits in mask kept in history, the oldest first;
+		# times are given by time.monotonic())
+		self._evictHistory(time.monotonic())
+		return [(t,bits) for t,bits,changedBits in self.history if changedBits&mask!=0]
+
+	def _evictHistory(self,now):
+		while self.history and self.history[0][0]<now-self.historyLength:
+			self.history.popleft()
+
+	async def _run(self):
+
+		# sample in regular intervals
+		# (missed samples are not caught up; the period follows the highest of requested rates;
+		# the sleep is cut short by boost() and by change-of-state interrupt, the next sample
+		# is then taken one period of the new rate after it)
+		loop=self.hardware.loop
+		nextTime=loop.time()
+		while True:
+			nextTime+=1/self.currentRate()
+			delay=nextTime-loop.time()
+			if delay>0:
+				self.wakeup=loop.create_future()
+				timer=loop.call_at(nextTime,self._wakeup)
+				try:
+					await self.wakeup
+				finally:
+					timer.cancel()
+					self.wakeup=None
+				if loop.time()<nextTime:
+					nextTime=loop.time()
+					continue
+			else:
+				nextTime=loop.time()
+			try:
+				self.addSample(await self.hardware.read())
+				if self.readFailed:
+					self.readFailed=False
+					logging.getLogger('main').info('Reading of power inputs recovered.')
+			except OSError as e:
+				if not self.readFailed:
+					self.readFailed=True
+					logging.getLogger('main').error('Failed to read power inputs ('+e.strerror+').')
@@ -0,0 +1,181 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+
+
+# persistent state journal
+#
+# Append-only file of JSON lines, each line holding the state of one computer.
+# The latest line of each computer wins on replay, thus a torn line at the end of the file
+# (power failure during the write) loses only the last change. Changed computers are only
+# marked by mark(); their states are taken and written together after batchDelay seconds
+# by a single write followed by a single fsync. Writes are performed in the executor,
+# thus the event loop is never blocked by the disk. When the number of lines written
+# since the last compaction exceeds compactionThreshold, the file is rewritten to hold
+# just one line per computer (written to a temporary file, fsynced, and renamed over
+# the journal). Closing waits for the write in the executor, thus the records it carries
+# are not lost and the journal is not reopened by its compaction.
+#
+# recordCallback(key) returns the record (dict) of the marked key
+# and snapshotCallback() returns the list of the records of all keys.
+class StateJournal:
+
+	def __init__(self,loop,path,recordCallback,snapshotCallback,batchDelay=0.05,compactionThreshold=1000):
+		self.loop=loop
+		self.path=path
+		self.recordCallback=recordCallback
+		self.snapshotCallback=snapshotCallback
+		self.batchDelay=batchDelay
+		self.compactionThreshold=compactionThreshold
+		self.file=None
+		self.dirty={}              # marked keys in the order of marking
+		self.flushHandle=None
+		self.flushFuture=None       # write of the batch in the executor
+		self.idle=threading.Event()  # set when no write is in the executor
+		self.idle.set()
+		self.closed=True            # (guarded by lock)
+		self.linesSinceCompaction=0
+		self.writeFailed=False
+		self.lock=threading.Lock()  # serializes file access of executor and close()
+		self.writes=0               # number of batched writes (each followed by fsync)
+		self.records=0              # number of records written
+
+	def replay(self):
+		# (returns dict of the latest record of each computer name stored in the journal;
+		# lines that can not be parsed are skipped)
+		records={}
+		try:
+			with open(self.path,'rb') as f:
+				for line in f:
+					try:
+						record=json.loads(line)
+						records[record['name']]=record
+					except (ValueError,KeyError,TypeError):
+						continue
+		except FileNotFoundError:
+			pass
+		return records
+
+	def open(self):
+		# (raises OSError if the journal can not be created;
+		# the file is compacted to the current states given by snapshotCallback() on open)
+		os.makedirs(os.path.dirname(self.path),exist_ok=True)
+		with self.lock:
+			self.closed=False
+			self._compact(self.snapshotCallback())
+		self.linesSinceCompaction=0
+
+	def close(self):
+		# (writes marked records synchronously; called in the event loop thread
+		# or when the event loop is not running; the write in the executor is joined first)
+		if self.flushHandle!=None:
+			self.flushHandle.cancel()
+			self.flushHandle=None
+		self.idle.wait()
+		self._close(self._takeRecords())
+
+	async def aclose(self):
+		# (as close(), but the write in the executor is awaited and the marked records
+		# are written in the executor, thus the event loop is not blocked by the disk)
+		while True:
+			if self.flushHandle!=None:
+				self.flushHandle.cancel()
+				self.flushHandle=None
+			if self.flushFuture==None:
+				break
+			await asyncio.wait([self.flushFuture])
+		await self.loop.run_in_executor(None,self._close,self._takeRecords())
+
+	def _close(self,data):
+		with self.lock:
+			self.closed=True
+			if data:
+				self._write(data)
+			if self.file!=None:
+				self.file.close()
+				self.file=None
+
+	def mark(self,key):
+		# (do not put any await or yield calls here, it is called from atomic blocks)
+		self.dirty[key]=None
+		if self.flushHandle==None and self.flushFuture==None:
+			self.flushHandle=self.loop.call_later(self.batchDelay,self._flush)
+
+	def _takeRecords(self):
+		if not self.dirty:
+			return b''
+		lines=[json.dumps(self.recordCallback(key),separators=(',',':')) for key in self.dirty]
+		self.dirty.clear()
+		self.records+=len(lines)
+		self.linesSinceCompaction+=len(lines)
+		return ('\n'.join(lines)+'\n').encode()
+
+	def _flush(self):
+		self.flushHandle=None
+		data=self._takeRecords()
+		compact=self.linesSinceCompaction>=self.compactionThreshold
+		if compact:
+			self.linesSinceCompaction=0
+			snapshot=self.snapshotCallback()
+		else:
+			snapshot=None
+		self.idle.clear()
+		self.flushFuture=self.loop.run_in_executor(None,self._writeAndCompact,data,snapshot)
+		self.flushFuture.add_done_callback(self._flushDone)
+
+	def _flushDone(self,future):
+		self.flushFuture=None
+		e=future.exception()
+		if e!=None:
+			if not self.writeFailed:
+				self.writeFailed=True
+				logging.getLogger('main').error('Failed to write state journal ('+str(e)+').')
+		elif self.writeFailed:
+			self.writeFailed=False
+			logging.getLogger('main').info('Writing of state journal recovered.')
+
+		# marks made during the write are flushed by the next batch
+		if self.dirty and self.flushHandle==None:
+			self.flushHandle=self.loop.call_later(self.batchDelay,self._flush)
+
+	def _writeAndCompact(self,data,snapshot):
+		# (runs in the executor)
+		try:
+			with self.lock:
+				if self.closed:
+					return
+				if data:
+					self._write(data)
+				if snapshot!=None:
+					self._compact(snapshot)
+		finally:
+			self.idle.set()
+
+	def _write(self,data):
+		if self.file==None:
+			return
+		self.file.write(data)
+		self.file.flush()
+		os.fsync(self.file.fileno())
+		self.writes+=1
+
+	def _compact(self,snapshot):
+
+		# rewrite the journal to hold one record per computer
+		tmpPath=self.path+'.tmp'
+		with open(tmpPath,'wb') as f:
+			for record in snapshot:
+				f.write((json.dumps(record,separators=(',',':'))+'\n').encode())
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(tmpPath,self.path)
+		dirFd=os.open(os.path.dirname(self.path),os.O_RDONLY)
+		try:
+			os.fsync(dirFd)
+		finally:
+			os.close(dirFd)
+		if self.file!=None:
+			self.file.close()
+		self.file=open(self.path,'ab')
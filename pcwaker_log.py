@@ -0,0 +1,183 @@
+import logging
+import logging.handlers
+import queue
+import threading
+
+
+# text of log record
+# (the message with the exception text, if any, is formatted only once by the first sink
+# that needs it; the record is then changed to carry the text, thus further formatting,
+# such as by the file handler in the writer thread, just prepends time to it)
+_textFormatter=logging.Formatter()
+
+def recordText(record):
+	text=getattr(record,'text',None)
+	if text==None:
+		text=_textFormatter.format(record)
+		record.text=text
+		record.msg=text
+		record.args=None
+		record.exc_info=None
+		record.exc_text=None
+		record.stack_info=None
+	return text
+
+
+# log handler that passes the records to the writer thread
+# (the record is not copied as all the sinks use its text only)
+class LogQueueHandler(logging.handlers.QueueHandler):
+
+	def __init__(self,writer):
+		logging.handlers.QueueHandler.__init__(self,writer.queue)
+		self.writer=writer
+
+	def prepare(self,record):
+		recordText(record)
+		return record
+
+	def enqueue(self,record):
+		self.writer.put(record)
+
+
+# background writer of log records
+#
+# Records are put to the queue by LogQueueHandler and written by the writer thread,
+# thus the event loop never waits on the log file, such as on slow SD card.
+# All the records queued at the moment are taken at once and written by a single write
+# and flush for each handler. Handlers must be StreamHandlers; RotatingFileHandler
+# is rolled over before the line that would exceed its maxBytes, as it does on its own.
+# flush() waits until the records queued so far are written (used before the log file
+# is read or when a new daemon process that rolls the file over is started).
+# When the writer is not running, such as after stop() on exit, records are written directly.
+class LogWriter:
+
+	maxBatchSize=256
+
+	def __init__(self,queue,*handlers):
+		self.queue=queue
+		self.handlers=list(handlers)
+		self.lock=threading.Lock()
+		self.thread=None
+
+	def start(self):
+		self.thread=threading.Thread(target=self._run,name='LogWriter',daemon=True)
+		self.thread.start()
+
+	def stop(self,timeout=None):
+		if self.thread!=None:
+			self.queue.put(None)
+			self.thread.join(timeout)
+			with self.lock:
+				self.thread=None
+
+			# write records queued after the writer stopped
+			# (events of flush() queued meanwhile are set after the records are written)
+			records=[]
+			events=[]
+			while True:
+				try:
+					item=self.queue.get_nowait()
+				except queue.Empty:
+					break
+				if isinstance(item,threading.Event):
+					events.append(item)
+				elif isinstance(item,logging.LogRecord):
+					records.append(item)
+			for record in records:
+				self._writeDirectly(record)
+			for event in events:
+				event.set()
+
+	def put(self,record):
+		if self.thread!=None:
+			self.queue.put(record)
+		else:
+			self._writeDirectly(record)
+
+	def _writeDirectly(self,record):
+		# (handlers might be closed by logging.shutdown() already; their emit() reopens the file)
+		with self.lock:
+			for handler in self.handlers:
+				if record.levelno>=handler.level:
+					handler.handle(record)
+
+	def flush(self,timeout=None):
+		# (the event is queued under the lock, thus it is set either by the writer thread
+		# or by stop() that takes the rest of the queue)
+		done=threading.Event()
+		with self.lock:
+			if self.thread==None or not self.thread.is_alive():
+				return
+			self.queue.put(done)
+		done.wait(timeout)
+
+	def addHandler(self,handler):
+		with self.lock:
+			self.handlers.append(handler)
+
+	def removeHandler(self,handler):
+		# (records queued before are still written to the handler)
+		self.flush()
+		with self.lock:
+			if handler in self.handlers:
+				self.handlers.remove(handler)
+
+	def _run(self):
+
+		stop=False
+		while not stop:
+
+			# take all queued records
+			# (events of flush() are set after the records queued before them are written)
+			records=[]
+			events=[]
+			item=self.queue.get()
+			while True:
+				if item==None:
+					stop=True
+				elif isinstance(item,threading.Event):
+					events.append(item)
+				else:
+					records.append(item)
+				if stop or len(records)>=self.maxBatchSize:
+					break
+				try:
+					item=self.queue.get_nowait()
+				except queue.Empty:
+					break
+
+			# write them
+			if records:
+				with self.lock:
+					for handler in self.handlers:
+						self._write(handler,records)
+			for event in events:
+				event.set()
+
+	def _write(self,handler,records):
+		handler.acquire()
+		try:
+			lines=[handler.format(r)+handler.terminator for r in records
+			       if r.levelno>=handler.level and handler.filter(r)]
+			if not lines:
+				return
+			stream=handler.stream
+			if isinstance(handler,logging.handlers.RotatingFileHandler) and handler.maxBytes>0:
+				size=stream.tell()
+				chunk=[]
+				for line in lines:
+					if size>0 and size+len(line)>=handler.maxBytes:
+						stream.write(''.join(chunk))
+						handler.doRollover()
+						stream=handler.stream
+						size=0
+						chunk=[]
+					chunk.append(line)
+					size+=len(line)
+				lines=chunk
+			stream.write(''.join(lines))
+			stream.flush()
+		except Exception:
+			handler.handleError(records[-1])
+		finally:
+			handler.release()
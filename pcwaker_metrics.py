@@ -0,0 +1,192 @@
+import asyncio
+import bisect
+import logging
+import time
+
+
+# metrics
+#
+# Counters, gauges and histograms are kept in memory and exported in Prometheus text format
+# by MetricsServer. Updating a metric is a dict lookup and an addition performed in the event loop,
+# thus nothing blocks the hot paths; the text is formatted only when the metrics are scraped.
+# Values are kept per tuple of label values given in the order of labelNames.
+class Counter:
+
+	type='counter'
+
+	def __init__(self,name,help,labelNames=()):
+		self.name=name
+		self.help=help
+		self.labelNames=tuple(labelNames)
+		self.values={}
+
+	def inc(self,labels=(),amount=1):
+		self.values[labels]=self.values.get(labels,0)+amount
+
+	def render(self,lines):
+		lines.append('# HELP '+self.name+' '+self.help)
+		lines.append('# TYPE '+self.name+' '+self.type)
+		for labels,value in self.values.items():
+			lines.append(self.name+_formatLabels(self.labelNames,labels)+' '+_formatValue(value))
+
+
+class Gauge(Counter):
+
+	type='gauge'
+
+	def set(self,value,labels=()):
+		self.values[labels]=value
+
+	def clear(self):
+		# (used by collectors that set all values on each scrape)
+		self.values.clear()
+
+
+class Histogram:
+
+	type='histogram'
+	defaultBuckets=(0.0005,0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0,30.0,60.0)
+
+	def __init__(self,name,help,labelNames=(),buckets=defaultBuckets):
+		self.name=name
+		self.help=help
+		self.labelNames=tuple(labelNames)
+		self.buckets=tuple(buckets)
+		self.values={}  # labels -> [bucket counts (not cumulative; the last one is +Inf),sum,count]
+
+	def observe(self,value,labels=()):
+		v=self.values.get(labels)
+		if v==None:
+			v=[[0]*(len(self.buckets)+1),0.0,0]
+			self.values[labels]=v
+		v[0][bisect.bisect_left(self.buckets,value)]+=1
+		v[1]+=value
+		v[2]+=1
+
+	def render(self,lines):
+		lines.append('# HELP '+self.name+' '+self.help)
+		lines.append('# TYPE '+self.name+' '+self.type)
+		for labels,(counts,total,count) in self.values.items():
+			cumulative=0
+			for bound,n in zip(self.buckets+(float('inf'),),counts):
+				cumulative+=n
+				le='+Inf' if bound==float('inf') else _formatValue(bound)
+				lines.append(self.name+'_bucket'+_formatLabels(self.labelNames+('le',),labels+(le,))+' '+str(cumulative))
+			lines.append(self.name+'_sum'+_formatLabels(self.labelNames,labels)+' '+_formatValue(total))
+			lines.append(self.name+'_count'+_formatLabels(self.labelNames,labels)+' '+str(count))
+
+
+def _formatLabels(names,values):
+	if not names:
+		return ''
+	return '{'+','.join(n+'="'+str(v).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')+'"'
+	                    for n,v in zip(names,values))+'}'
+
+
+def _formatValue(value):
+	if isinstance(value,bool):
+		return '1' if value else '0'
+	if isinstance(value,int):
+		return str(value)
+	return format(value,'.10g')
+
+
+# set of metrics
+# (collectors are called right before rendering; they update the metrics
+# that are computed from the state of the daemon, such as number of connections)
+class Metrics:
+
+	def __init__(self):
+		self.metrics=[]
+		self.collectors=[]
+
+	def add(self,metric):
+		self.metrics.append(metric)
+		return metric
+
+	def render(self):
+		for collector in self.collectors:
+			try:
+				collector()
+			except Exception:
+				logging.getLogger('main').exception('Exception raised in metrics collector.')
+		lines=[]
+		for metric in self.metrics:
+			metric.render(lines)
+		return '\n'.join(lines)+'\n'
+
+
+# event loop lag monitor
+# (a timer is scheduled every interval; how late it fires is the lag of the event loop,
+# such as caused by a blocking call or a long atomic block)
+class LoopLagMonitor:
+
+	def __init__(self,loop,histogram,gauge,interval=0.5):
+		self.loop=loop
+		self.histogram=histogram
+		self.gauge=gauge
+		self.interval=interval
+		self.handle=None
+		self.expected=None
+
+	def start(self):
+		self.expected=time.monotonic()+self.interval
+		self.handle=self.loop.call_later(self.interval,self._tick)
+
+	def stop(self):
+		if self.handle!=None:
+			self.handle.cancel()
+			self.handle=None
+
+	def _tick(self):
+		now=time.monotonic()
+		lag=max(now-self.expected,0.0)
+		self.histogram.observe(lag)
+		self.gauge.set(lag)
+		self.expected=now+self.interval
+		self.handle=self.loop.call_later(self.interval,self._tick)
+
+
+# HTTP server of the metrics
+# (serves GET /metrics in Prometheus text format; each connection gets one response and is closed)
+class MetricsServer:
+
+	maxRequestSize=8192
+	requestTimeout=5.0
+
+	def __init__(self,metrics):
+		self.metrics=metrics
+		self.server=None
+		self.scrapes=0
+
+	async def start(self,host,port):
+		# (raises OSError if the port can not be bound)
+		self.server=await asyncio.start_server(self._handle,host,port,limit=self.maxRequestSize)
+
+	def close(self):
+		if self.server!=None:
+			self.server.close()
+			self.server=None
+
+	async def _handle(self,reader,writer):
+		try:
+			try:
+				request=await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'),self.requestTimeout)
+			except (asyncio.IncompleteReadError,asyncio.LimitOverrunError,asyncio.TimeoutError):
+				return
+			parts=request.split(b'\r\n',1)[0].split(b' ')
+			if len(parts)<2 or parts[0] not in (b'GET',b'HEAD'):
+				status,body,contentType='405 Method Not Allowed',b'Method not allowed.\n','text/plain'
+			elif parts[1].split(b'?')[0]!=b'/metrics':
+				status,body,contentType='404 Not Found',b'Use /metrics.\n','text/plain'
+			else:
+				self.scrapes+=1
+				status,body,contentType='200 OK',self.metrics.render().encode(),'text/plain; version=0.0.4; charset=utf-8'
+			header=('HTTP/1.1 '+status+'\r\nContent-Type: '+contentType+'\r\nContent-Length: '+str(len(body))+
+			        '\r\nConnection: close\r\n\r\n').encode()
+			writer.write(header if parts[0]==b'HEAD' else header+body)
+			await writer.drain()
+		except OSError:
+			pass
+		finally:
+			writer.close()
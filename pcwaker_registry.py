@@ -0,0 +1,177 @@
+import collections
+
+
+# computer record
+# (compiled from a computer class of pcconfig; configuration is copied into the record
+# and the runtime state of the daemon is kept in slots next to it, thus the config
+# classes are never modified; operating systems are indexed by case-insensitive
+# aliases and partitions)
+class Computer:
+
+	configSlots=('name','names','powerBitMask','bootManagerOS','operatingSystems','pulseProfile','tags',
+	             'osByName','osByPartition')
+	__slots__=configSlots+('index','status','stream','requestedOS','currentOS',
+	                       'timeOfStatusChange','timeOfLastPowerEdge')
+
+	def __init__(self,config,defaultPulseProfile):
+
+		# configuration
+		self.name=config.name
+		self.names=list(config.names)
+		self.powerBitMask=config.powerBitMask
+		self.bootManagerOS=getattr(config,'bootManagerOS',None)
+		self.operatingSystems=list(getattr(config,'operatingSystems',[]))
+		self.pulseProfile=getattr(config,'pulseProfile',defaultPulseProfile)
+		self.tags=list(getattr(config,'tags',[]))
+
+		# operating system indexes
+		self.osByName={}
+		self.osByPartition={}
+		for os in self.operatingSystems:
+			for n in os.names:
+				key=n.casefold()
+				if self.osByName.get(key,os) is not os:
+					raise ValueError('Computer '+self.name+': operating system alias '+n+
+					                 ' is used by '+self.osByName[key].name+' and '+os.name+'.')
+				self.osByName[key]=os
+			if os.partition:
+				key=os.partition.casefold()
+				if key in self.osByPartition:
+					raise ValueError('Computer '+self.name+': partition '+os.partition+
+					                 ' is used by '+self.osByPartition[key].name+' and '+os.name+'.')
+				self.osByPartition[key]=os
+
+		# runtime state
+		# (owned by the daemon)
+		self.index=-1
+		self.status=None
+		self.stream=None
+		self.requestedOS=None
+		self.currentOS=None
+		self.timeOfStatusChange=None    # time.monotonic() of the latest status change
+		self.timeOfLastPowerEdge=None   # time.monotonic() of the latest debounced power edge
+
+	def configKey(self):
+		# (value comparing equal for equal configurations)
+		profile=self.pulseProfile
+		return (tuple(self.names),self.powerBitMask,self.bootManagerOS,
+		        tuple((os.name,tuple(os.names),os.partition,tuple(os.cmdBootToThisOne),tuple(os.cmdBootToBootManager))
+		              for os in self.operatingSystems),
+		        (profile.pressLength,profile.confirmationWindow,profile.killHoldLimit),tuple(self.tags))
+
+	def getOperatingSystemByName(self,osName):
+		if osName==None:
+			return None
+		return self.osByName.get(osName.casefold())
+
+	def getOperatingSystemByPartition(self,partition):
+		if partition==None or partition=='':
+			return None
+		return self.osByPartition.get(partition.casefold())
+
+
+# computer registry
+#
+# Built once from the computer classes of pcconfig. Computer names, aliases and tags
+# are resolved by case-insensitive dictionaries. Configuration errors, such as an alias
+# used by two computers or two computers sharing a bit of power inputs, raise ValueError.
+# Tag all is reserved and means all computers.
+class Registry:
+
+	def __init__(self,computerList,defaultPulseProfile):
+
+		self.computers=[]
+		self.byName={}
+		self.byTag=collections.defaultdict(list)
+		usedBits=0
+		for config in computerList:
+			pc=Computer(config,defaultPulseProfile)
+
+			# names
+			for n in pc.names:
+				key=n.casefold()
+				other=self.byName.get(key,pc)
+				if other is not pc:
+					raise ValueError('Name '+n+' is used by computers '+other.name+' and '+pc.name+'.')
+				if key=='all':
+					raise ValueError('Computer '+pc.name+': name all is reserved.')
+				self.byName[key]=pc
+
+			# power input bits
+			if usedBits&pc.powerBitMask!=0:
+				other=[x.name for x in self.computers if x.powerBitMask&pc.powerBitMask!=0]
+				raise ValueError('Computer '+pc.name+': power bit mask '+hex(pc.powerBitMask)+
+				                 ' collides with computer(s) '+', '.join(other)+'.')
+			usedBits|=pc.powerBitMask
+
+			# tags
+			for t in pc.tags:
+				self.byTag[t.casefold()].append(pc)
+			self.computers.append(pc)
+
+		# tags must not shadow computer names
+		for key,pcList in self.byTag.items():
+			if key in self.byName:
+				raise ValueError('Tag '+key+' of computer '+pcList[0].name+' collides with computer name.')
+			if key=='all':
+				raise ValueError('Computer '+pcList[0].name+': tag all is reserved.')
+		self.byTag['all']=list(self.computers)
+		self.byTag=dict(self.byTag)
+		self.powerBitMask=usedBits
+
+	def adopt(self,liveRegistry):
+
+		# take over records of the live registry
+		# (used on configuration reload; computers of the same name keep their records,
+		# thus their runtime state and all references to them stay valid, only their configuration
+		# is replaced; returns (added,removed,changed) lists of computer names)
+		added=[]
+		changed=[]
+		live={pc.name:pc for pc in liveRegistry.computers}
+		records={}
+		for i,pc in enumerate(self.computers):
+			old=live.pop(pc.name,None)
+			if old==None:
+				added.append(pc.name)
+				continue
+			if old.configKey()!=pc.configKey():
+				changed.append(pc.name)
+			for a in Computer.configSlots:
+				setattr(old,a,getattr(pc,a))
+			self.computers[i]=old
+			records[pc]=old
+		removed=list(live)
+
+		# re-point indexes to the adopted records
+		self.byName={key:records.get(pc,pc) for key,pc in self.byName.items()}
+		self.byTag={key:[records.get(pc,pc) for pc in pcList] for key,pcList in self.byTag.items()}
+		return added,removed,changed
+
+	def get(self,name):
+		# (returns None for unknown computer)
+		if name==None:
+			return None
+		return self.byName.get(name.casefold())
+
+	def isTag(self,name):
+		return name.casefold() in self.byTag
+
+	def resolve(self,names):
+		# (resolves computer names and tags to the list of computers;
+		# returns (computers,unknownNames); each computer is listed once, in the order of the names)
+		pcList=[]
+		seen=set()
+		unknownNames=[]
+		for name in names:
+			key=name.casefold()
+			pc=self.byName.get(key)
+			if pc!=None: found=[pc]
+			else: found=self.byTag.get(key)
+			if found==None:
+				unknownNames.append(name)
+				continue
+			for pc in found:
+				if not pc.name in seen:
+					seen.add(pc.name)
+					pcList.append(pc)
+		return pcList,unknownNames
@@ -0,0 +1,76 @@
+import time
+
+
+# Chrome trace export
+#
+# Spans are exported as complete events ("ph":"X") of the Chrome trace event format,
+# loadable by chrome://tracing or Perfetto UI. The daemon and each client computer get
+# their own process (pid). Spans of each trace are laid out to rows (tids) so that
+# the spans of a row nest properly; the rows are named by the root span of the trace.
+# Spans with thread given, such as USB transactions, go to the rows of that thread.
+# Unfinished spans are exported up to now and marked by unfinished argument.
+# Times are converted from time.monotonic() to wall clock microseconds.
+def chromeTrace(tracer,processName='pcwakerd'):
+
+	now=time.monotonic()
+	wallClockOffset=time.time()-now
+	spans=list(tracer.spans)+list(tracer.openSpans.values())
+	spans.sort(key=lambda s: (s.start,-((s.end if s.end!=None else now)-s.start)))
+
+	# group spans by process and trace (or thread)
+	processes={None:1}
+	groups={}
+	rootNames={}
+	for s in spans:
+		if s.process not in processes:
+			processes[s.process]=len(processes)+1
+		key=(s.process,s.thread if s.thread!=None else s.traceId)
+		groups.setdefault(key,[]).append(s)
+		if s.parentId==None and s.process==None:
+			rootNames.setdefault(s.traceId,s.name)
+
+	# metadata
+	events=[]
+	for process,pid in processes.items():
+		events.append({'name':'process_name','ph':'M','pid':pid,'args':{'name':process if process!=None else processName}})
+		events.append({'name':'process_sort_index','ph':'M','pid':pid,'args':{'sort_index':pid}})
+
+	# lay out each group to rows
+	# (a span goes to the first row where it nests into the innermost open span;
+	# groups keep the order of their first spans)
+	tid=0
+	for (process,thread),groupSpans in groups.items():
+		pid=processes[process]
+		if groupSpans[0].thread!=None:
+			name=groupSpans[0].thread
+		else:
+			name=rootNames.get(thread,groupSpans[0].name)
+		rows=[]
+		for s in groupSpans:
+			end=s.end if s.end!=None else now
+			for i,stack in enumerate(rows):
+				while stack and stack[-1]<=s.start:
+					stack.pop()
+				if not stack or end<=stack[-1]:
+					stack.append(end)
+					row=i
+					break
+			else:
+				rows.append([end])
+				row=len(rows)-1
+			args=dict(s.args)
+			args['traceId']=format(s.traceId,'016x')
+			args['spanId']=format(s.spanId,'016x')
+			if s.parentId!=None:
+				args['parentId']=format(s.parentId,'016x')
+			if s.end==None:
+				args['unfinished']=True
+			events.append({'name':s.name,'cat':s.category,'ph':'X','pid':pid,'tid':tid+1+row,
+			               'ts':round((s.start+wallClockOffset)*1e6,1),'dur':round((end-s.start)*1e6,1),'args':args})
+		for row in range(len(rows)):
+			events.append({'name':'thread_name','ph':'M','pid':pid,'tid':tid+1+row,
+			               'args':{'name':name if row==0 else name+' ('+str(row+1)+')'}})
+			events.append({'name':'thread_sort_index','ph':'M','pid':pid,'tid':tid+1+row,'args':{'sort_index':tid+1+row}})
+		tid+=len(rows)
+
+	return {'traceEvents':events,'displayTimeUnit':'ms'}
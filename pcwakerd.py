@@ -10,13 +10,16 @@
 #
 #    Controls pcwakerd daemon.
 #
-# pcwaker status [--machine-readable] [computer-names]
+# pcwaker status [--machine-readable|--json] [computer-names]
 #
 #    Prints the status of specified computer and OS booted as
 #    some computers have more OS installed. Status can be:
 #    OFF, ON, STARTING, STOPPING, FROZEN, START_AFTER_STOPPED, STOP_AFTER_STARTED.
 #    If no computer names are given, all configured computers
-#    are printed.
+#    are printed. All computers are sent in a single structured reply
+#    (state, OSes, time in state, last power edge, ping RTT and its percentiles,
+#    and clock offset of the computer estimated from the heartbeats)
+#    rendered by pcwaker.py.
 #
 # pcwaker list
 #
@@ -42,11 +45,48 @@
 #
 # pcwaker command [computer-name] [command-to-run] [command-parameters]
 #
-#    Executes the command on the computer.
+#    Executes the command on the computer. Output of the command is streamed back
+#    in MSG_STREAM chunks as it is produced.
+#
+# pcwaker daemon log
+#
+#    Prints log file of the daemon. The file is sent in MSG_STREAM chunks
+#    after the log records queued for the writer thread are written.
+#
+# pcwaker history [computer-name]
+#
+#    Prints power on and power off edges of the computer detected
+#    during the last minutes (see powerHistoryLength).
+#
+# pcwaker watch [computer-names-or-tags]
+#
+#    Prints the current state of the computers followed by their state transitions
+#    as they happen. It runs until interrupted. All computers are watched if no names
+#    are given.
+#
+# pcwaker wait [computer-name] [states] [--timeout seconds]
+#
+#    Waits until the computer gets to one of the states given as a comma separated
+#    list (for example ON or OFF,FROZEN). The reply is sent right on the transition
+#    and holds the time it took. Without --timeout, it waits forever.
+#
+# pcwaker connections
+#
+#    Prints all connections of the daemon together with depth of their outgoing
+#    message queues and counts of dropped and merged log messages.
+#
+# pcwaker trace dump [file-name]
+#
+#    Writes spans recorded by the daemon and by the client computers in Chrome
+#    trace event format (JSON loadable by chrome://tracing or Perfetto UI).
+#    Spans cover requests, power button pulses and their USB writes, sleeps and waits,
+#    network writes, commands executed by the clients and boots of the computers
+#    split to phases by "Got alive" messages.
 #
 
 #
-# Computer states and transitions:
+# Computer states and transitions
+# (see transitionTable for the executable form of this table):
 # OFF - no power, no connection
 #     - start - send 0.5s power signal and test for power sense,
 #               on success move to STARTING state, on failure keep OFF state
@@ -120,121 +160,217 @@
 
 import argparse
 import asyncio
+import atexit
+import collections
+import functools
+import importlib
+import json
 import logging
 import logging.handlers
 import os
 import pickle
+import queue
 import signal
 import socket
+import struct
+import subprocess
 import sys
 import time
 import traceback
 from pcwaker_common import *
 from pcconfig import *
+from pcwaker_registry import *
+from pcwaker_fleet import *
+from pcwaker_fleet import _status2string
+from pcwaker_journal import *
+from pcwaker_metrics import *
+from pcwaker_trace import *
+from pcwaker_log import *
 
 
 # global variables
 terminatingSignalHandled=False
 restartFlag=False
+upgradeFlag=False
 shutdownLog=None
-pingTask=None
+heartbeatWheel=TimerWheel()  # drives heartbeats of all connections of the computers
+metricsServer=None
+loopLagMonitor=None
+
+# metrics
+# (exported by metrics server on pcwakerMetricsPort, see pcwaker_metrics.py)
+metrics=Metrics()
+usbTransactionMetric=metrics.add(Histogram('pcwaker_usb_transaction_seconds','Duration of USB-4761 transactions.',('kind',)))
+requestMetric=metrics.add(Histogram('pcwaker_request_seconds','Processing time of requests of pcwaker utility.',('command',)))
+connectionsMetric=metrics.add(Gauge('pcwaker_connections','Open connections of the daemon.',('kind',)))
+bytesMetric=metrics.add(Counter('pcwaker_bytes_total','Bytes sent and received over the connections.',('direction',)))
+overflowMetric=metrics.add(Counter('pcwaker_queue_overflows_total','Connections aborted on full outgoing queue.'))
+stateMetric=metrics.add(Gauge('pcwaker_computer_state','Current state of the computers (1 for the current state).',('computer','state')))
+transitionMetric=metrics.add(Counter('pcwaker_state_transitions_total','State transitions of the computers.',('computer','from','to')))
+stateTimeMetric=metrics.add(Counter('pcwaker_state_seconds_total','Time spent by the computers in each state.',('computer','state')))
+roundTripTimeMetric=metrics.add(Gauge('pcwaker_heartbeat_rtt_seconds','Round trip time of heartbeats (percentiles of the last 100).',('computer','quantile')))
+clockOffsetMetric=metrics.add(Gauge('pcwaker_clock_offset_seconds','Clock offset of the computers estimated from heartbeats.',('computer',)))
+loopLagMetric=metrics.add(Histogram('pcwaker_event_loop_lag_seconds','Lag of the event loop.'))
+lastLoopLagMetric=metrics.add(Gauge('pcwaker_event_loop_lag_last_seconds','The latest measured lag of the event loop.'))
+closedConnectionBytes={'sent':0,'received':0}  # bytes of the connections that were already closed
+stateEnteredTimes={}                             # computer name -> time.monotonic() the state time was counted to
+requestCommands=('daemon','status','watch','wait','start','restart','stop','kill','command','history','connections','trace')
+
+# power sampling
+# (debounced power inputs are changed after powerDebounceSamples consecutive samples
+# agree on the new value; power history keeps the last powerHistoryLength seconds)
+powerSamplingRate=20        # Hz
+powerDebounceSamples=3
+powerHistoryLength=10*60    # seconds
+powerKillSamplingRate=200   # Hz, used while power button is held on kill to release it right on power off
+powerBackstopSamplingRate=2 # Hz, used while change-of-state interrupts are enabled
 
 
 # variables requiring atomic access
-# (this includes all access to USB-4761 device,
-# all access to mutable computer data in computerList
+# (this includes fleet model,
+# all access to mutable computer data in computer registry
 # and getComputerStatus() function;
 # be careful when using await or yield
-# to leave data for others in consistent state)
-powerInputBits=None
-powerOutputBits=0
+# to leave data for others in consistent state;
+# USB-4761 device itself is accessed only through hardware service
+# that processes all requests in its own thread in the order they were issued;
+# power inputs are read only by power sampler, others use its debounced snapshot;
+# power outputs are written only by pulse engine)
+registry=None
+hardware=None
+sampler=None
+pulseEngine=None
+powerOnScheduler=None
+fleet=None
+journal=None
 activeComputerList=[]
+connectionList=[]
+forwardedDataStreams={}
+nextStreamId=1
+powerWaiters=[]
+bootSpans={}                 # computer -> [boot span,span of the current boot phase or None]
+powerOnParents={}            # computer -> span that pressed its power button to start it
+startAfterStoppedParents={}  # computer -> span that queued it for startAfterStopped procedure
 startAfterStoppedQueue=asyncio.Queue()
+upgrading=False                        # daemon upgrade in progress, user requests are refused
+powerButtonsAvailable=asyncio.Event()  # cleared during the upgrade, no new presses are started
+powerButtonsAvailable.set()
+powerButtonOperations=0                # scheduled power-ons and startAfterStopped starts in progress
+
+def beginPowerButtonOperation():
+	global powerButtonOperations
+	powerButtonOperations+=1
+
+def endPowerButtonOperation(*args):
+	global powerButtonOperations
+	powerButtonOperations-=1
+
+# transition actions
+# (called after the state was changed; wlog is None for transitions not caused by the user;
+# do not put any await or yield calls here!)
+def resetRequestedOS(pc,wlog):
+	pc.requestedOS=noRequestedOS
 
-# constants
-class Status:
-
-	OFF=1
-	STARTING=2
-	ON=3
-	STOPPING=4
-	FROZEN=5
-	START_AFTER_STOPPED=6
-	STOP_AFTER_STARTED=7
-
-	def str(status):
-		return _status2string.get(status,"unknown")
-
-_status2string={
-	Status.OFF:      "OFF",
-	Status.STARTING: "STARTING",
-	Status.ON:       "ON",
-	Status.STOPPING: "STOPPING",
-	Status.FROZEN:   "FROZEN",
-	Status.START_AFTER_STOPPED: "START_AFTER_STOPPED",
-	Status.STOP_AFTER_STARTED:  "STOP_AFTER_STARTED",
-}
-
-class NoRequestedOS:
-	name="None"
-
-noRequestedOS=NoRequestedOS
-
-
-
-def getComputerStatus(pc,powerInputBits):
+def sendShutdown(pc,wlog):
+	stream_write_message(pc.stream,MSG_COMPUTER,['shutdown'],traceContext=traceContext())
 
-	# handle power up and power lost (except OFF and START_AFTER_STOPPED states)
-	if pc.status==Status.OFF:
-		# OFF: on power ->STARTING
-		if powerInputBits&pc.powerBitMask!=0:
-			pc.status=Status.STARTING
-	elif pc.status==Status.START_AFTER_STOPPED:
-		pass # do not do anything here as everything is done in startAfterStoppedHandler
+def sendRestart(pc,wlog):
+	if pc.requestedOS!=noRequestedOS:
+		wlog.info('Computer '+pc.name+' restart requested to '+pc.requestedOS.name+' operating system.')
 	else:
-		# all remaining states: on power lost ->OFF
-		# but ignore computers that have powerBitMask set to zero (no wires to the computer)
-		if powerInputBits&pc.powerBitMask==0 and pc.powerBitMask!=0:
-			pc.status=Status.OFF
-			pc.requestedOS=noRequestedOS
-
-	# status OFF
-	if pc.status==Status.OFF:
-		pass
-
-	# status STARTING
-	elif pc.status==Status.STARTING:
-		pass
-
-	# status ON
-	elif pc.status==Status.ON:
-		if pc.writer==None:
-			pc.status=Status.FROZEN
-
-	# status STOPPING
-	elif pc.status==Status.STOPPING:
-		pass
-
-	# status FROZEN
-	elif pc.status==Status.FROZEN:
-		pass
+		wlog.info('Computer '+pc.name+' restart requested without specifying any operating system to boot.')
+	if pc.currentOS.name!=pc.bootManagerOS:
+		commandList=pc.currentOS.cmdBootToBootManager
+		log.info(pc.name+': Running command \"'+' '.join(commandList)+'\" to reboot to bootManager OS.')
+		stream_write_message(pc.stream,MSG_COMPUTER,['command']+commandList,traceContext=traceContext())
+	stream_write_message(pc.stream,MSG_COMPUTER,['restart'],traceContext=traceContext())
+
+def queueStartAfterStopped(pc,wlog):
+	if currentSpan.get()!=None:
+		startAfterStoppedParents[pc]=currentSpan.get()
+	startAfterStoppedQueue.put_nowait(pc)
+
+
+# transition table
+# (executable form of the table of computer states and transitions at the top of this file;
+# (state,event) is mapped to (new state,action,message); new state None means no transition;
+# the message is logged to the user that caused the event;
+# events not listed for the state are ignored)
+frozenMessage=('Computer {} is not answering and seems to be frozen.\n'
+               '   You might try to power it down by kill command or wait some moments\n'
+               '   (it might be busy installing updates during shutdown, power up, etc).')
+transitionTable={
+
+	# OFF
+	(Status.OFF,Event.POWER_ON):     (Status.STARTING,None,None),
+	(Status.OFF,Event.CONNECTED):    (Status.ON,resetRequestedOS,None),
+	(Status.OFF,Event.START):        (None,None,'Starting computer {}...'),
+	(Status.OFF,Event.RESTART):      (None,None,'Starting computer {}...'),
+	(Status.OFF,Event.STOP):         (None,None,'Computer {} is already powered off.'),
+
+	# STARTING
+	(Status.STARTING,Event.POWER_LOST): (Status.OFF,resetRequestedOS,None),
+	(Status.STARTING,Event.CONNECTED):  (Status.ON,resetRequestedOS,None),
+	(Status.STARTING,Event.START):      (None,None,'Computer {} is already starting.'),
+	(Status.STARTING,Event.RESTART):    (None,None,'Computer {} is starting...'),
+	(Status.STARTING,Event.STOP):       (Status.STOP_AFTER_STARTED,resetRequestedOS,'Computer {} is starting. It will be stopped after booting up.'),
+
+	# ON
+	(Status.ON,Event.POWER_LOST):    (Status.OFF,resetRequestedOS,None),
+	(Status.ON,Event.CONNECTED):     (None,resetRequestedOS,None),
+	(Status.ON,Event.DISCONNECTED):  (Status.FROZEN,None,None),
+	(Status.ON,Event.PING_TIMEOUT):  (Status.FROZEN,None,None),
+	(Status.ON,Event.START):         (None,None,'Computer {} is already running.'),
+	(Status.ON,Event.RESTART):       (None,sendRestart,None),
+	(Status.ON,Event.STOP):          (Status.STOPPING,sendShutdown,'Stopping computer {}...'),
+
+	# STOPPING
+	(Status.STOPPING,Event.POWER_LOST): (Status.OFF,resetRequestedOS,None),
+	(Status.STOPPING,Event.CONNECTED):  (Status.ON,resetRequestedOS,None),
+	(Status.STOPPING,Event.START):      (Status.START_AFTER_STOPPED,queueStartAfterStopped,'Computer {} is shutting down. It will be started after shutdown.'),
+	(Status.STOPPING,Event.RESTART):    (Status.START_AFTER_STOPPED,queueStartAfterStopped,'Computer {} is shutting down. It will be started after shutdown.'),
+	(Status.STOPPING,Event.STOP):       (None,None,'Computer {} is already shutting down.'),
+
+	# FROZEN
+	(Status.FROZEN,Event.POWER_LOST): (Status.OFF,resetRequestedOS,None),
+	(Status.FROZEN,Event.CONNECTED):  (Status.ON,resetRequestedOS,None),
+	(Status.FROZEN,Event.START):      (None,None,frozenMessage),
+	(Status.FROZEN,Event.RESTART):    (None,None,frozenMessage),
+	(Status.FROZEN,Event.STOP):       (None,None,frozenMessage),
+
+	# START_AFTER_STOPPED
+	# (power changes are handled by startAfterStoppedHandler)
+	(Status.START_AFTER_STOPPED,Event.CONNECTED):    (Status.ON,resetRequestedOS,None),
+	(Status.START_AFTER_STOPPED,Event.START):        (None,None,'Computer {} is shutting down. It will be started after shutdown.'),
+	(Status.START_AFTER_STOPPED,Event.RESTART):      (None,None,'Computer {} is shutting down. It will be started after shutdown.'),
+	(Status.START_AFTER_STOPPED,Event.STOP):         (Status.STOPPING,None,'Computer {} is scheduled to start after shutdown. Cancelling start.'),
+	(Status.START_AFTER_STOPPED,Event.STARTED):      (Status.STARTING,None,None),
+	(Status.START_AFTER_STOPPED,Event.START_FAILED): (Status.OFF,None,None),
+
+	# STOP_AFTER_STARTED
+	# (shutdown is sent by the connection handler as the computer is not associated with the connection yet)
+	(Status.STOP_AFTER_STARTED,Event.POWER_LOST): (Status.OFF,resetRequestedOS,None),
+	(Status.STOP_AFTER_STARTED,Event.CONNECTED):  (Status.STOPPING,None,'Computer {} is in STOP_AFTER_STARTED state. Stopping it...'),
+	(Status.STOP_AFTER_STARTED,Event.START):      (Status.STARTING,None,'Computer {} is scheduled to shutdown. Canceling shutdown.'),
+	(Status.STOP_AFTER_STARTED,Event.RESTART):    (Status.STARTING,None,'Computer {} is scheduled to shutdown. Canceling shutdown.'),
+	(Status.STOP_AFTER_STARTED,Event.STOP):       (None,None,'Computer {} is already scheduled to shutdown.'),
+}
 
-	# status START_AFTER_STOPPED
-	elif pc.status==Status.START_AFTER_STOPPED:
-		pass
 
-	# status STOP_AFTER_STARTED
-	elif pc.status==Status.STOP_AFTER_STARTED:
-		pass
+def getComputerStatus(pc,powerInputBits):
 
+	# update states of all computers and return the state of pc
+	# (all computers are evaluated at once by the fleet model)
+	fleet.evaluate(powerInputBits)
 	return pc.status
 
 
-async def serverConnectionHandler(reader,writer):
+async def serverConnectionHandler(stream,handoff=None):
 
-	global powerOutputBits
 	wlog=None
 	associatedComputer=None
+	announcedComputer=None  # computer that sent "Got alive" over the connection
+	requestTasks=set()
 	try:
 
 		# initialize log
@@ -242,25 +378,47 @@ async def serverConnectionHandler(reader,writer):
 		# and sent over command connection back to the client
 		wlog=logging.Logger('ConnectionLogger',rootLog.level)
 		wlog.parent=rootLog
-		wlogHandler=ConnectionLogHandler(writer)
+		wlogHandler=ConnectionLogHandler(stream)
 		wlog.addHandler(wlogHandler)
 		wlog.debug('Connection handler started.')
+		connectionList.append(stream)
 
 		# set keep-alive on socket
-		s=writer.get_extra_info('socket')
+		s=stream.get_extra_info('socket')
 		if s is None:
-			wlog.error('Can not get socket out of writer. Socket TCP keep-alive parameters will not be set.')
+			wlog.error('Can not get socket out of stream. Socket TCP keep-alive parameters will not be set.')
 		else:
 			s.setsockopt(socket.SOL_SOCKET,socket.SO_KEEPALIVE,1)
 			s.setsockopt(socket.IPPROTO_TCP,socket.TCP_KEEPIDLE,6)   # six second before keepalive probes
 			s.setsockopt(socket.IPPROTO_TCP,socket.TCP_KEEPINTVL,1)  # keepalive probes are sent in 1 second interval
 			s.setsockopt(socket.IPPROTO_TCP,socket.TCP_KEEPCNT,4)    # four keepalive probes from 6th to 9th second
 
+		def heartbeatFailed(heartbeat,phi):
+
+			# close the connection and put computer to FROZEN state
+			# (called by the heartbeat when the failure detector suspects the connection;
+			# do not put any await and yield calls in this function!)
+			pc=associatedComputer
+			fleet.dispatch(pc,Event.PING_TIMEOUT)
+			stream.close()
+			log.error(pc.name+': connection lost (heartbeat timeout, phi {:.1f}).'.format(phi))
+
+		# continue connection handed over by the previous daemon process
+		# (the computer is already associated with the stream by restoreHandoff();
+		# heartbeat is started by restoring the stream)
+		if handoff!=None:
+			associatedComputer=registry.get(handoff['computer'])
+			announcedComputer=associatedComputer
+			activeComputerList.append(associatedComputer)
+			Heartbeat(heartbeatWheel,stream,heartbeatFailed)
+			stream.restore(handoff['messages'],handoff['data'])
+			wlog.debug(associatedComputer.name+': Connection taken over from the previous daemon process.')
+
 		# main loop of the connection
-		while not reader.at_eof():
+		while not stream.at_eof():
 
-			# receive the messageq
-			msgType,message=await stream_read_message(reader)
+			# receive the message
+			msgType,message,requestId=await stream_read_message(stream)
 
 			# handle closed connection
 			if msgType==MSG_EOF:
@@ -268,405 +426,62 @@ async def serverConnectionHandler(reader,writer):
 
 					# atomically change computer status
 					# (do not put any await and yield calls in this block!)
-					# (do not close writer, this will be made on the function exit)
+					# (do not close stream, this will be made on the function exit)
 					pc=associatedComputer
-					associatedComputer.writer=None
-					associatedComputer.reader=None
+					fleet.setStream(associatedComputer,None)
 					associatedComputer=None
 					activeComputerList.remove(pc)
-					r=dataInput.Read(0,powerInputBits)
-					if r!=0: raise OSError(r,'USB-4761 device error (error code: '+hex(r)+').')
-					getComputerStatus(pc,powerInputBits.value())
+					powerInputBits=sampler.inputBits
+					getComputerStatus(pc,powerInputBits)
+
+					# finish data streams of the computer
+					for forward in list(forwardedDataStreams.values()):
+						if forward.pc is pc:
+							forward.finish()
 
 					wlog.info('Computer '+pc.name+' disconnected.')
 				break
 
-			# pingHandler scheduled sending of ping
-			if msgType==MSG_PING_SCHEDULE:
-
-				# check if previous ping was correctly processed,
-				# if not, move to FROZEN state and check power (to move to OFF state)
-				if pc.timeOfLastPingAnswer!=pc.timeOfLastPingRequest:
-
-					# close the connection and put computer to FROZEN state
-					# (do not put any await and yield calls in this block!)
-					pc.status=Status.FROZEN
-					pc.writer.close()
-					pc.reader.feed_eof()
-					r=dataInput.Read(0,powerInputBits)
-					if r!=0: raise OSError(r,'USB-4761 device error (error code: '+hex(r)+').')
-					getComputerStatus(pc,powerInputBits.value())
-
-					# log connection lost
-					log.error(pc.name+': connection lost (ping timeout).')
-					break
-
-				# send ping request message
-				pc.timeOfLastPingRequest=message
-				stream_write_message(writer,MSG_PING_REQUEST,message)
-
-			# peer sent ping request
-			elif msgType==MSG_PING_REQUEST:
-				stream_write_message(writer,MSG_PING_ANSWER,message)
-				continue
-
-			# peer sent ping answer
-			elif msgType==MSG_PING_ANSWER:
-				associatedComputer.timeOfLastPingAnswer=message
+			# chunk of data stream sent by client computer
+			# (ping requests and answers are processed by the stream itself)
+			if msgType==MSG_STREAM:
+				forward=forwardedDataStreams.get(message[0])
+				if forward==None or forward.pc is not associatedComputer:
+					wlog.error('Chunk of unknown data stream '+str(message[0])+' received.')
+				else:
+					await forward.forward(message)
 				continue
 
 			# process messages from pcwaker.py
+			# (requests carrying request id are processed concurrently, each by its own task)
 			elif msgType==MSG_USER:
-
-				# decode data
-				params=message
-				wlog.debug('Message received from pcwaker: '+str(params))
-
-				# ignore empty messages
-				if len(params)==0:
-					continue
-
-				# daemon stop and restart
-				if params[0]=='daemon':
-
-					if len(params)==1:
-						wlog.error('Error: Not enough arguments for daemon parameter.')
-						continue
-
-					if params[1]=='stop' or params[1]=='restart':
-						global restartFlag
-						global shutdownLog
-						shutdownLog=wlog
-						if params[1]=='restart':
-							restartFlag=True
-							wlog.debug('Scheduled server restart.')
-						else:
-							wlog.debug('Scheduled server stop.')
-						loop.stop()
-						continue
-
-					wlog.error('Unknown parameter 1: '+params[1])
-					continue
-
-				# status of computer(s)
-				elif params[0]=='status':
-
-					# parse --machine-readable if present
-					p=params[1:]
-					machineReadable=len(p)>0 and p[0]=='--machine-readable'
-					if machineReadable:
-						p=p[1:]
-
-					# get computer list
-					if len(p)==0:
-						list=computerList
-					else:
-						list=[]
-						for name in p:
-							pc=getComputer(name)
-							if pc==None:
-								wlog.critical(name+' is not a configured computer.')
-							else:
-								list.append(pc)
-
-					# atomically read computer state and print result
-					# (do not put any await and yield calls in this block!)
-					r=dataInput.Read(0,powerInputBits)
-					if r!=0: raise OSError(r,'USB-4761 device error (error code: '+hex(r)+').')
-					if machineReadable:
-						for pc in list:
-							s=Status.str(getComputerStatus(pc,powerInputBits.value()))
-							stream_write_message(writer,MSG_USER,pickle.dumps(s,protocol=2))
-					else:
-						for pc in list:
-							status=getComputerStatus(pc,powerInputBits.value())
-							s=Status.str(status)
-							wlog.critical('Computer '+pc.name+':')
-							wlog.critical('   Status: '+s)
-							if status==Status.ON:
-								wlog.critical('   OS:     '+pc.currentOS.name)
-
-					continue
-
-				# start computer
-				elif params[0]=='start' or params[0]=='restart':
-					if len(params)==1:
-						wlog.error('Error: No computer specified.')
-					else:
-
-						# get computer
-						pc=getComputer(params[1])
-						if pc==None:
-							wlog.critical(params[1]+' is not a configured computer.')
-							continue
-
-						# requested OS
-						if len(params)>=3:
-							pc.requestedOS=getComputerOperatingSystemByName(pc,params[2])
-							if pc.requestedOS==None and params[2]!=None and params!='':
-								wlog.critical(params[2]+' is not valid operating system for computer '+pc.name)
-							if pc.requestedOS==None:
-								pc.requestedOS=noRequestedOS
-						else:
-							pc.requestedOS=noRequestedOS
-
-						# atomically process computer state update
-						# (do not put any await or yield calls the following blocks starting from
-						# read computer state, through processing all states and finishing by unknown state)
-
-						# read computer state
-						r=dataInput.Read(0,powerInputBits)
-						if r!=0: raise OSError(r,'USB-4761 device error (error code: '+hex(r)+').')
-						status=getComputerStatus(pc,powerInputBits.value())
-
-						# if OFF, activate power signal
-						# (the rest will be performed bellow after 0.5s)
-						if status==Status.OFF:
-							wlog.info('Starting computer '+pc.name+'...')
-							powerOutputBits|=pc.powerBitMask
-							dataOutput.Write(0,powerOutputBits)
-
-						# in STARTING, do noting,
-						# operating system to boot is changed if it was specified
-						elif status==Status.STARTING:
-							if params[0]=='start':
-								wlog.info('Computer '+pc.name+' is already starting.')
-							elif params[0]=='restart':
-								wlog.info('Computer '+pc.name+' is starting...')
-
-						# in ON, do nothing
-						elif status==Status.ON:
-							if params[0]=='start':
-								wlog.info('Computer '+pc.name+' is already running.')
-							elif params[0]=='restart':
-								if pc.requestedOS!=noRequestedOS:
-									wlog.info('Computer '+pc.name+' restart requested to '+pc.requestedOS.name+' operating system.')
-								else:
-									wlog.info('Computer '+pc.name+' restart requested without specifying any operating system to boot.')
-								if pc.currentOS.name!=pc.bootManagerOS:
-									commandList=pc.currentOS.cmdBootToBootManager
-									log.info(pc.name+': Running command \"'+' '.join(commandList)+'\" to reboot to bootManager OS.')
-									stream_write_message(pc.writer,MSG_COMPUTER,pickle.dumps(['command']+commandList,protocol=2))
-								stream_write_message(pc.writer,MSG_COMPUTER,pickle.dumps(['restart'],protocol=2))
-
-						# in STOPPING, move to START_AFTER_STOPPED
-						elif status==Status.STOPPING:
-							wlog.info('Computer '+pc.name+' is shutting down. It will be started after shutdown.')
-							pc.status=Status.START_AFTER_STOPPED
-							startAfterStoppedQueue.put_nowait(pc)
-
-						# in START_AFTER_STOPPED, do nothing
-						elif status==Status.START_AFTER_STOPPED:
-							wlog.info('Computer '+pc.name+' is shutting down. It will be started after shutdown.')
-
-						# in STOP_AFTER_STARTED, move to STARTING
-						elif status==Status.STOP_AFTER_STARTED:
-							wlog.info('Computer '+pc.name+' is scheduled to shutdown. Canceling shutdown.')
-							pc.status=Status.STARTING
-							# deactivate periodical state checker here
-
-						# in FROZEN, do nothing
-						elif status==Status.FROZEN:
-							wlog.info('Computer '+pc.name+' is not answering and seems to be frozen.\n'
-											'   You might try to power it down by kill command or wait some moments\n'
-											'   (it might be busy installing updates during shutdown, power up, etc).')
-
-						# unknown state
-						else:
-							wlog.critical('Computer '+pc.name+' is in unknown state.')
-
-						# if status was originally OFF, deactivate power signal after 0.5 second and re-read computer state
-						if status==Status.OFF:
-							await asyncio.sleep(0.5)
-
-							# atomically deactivate power signal and update computer state
-							# (do not put any await or yield calls in following two code blocks!)
-
-							# if OFF, deactivate power signal after 0.5 second
-							powerOutputBits&=~pc.powerBitMask
-							dataOutput.Write(0,powerOutputBits)
-
-							# update computer state
-							r=dataInput.Read(0,powerInputBits)
-							if r!=0: raise OSError(r,'USB-4761 device error (error code: '+hex(r)+').')
-							status=getComputerStatus(pc,powerInputBits.value())
-
-							# if still did not came up, give it three times another 0.5 second
-							for i in [1,2,3]:
-								if status==Status.OFF:
-									await asyncio.sleep(0.5)
-
-									# test again if it came up
-									r=dataInput.Read(0,powerInputBits)
-									if r!=0: raise OSError(r,'USB-4761 device error (error code: '+hex(r)+').')
-									status=getComputerStatus(pc,powerInputBits.value())
-
-							# log
-							if status==Status.OFF:
-								wlog.critical('Failed to start computer '+pc.name+'.')
-							elif status==Status.STARTING:
-								wlog.critical('Computer '+pc.name+' successfully started.')
-							else:
-								wlog.critical('Computer '+pc.name+' successfully started (state: '+Status.str(status)+').')
-
-					continue
-
-				# stop computer
-				elif params[0]=='stop':
-					if len(params)==1:
-						wlog.error('Error: No computer(s) specified.')
-					else:
-
-						# get computer
-						pc=getComputer(params[1])
-						if pc==None:
-							wlog.critical(params[1]+' is not a configured computer.')
-							continue
-
-						# atomically update computer state
-						# (do not put any wait and yield calls in following code blocks starting from
-						# read computer state, through all state processing, finishing by unknown state)
-
-						# read computer state
-						r=dataInput.Read(0,powerInputBits)
-						if r!=0: raise OSError(r,'USB-4761 device error (error code: '+hex(r)+').')
-						status=getComputerStatus(pc,powerInputBits.value())
-
-						# if OFF, do nothing
-						if status==Status.OFF:
-							wlog.info('Computer '+pc.name+' is already powered off.')
-
-						# in STARTING, move to STOP_AFTER_STARTED
-						elif status==Status.STARTING:
-							wlog.info('Computer '+pc.name+' is starting. It will be stopped after booting up.')
-							pc.status=Status.STOP_AFTER_STARTED
-							pc.requestedOS=noRequestedOS
-
-						# in ON, send shutdown message and move to STOPPING
-						elif status==Status.ON:
-							wlog.info('Stopping computer '+pc.name+'...')
-							stream_write_message(pc.writer,MSG_COMPUTER,pickle.dumps(['shutdown'],protocol=2))
-							pc.status=Status.STOPPING
-
-						# in STOPPING, do noting
-						elif status==Status.STOPPING:
-							wlog.info('Computer '+pc.name+' is already shutting down.')
-
-						# in START_AFTER_STOPPED, move to STOPPING
-						elif status==Status.START_AFTER_STOPPED:
-							wlog.info('Computer '+pc.name+' is scheduled to start after shutdown. Cancelling start.')
-							pc.status=Status.STOPPING
-
-						# in STOP_AFTER_STARTED, do noting
-						elif status==Status.STOP_AFTER_STARTED:
-							wlog.info('Computer '+pc.name+' is already scheduled to shutdown.')
-
-						# in FROZEN, do nothing
-						elif status==Status.FROZEN:
-							wlog.info('Computer '+pc.name+' is not answering and seems to be frozen.\n'
-											'   You might try to power it down by kill command or wait some moments\n'
-											'   (it might be busy installing updates during shutdown, power up, etc).')
-
-						# unknown state
-						else:
-							wlog.critical('Computer '+pc.name+' is in unknown state.')
-
-					continue
-
-				# kill computer - press power button for 4 seconds
-				elif params[0]=='kill':
-					if len(params)==1:
-						wlog.error('Error: No computer specified.')
-					else:
-
-						# get computer
-						pc=getComputer(params[1])
-						if pc==None:
-							wlog.critical(params[1]+' is not a configured computer.')
-							continue
-
-						# read computer state
-						r=dataInput.Read(0,powerInputBits)
-						if r!=0: raise OSError(r,'USB-4761 device error (error code: '+hex(r)+').')
-						status=getComputerStatus(pc,powerInputBits.value())
-
-						# if OFF, do nothing
-						if status==Status.OFF:
-							wlog.info('Computer '+pc.name+' is already switched off.')
-							continue
-
-						# activate power signal
-						wlog.info('Forcefully shutting down computer '+pc.name+'...')
-						powerOutputBits|=pc.powerBitMask
-						dataOutput.Write(0,powerOutputBits)
-
-						t=0
-						while t<5.9: # max 6 seconds before we fail
-							await asyncio.sleep(0.5)
-							t+=0.5
-
-							# update computer state
-							r=dataInput.Read(0,powerInputBits)
-							if r!=0: raise OSError(r,'USB-4761 device error (error code: '+hex(r)+').')
-							status=getComputerStatus(pc,powerInputBits.value())
-							if status==Status.OFF:
-								break
-
-						# deactivate power signal
-						powerOutputBits&=~pc.powerBitMask
-						dataOutput.Write(0,powerOutputBits)
-
-						# update computer state
-						r=dataInput.Read(0,powerInputBits)
-						if r!=0: raise OSError(r,'USB-4761 device error (error code: '+hex(r)+').')
-						status=getComputerStatus(pc,powerInputBits.value())
-
-						# if OFF
-						if status==Status.OFF:
-							wlog.critical('Computer '+pc.name+' successfully powered off (in {:.1f} seconds).'.format(t))
-						else:
-							wlog.critical('Failed to forcefully power off computer '+pc.name+'.\n'
-							              '   Computer left in the state: '+Status.str(status)+'.')
-
-					continue
-
-				# execute command on computer
-				elif params[0]=='command':
-					if len(params)==1:
-						wlog.error('Error: No computer specified.')
-					else:
-
-						# get computer
-						pc=getComputer(params[1])
-						if pc==None:
-							wlog.critical(params[1]+' is not a configured computer.')
-							continue
-
-						# read computer state
-						r=dataInput.Read(0,powerInputBits)
-						if r!=0: raise OSError(r,'USB-4761 device error (error code: '+hex(r)+').')
-						status=getComputerStatus(pc,powerInputBits.value())
-
-						# if not ON, print error
-						if status!=Status.ON:
-							wlog.info('Computer '+pc.name+' is not in ON state (current state: '+Status.str(status)+').')
-							continue
-
-						# send the command
-						stream_write_message(pc.writer,MSG_COMPUTER,pickle.dumps(['command']+params[2:],protocol=2))
-
-					continue
-
-				# unknown command
+				if requestId is None:
+					t=time.monotonic()
+					with tracer.span(' '.join(map(str,message))[:100],'request'):
+						result=await processUserMessage(stream,wlog,message)
+					metricsRequest(message,time.monotonic()-t)
+					if not result:
+						break
 				else:
-					wlog.error('Unknown command: '+params[0])
-				break
+					task=loop.create_task(userRequestHandler(stream,message,requestId))
+					requestTasks.add(task)
+					task.add_done_callback(requestTasks.discard)
+				continue
+
+			# spans finished by the client computer
+			elif msgType==MSG_TRACE:
+				if announcedComputer!=None:
+					try:
+						traceClientSpans(announcedComputer,stream,message)
+					except (ValueError,TypeError):
+						wlog.error('Invalid spans received from computer '+announcedComputer.name+'.')
+				continue
 
 			# process messages from client processes on monitored computers
 			elif msgType==MSG_COMPUTER:
 
-				# decode data
-				params=pickle.loads(message)
+				# message was already decoded by MessageStream
+				params=message
 				wlog.debug('Message received from computer: '+str(params))
 
 				# ignore empty messages
@@ -681,68 +496,87 @@ async def serverConnectionHandler(reader,writer):
 					else: platform=None
 					if len(params)>=4: partition=params[3]
 					else: partition=None
+					if len(params)>=5: peerCodecs=params[4]
+					else: peerCodecs=[]
+					if len(params)>=6: peerFeatures=params[5]
+					else: peerFeatures=[]
 					pc=getComputer(computerName)
 					if pc!=None:
 
-						log.info('Computer '+pc.name+' got alive (system: '+platform+', partition: '+partition+').')
-
-						if pc.status!=Status.STOP_AFTER_STARTED:
-
-							# get current operating system
-							pc.currentOS=getComputerOperatingSystemByPartition(pc,partition)
-							if pc.currentOS==None:
-								wlog.error(pc.name+': Unknown current operating system. Please, update pcconfig.py.')
-								pc.currentOS=noRequestedOS  # provide some safe value to continue
-
-							if pc.requestedOS!=noRequestedOS and pc.requestedOS.name!=pc.currentOS.name:
+						# negotiate codec
+						# (the answer is still sent by the current codec, pickle for the previous versions)
+						for codec in supportedCodecs:
+							if codec in peerCodecs:
+								stream_write_message(stream,MSG_CODEC,codec)
+								stream.codec=codec
+								wlog.debug(pc.name+': Using codec '+str(codec)+'.')
+								break
 
-								# reboot to requested OS
-								if pc.currentOS.name==pc.bootManagerOS:
-									log.info(pc.name+': Requested operating system is '+pc.requestedOS.name+'.')
-									commandList=pc.requestedOS.cmdBootToThisOne
-									log.info(pc.name+': Running command \"'+' '.join(commandList)+'\" to reboot to requested OS.')
-									stream_write_message(writer,MSG_COMPUTER,pickle.dumps(['command']+commandList,protocol=2))
-									if platform=='win32': commandList=['shutdown','/r','/t','1']
-									else: commandList=['/usr/bin/sudo','reboot']
-									stream_write_message(writer,MSG_COMPUTER,pickle.dumps(['command']+commandList,protocol=2))
+						# trace the processing
+						# (it ends the current boot phase of the computer and joins its boot,
+						# the computer gets trace context in the messages if it offered trace feature)
+						stream.peerTracing='trace' in peerFeatures
+						announcedComputer=pc
+						boot=bootPhase(pc,None)
+						with tracer.span('Got alive '+pc.name,'connection',boot,{'computer':pc.name,'partition':str(partition)}):
+
+							log.info('Computer '+pc.name+' got alive (system: '+platform+', partition: '+partition+').')
+
+							if pc.status!=Status.STOP_AFTER_STARTED:
+
+								# get current operating system
+								pc.currentOS=pc.getOperatingSystemByPartition(partition)
+								if pc.currentOS==None:
+									wlog.error(pc.name+': Unknown current operating system. Please, update pcconfig.py.')
+									pc.currentOS=noRequestedOS  # provide some safe value to continue
+								journalMark(pc)
+
+								if pc.requestedOS!=noRequestedOS and pc.requestedOS.name!=pc.currentOS.name:
+
+									# reboot to requested OS
+									if pc.currentOS.name==pc.bootManagerOS:
+										log.info(pc.name+': Requested operating system is '+pc.requestedOS.name+'.')
+										commandList=pc.requestedOS.cmdBootToThisOne
+										log.info(pc.name+': Running command \"'+' '.join(commandList)+'\" to reboot to requested OS.')
+										stream_write_message(stream,MSG_COMPUTER,['command']+commandList,traceContext=traceContext())
+										if platform=='win32': commandList=['shutdown','/r','/t','1']
+										else: commandList=['/usr/bin/sudo','reboot']
+										stream_write_message(stream,MSG_COMPUTER,['command']+commandList,traceContext=traceContext())
+										bootPhase(pc,'reboot to '+pc.requestedOS.name)
+
+									# reboot to bootManager OS
+									else:
+										log.info(pc.name+': Requested operating system is '+pc.requestedOS.name+'.')
+										commandList=pc.requestedOS.cmdBootToBootManager
+										log.info(pc.name+': Running command \"'+' '.join(commandList)+'\" to reboot to bootManager OS.')
+										stream_write_message(stream,MSG_COMPUTER,['command']+commandList,traceContext=traceContext())
+										if platform=='win32': commandList=['shutdown','/r','/t','1']
+										else: commandList=['/usr/bin/sudo','reboot']
+										stream_write_message(stream,MSG_COMPUTER,['command']+commandList,traceContext=traceContext())
+										bootPhase(pc,'reboot to boot manager')
 
-								# reboot to bootManager OS
 								else:
-									log.info(pc.name+': Requested operating system is '+pc.requestedOS.name+'.')
-									commandList=pc.requestedOS.cmdBootToBootManager
-									log.info(pc.name+': Running command \"'+' '.join(commandList)+'\" to reboot to bootManager OS.')
-									stream_write_message(writer,MSG_COMPUTER,pickle.dumps(['command']+commandList,protocol=2))
-									if platform=='win32': commandList=['shutdown','/r','/t','1']
-									else: commandList=['/usr/bin/sudo','reboot']
-									stream_write_message(writer,MSG_COMPUTER,pickle.dumps(['command']+commandList,protocol=2))
 
-							else:
-
-								# move to ON status
-								# (atomically process the following code block, not doing any await or yield calls!)
-								log.debug(pc.name+': Booted with the correct OS (current: '+pc.currentOS.name+', requested: '+pc.requestedOS.name+').')
-								pc.status=Status.ON
-								pc.requestedOS=noRequestedOS
-								pc.reader=reader
-								pc.writer=writer
-								associatedComputer=pc
-								activeComputerList.append(pc)
-								pc.timeOfLastPingRequest=time.monotonic()
-								pc.timeOfLastPingAnswer=pc.timeOfLastPingRequest
-								r=dataInput.Read(0,powerInputBits)
-								if r!=0: raise OSError(r,'USB-4761 device error (error code: '+hex(r)+').')
-								if powerInputBits.value()&pc.powerBitMask==0:
-									if pc.powerBitMask!=0:
-										wlog.error('Error: Computer '+pc.name+' established connection\n'
-										           '   while no power signal is detected. Check your wiring.')
-									else:
-										wlog.info('Computer '+pc.name+' is not connected by wires to detect its power on/off state.\n'
-										          '   The functionality of pcwaker might be limited on this computer.')
+									# move to ON status
+									# (atomically process the following code block, not doing any await or yield calls!)
+									log.debug(pc.name+': Booted with the correct OS (current: '+pc.currentOS.name+', requested: '+pc.requestedOS.name+').')
+									fleet.setStream(pc,stream)
+									fleet.dispatch(pc,Event.CONNECTED,wlog)
+									associatedComputer=pc
+									activeComputerList.append(pc)
+									Heartbeat(heartbeatWheel,stream,heartbeatFailed).start()
+									powerInputBits=sampler.inputBits
+									if powerInputBits&pc.powerBitMask==0:
+										if pc.powerBitMask!=0:
+											wlog.error('Error: Computer '+pc.name+' established connection\n'
+											           '   while no power signal is detected. Check your wiring.')
+										else:
+											wlog.info('Computer '+pc.name+' is not connected by wires to detect its power on/off state.\n'
+											          '   The functionality of pcwaker might be limited on this computer.')
 
-						else:
-							wlog.info('Computer '+pc.name+' is in STOP_AFTER_STARTED state. Stopping it...')
-							stream_write_message(writer,MSG_COMPUTER,pickle.dumps(['shutdown'],protocol=2))
-							pc.status=Status.STOPPING
+							else:
+								fleet.dispatch(pc,Event.CONNECTED,wlog)
+								stream_write_message(stream,MSG_COMPUTER,['shutdown'],traceContext=traceContext())
 
 					else:
 						log.critical('Computer '+params[1]+' attempts to announce it is alive,\n'
@@ -753,6 +587,10 @@ async def serverConnectionHandler(reader,writer):
 				else:
 					wlog.error('Unknown computer message data: '+str(data))
 
+		# wait for requests still being processed
+		if requestTasks:
+			await asyncio.wait(set(requestTasks))
+
 	except (ConnectionResetError,BrokenPipeError) as e:
 
 		# remove sending log over network (connection was reset)
@@ -783,22 +621,482 @@ async def serverConnectionHandler(reader,writer):
 
 		# remove connection from connection list
 		# (no await and yield calls in this code block!)
-		if reader in activeComputerList:
-			activeComputerList.remove(reader)
+		if stream in activeComputerList:
+			activeComputerList.remove(stream)
+		if stream in connectionList:
+			connectionList.remove(stream)
+		if stream.heartbeat!=None:
+			stream.heartbeat.stop()
+		closedConnectionBytes['sent']+=stream.bytesSent
+		closedConnectionBytes['received']+=stream.bytesReceived
 
 		# close connection
-		# (shutdownLog is not closed, neither its writer; they will be closed when main loop is left)
+		# (shutdownLog is not closed, neither its stream; they will be closed when main loop is left)
 		wlog.debug('Connection handler cleaning up...')
 		if wlog!=shutdownLog and wlog and wlogHandler!=None:
 			wlog.removeHandler(wlogHandler)
 		if wlog!=shutdownLog or wlog==None:
-			writer.close()
+			stream.close()
 		wlog.debug('Connection handler terminated.')
 
 
-async def startAfterStoppedHandler():
+async def processUserMessage(stream,wlog,params,requestId=None):
+
+	# process message from pcwaker.py
+	# (returns False if the connection should be closed)
+	wlog.debug('Message received from pcwaker: '+str(params))
+
+	# ignore empty messages
+	if len(params)==0:
+		return True
+
+	# refuse requests while the daemon hands over to the new process
+	if upgrading:
+		wlog.critical('Error: Daemon upgrade in progress. Try it again later.')
+		return True
+
+	# daemon stop and restart
+	if params[0]=='daemon':
+
+		if len(params)==1:
+			wlog.error('Error: Not enough arguments for daemon parameter.')
+			return True
+
+		# send log file as a data stream
+		if params[1]=='log':
+			await loop.run_in_executor(None,logWriter.flush)
+			sender=DataStreamSender(stream,allocateStreamId(),requestId)
+			with open(logFilePath,'rb') as f:
+				while True:
+					data=await loop.run_in_executor(None,f.read,dataStreamChunkSize)
+					if not data:
+						break
+					await sender.send(data)
+			await sender.close()
+			return True
+
+		# reload pcconfig.py
+		if params[1]=='reload':
+			await reloadConfiguration(wlog)
+			return True
+
+		# hand over to new daemon process
+		# (on success, the connection of the requester is closed by terminating this process)
+		if params[1]=='upgrade':
+			global shutdownLog
+			if await upgradeDaemon(wlog):
+				shutdownLog=wlog
+				loop.stop()
+			return True
+
+		if params[1]=='stop' or params[1]=='restart':
+			global restartFlag
+			shutdownLog=wlog
+			if params[1]=='restart':
+				restartFlag=True
+				wlog.debug('Scheduled server restart.')
+			else:
+				wlog.debug('Scheduled server stop.')
+			loop.stop()
+			return True
+
+		wlog.error('Unknown parameter 1: '+params[1])
+		return True
+
+	# status of computer(s)
+	elif params[0]=='status':
+
+		# skip output options
+		# (output is rendered by pcwaker.py from the structured reply)
+		p=params[1:]
+		while len(p)>0 and p[0] in ('--machine-readable','--json'):
+			p=p[1:]
+
+		# get computer list
+		if len(p)==0:
+			list=registry.computers
+		else:
+			list=[]
+			for name in p:
+				pc=getComputer(name)
+				if pc==None:
+					wlog.critical(name+' is not a configured computer.')
+				else:
+					list.append(pc)
+
+		# atomically read computer states and send them in a single reply
+		# (do not put any await and yield calls in this block,
+		# except sending the reply after all states were read)
+		fleet.evaluate(sampler.inputBits)
+		t=time.monotonic()
+		wallClockOffset=time.time()-t
+		results=[]
+		for pc in list:
+			if pc.powerBitMask==0: powered=None
+			else: powered=sampler.inputBits&pc.powerBitMask!=0
+			if pc.timeOfLastPowerEdge==None: lastPowerEdge=None
+			else: lastPowerEdge=pc.timeOfLastPowerEdge+wallClockOffset
+			record={
+				'name':pc.name,
+				'status':Status.str(pc.status),
+				'currentOS':pc.currentOS.name if pc.status==Status.ON and pc.currentOS not in (None,noRequestedOS) else None,
+				'requestedOS':pc.requestedOS.name if pc.requestedOS not in (None,noRequestedOS) else None,
+				'timeInState':t-pc.timeOfStatusChange,
+				'powered':powered,
+				'lastPowerEdge':lastPowerEdge,
+				'pingRoundTripTime':None,
+				'roundTripTimeP50':None,
+				'roundTripTimeP90':None,
+				'roundTripTimeP99':None,
+				'clockOffset':None}
+			if pc.stream!=None and pc.stream.heartbeat!=None:
+				record['pingRoundTripTime']=pc.stream.heartbeat.roundTripTime
+				record.update(pc.stream.heartbeat.statistics())
+			results.append(record)
+		await stream.send(MSG_USER,{'computers':results},requestId)
+
+		return True
+
+	# watch state transitions of computer(s)
+	# (the current state of each computer is sent first, followed by all its transitions
+	# published by the fleet; the request lasts until the connection is closed)
+	elif params[0]=='watch':
+
+		# get computer names
+		# (no names mean all computers, including the ones added by configuration reload)
+		if len(params)==1:
+			names=None
+		else:
+			pcList,unknownNames=registry.resolve(params[1:])
+			for name in unknownNames:
+				wlog.critical(name+' is not a configured computer.')
+			if len(pcList)==0:
+				return True
+			names=set(pc.name for pc in pcList)
+
+		def publish(transition):
+			# (do not put any await or yield calls here, it is called from atomic blocks)
+			pc=transition.pc
+			if names==None or pc.name in names:
+				stream.send_nowait(MSG_USER,transitionReply(transition),requestId)
+
+		# atomically send current states and subscribe to transitions
+		# (do not put any await and yield calls in this block!)
+		fleet.evaluate(sampler.inputBits)
+		t=time.time()
+		for pc in registry.computers:
+			if names==None or pc.name in names:
+				stream.send_nowait(MSG_USER,currentStatusReply(pc,t),requestId)
+		fleet.subscribe(publish)
+
+		# wait for the connection to be closed
+		try:
+			await stream.wait_eof()
+		finally:
+			fleet.unsubscribe(publish)
+
+		return True
 
-	global powerOutputBits
+	# wait until computer gets to one of the states
+	# (the reply is sent right on the transition, together with the time it took)
+	elif params[0]=='wait':
+
+		# parse parameters
+		# (errors are replied as structured messages, thus pcwaker exits with non-zero code)
+		try:
+			name,statuses,timeout=parseWaitParameters(params[1:])
+			pc=getComputer(name)
+			if pc==None:
+				raise ValueError(name+' is not a configured computer.')
+		except ValueError as e:
+			log.info(str(e))
+			await stream.send(MSG_USER,{'error':str(e)},requestId)
+			return True
+
+		# wait for the states
+		# (waiting is given up if the connection is closed)
+		fleet.evaluate(sampler.inputBits)
+		t1=time.monotonic()
+		future=statusWaiters.wait(pc,statuses,timeout)
+		eof=loop.create_task(stream.wait_eof())
+		try:
+			await asyncio.wait([future,eof],return_when=asyncio.FIRST_COMPLETED)
+		finally:
+			eof.cancel()
+			future.cancel()
+		if not future.done() or future.cancelled():
+			return True
+		await stream.send(MSG_USER,waitReply(pc,future.result(),t1),requestId)
+
+		return True
+
+	# start computer
+	# group start, stop and kill
+	# (used when more computers or a tag are given; computers are started by power-on scheduler
+	# that staggers the presses, and a per-computer summary finishes the response)
+	elif params[0] in ['start','stop','kill'] and isGroupRequest(params[1:]):
+		pcList,unknownNames=registry.resolve(params[1:])
+		for name in unknownNames:
+			wlog.critical(name+' is not a configured computer or tag.')
+
+		# start
+		if params[0]=='start':
+			results=await asyncio.gather(*[powerOnScheduler.schedule(pc,Event.START,wlog) for pc in pcList],
+			                             return_exceptions=True)
+			outcomes=[]
+			for pc,result in zip(pcList,results):
+				if isinstance(result,BlockingIOError):
+					outcomes.append('power button already being pressed')
+				elif isinstance(result,Exception):
+					outcomes.append('error ('+type(result).__name__+')')
+				elif result[1]==None:
+					outcomes.append('not pressed (state: '+Status.str(result[0])+')')
+				elif result[0]==Status.OFF:
+					outcomes.append('failed to start')
+				else:
+					outcomes.append('started (state: '+Status.str(result[0])+')')
+
+		# stop
+		# (do not put any await or yield calls here)
+		elif params[0]=='stop':
+			outcomes=[]
+			fleet.evaluate(sampler.inputBits)
+			for pc in pcList:
+				if fleet.dispatch(pc,Event.STOP,wlog):
+					outcomes.append('state: '+Status.str(pc.status))
+				else:
+					outcomes.append('unknown state')
+
+		# kill
+		# (power buttons are held concurrently; presses issued in the same moment share one output write)
+		else:
+			outcomes=await asyncio.gather(*[killComputer(pc,wlog) for pc in pcList])
+
+		# summary
+		width=max([len(pc.name) for pc in pcList]+[0])
+		text='Summary of '+params[0]+' of '+str(len(pcList))+' computer(s):'
+		for pc,outcome in zip(pcList,outcomes):
+			text+='\n   '+pc.name.ljust(width)+'  '+outcome
+		wlog.critical(text)
+
+		return True
+
+	elif params[0]=='start' or params[0]=='restart':
+		if len(params)==1:
+			wlog.error('Error: No computer specified.')
+		else:
+
+			# get computer
+			pc=getComputer(params[1])
+			if pc==None:
+				wlog.critical(params[1]+' is not a configured computer.')
+				return True
+
+			# requested OS
+			if len(params)>=3:
+				pc.requestedOS=pc.getOperatingSystemByName(params[2])
+				if pc.requestedOS==None and params[2]!=None and params!='':
+					wlog.critical(params[2]+' is not valid operating system for computer '+pc.name)
+				if pc.requestedOS==None:
+					pc.requestedOS=noRequestedOS
+			else:
+				pc.requestedOS=noRequestedOS
+			journalMark(pc)
+
+			# process the event by power-on scheduler
+			# (it presses power button if the computer is OFF and waits for power on)
+			if params[0]=='start': event=Event.START
+			else: event=Event.RESTART
+			try:
+				status,duration=await powerOnScheduler.schedule(pc,event,wlog)
+			except BlockingIOError:
+				wlog.critical('Power button of computer '+pc.name+' is already being pressed.')
+				return True
+
+			# if power button was pressed, log the result
+			if duration!=None:
+				wlog.info('Power button of computer '+pc.name+' pressed for {:.3f} seconds.'.format(duration))
+				if status==Status.OFF:
+					wlog.critical('Failed to start computer '+pc.name+'.')
+				elif status==Status.STARTING:
+					wlog.critical('Computer '+pc.name+' successfully started.')
+				else:
+					wlog.critical('Computer '+pc.name+' successfully started (state: '+Status.str(status)+').')
+
+		return True
+
+	# stop computer
+	elif params[0]=='stop':
+		if len(params)==1:
+			wlog.error('Error: No computer(s) specified.')
+		else:
+
+			# get computer
+			pc=getComputer(params[1])
+			if pc==None:
+				wlog.critical(params[1]+' is not a configured computer.')
+				return True
+
+			# atomically update computer state
+			# (do not put any wait and yield calls in following code blocks starting from
+			# read computer state, finishing by processing the event)
+
+			# read computer state
+			powerInputBits=sampler.inputBits
+			status=getComputerStatus(pc,powerInputBits)
+
+			# process the event by transition table
+			if not fleet.dispatch(pc,Event.STOP,wlog):
+				wlog.critical('Computer '+pc.name+' is in unknown state.')
+
+		return True
+
+	# kill computer - hold power button until power goes off
+	elif params[0]=='kill':
+		if len(params)==1:
+			wlog.error('Error: No computer specified.')
+		else:
+
+			# get computer
+			pc=getComputer(params[1])
+			if pc==None:
+				wlog.critical(params[1]+' is not a configured computer.')
+				return True
+
+			# hold power button until power goes off
+			await killComputer(pc,wlog)
+
+		return True
+
+	# execute command on computer
+	elif params[0]=='command':
+		if len(params)==1:
+			wlog.error('Error: No computer specified.')
+		else:
+
+			# get computer
+			pc=getComputer(params[1])
+			if pc==None:
+				wlog.critical(params[1]+' is not a configured computer.')
+				return True
+
+			# read computer state
+			powerInputBits=sampler.inputBits
+			status=getComputerStatus(pc,powerInputBits)
+
+			# if not ON, print error
+			if status!=Status.ON:
+				wlog.info('Computer '+pc.name+' is not in ON state (current state: '+Status.str(status)+').')
+				return True
+
+			# send the command
+			# (clients using binary codec stream the command output back
+			# under the stream id given in request id; it is forwarded to pcwaker.py as it arrives)
+			if pc.stream.codec==CODEC_PICKLE:
+				await pc.stream.send(MSG_COMPUTER,['command']+params[2:])
+			else:
+				forward=ForwardedDataStream(pc,stream,requestId)
+				with tracer.span('command round trip','client',args={'computer':pc.name}):
+					await pc.stream.send(MSG_COMPUTER,['command']+params[2:],forward.streamId,traceContext())
+					await forward.done
+				if not forward.receiver.ended:
+					wlog.error('Computer '+pc.name+' disconnected before the command finished.')
+
+		return True
+
+	# print power edges of computer kept in power history
+	elif params[0]=='history':
+		if len(params)==1:
+			wlog.error('Error: No computer specified.')
+		else:
+
+			# get computer
+			pc=getComputer(params[1])
+			if pc==None:
+				wlog.critical(params[1]+' is not a configured computer.')
+				return True
+			if pc.powerBitMask==0:
+				wlog.critical('Computer '+pc.name+' is not connected by wires to detect its power on/off state.')
+				return True
+
+			# print edges
+			edges=sampler.edges(pc.powerBitMask)
+			wlog.critical('Power history of computer '+pc.name+' (last {:g} minutes):'.format(sampler.historyLength/60))
+			for t,powerInputBits in edges:
+				s=formatMonotonicTime(t)
+				if powerInputBits&pc.powerBitMask!=0: s+='  Power on'
+				else: s+='  Power off'
+				wlog.critical('   '+s)
+			if len(edges)==0:
+				wlog.critical('   No power edges.')
+			if sampler.inputBits&pc.powerBitMask!=0: s='on'
+			else: s='off'
+			wlog.critical('   Power is currently '+s+' (status: '+Status.str(pc.status)+').')
+
+		return True
+
+	# print connections and their outgoing queues
+	elif params[0]=='connections':
+		for c in connectionList:
+			peer=c.get_extra_info('peername')
+			if peer: t=str(peer[0])+':'+str(peer[1])
+			else: t='unknown peer'
+			for pc in activeComputerList:
+				if pc.stream is c:
+					t+=' ('+pc.name+')'
+			if c is stream:
+				t+=' (this connection)'
+			wlog.critical('Connection '+t+':')
+			wlog.critical('   Queue depth:   '+str(c.queueDepth)+' (high-water mark: '+str(c.maxQueuedMessages)+')')
+			wlog.critical('   Log messages:  '+str(c.droppedMessages)+' dropped, '+str(c.mergedMessages)+' merged')
+			wlog.critical('   Bytes:         '+str(c.bytesSent)+' sent, '+str(c.bytesReceived)+' received')
+		wlog.critical('Connections aborted on full queue: '+str(MessageStream.overflowedConnections)+
+		              ' (hard limit: '+str(MessageStream.maxOutgoingMessages)+')')
+		return True
+
+	# write recorded spans in Chrome trace event format
+	# (sent as a data stream; pcwaker.py writes it to the file given or to stdout)
+	elif params[0]=='trace':
+		if len(params)<2 or params[1]!='dump':
+			wlog.error('Error: Unknown or missing trace parameter (use trace dump).')
+			return True
+		trace=chromeTrace(tracer)
+		data=await loop.run_in_executor(None,functools.partial(json.dumps,trace,separators=(',',':')))
+		sender=DataStreamSender(stream,allocateStreamId(),requestId)
+		await sender.close(data.encode())
+		return True
+
+	# unknown command
+	else:
+		wlog.error('Unknown command: '+params[0])
+	return False
+
+
+async def userRequestHandler(stream,params,requestId):
+
+	# initialize log of the request
+	# (log messages are sent back with the request id of the request)
+	wlog=logging.Logger('RequestLogger',rootLog.level)
+	wlog.parent=rootLog
+	wlog.addHandler(ConnectionLogHandler(stream,requestId))
+	t=time.monotonic()
+	with tracer.span(' '.join(map(str,params))[:100],'request',args={'requestId':requestId}):
+		try:
+			await processUserMessage(stream,wlog,params,requestId)
+		except (ConnectionResetError,BrokenPipeError):
+			pass
+		except Exception as e:
+			wlog.critical('\nException raised: '+type(e).__name__+'\n'+
+			              traceback.format_exc())
+		finally:
+			metricsRequest(params,time.monotonic()-t)
+			# terminate the response
+			# (the response to daemon stop and restart is terminated by closing the connection)
+			if wlog!=shutdownLog:
+				stream_write_message(stream,MSG_DONE,'',requestId,traceContext())
+
+
+async def startAfterStoppedHandler():
 
 	while True:
 
@@ -820,19 +1118,19 @@ async def startAfterStoppedHandler():
 				log.info('Queueing computer '+pc.name+' for startAfterStopped procedure.')
 
 			# update status of all computers in q
-			r=dataInput.Read(0,powerInputBits)
-			if r!=0: raise OSError(r,'USB-4761 device error (error code: '+hex(r)+').')
+			powerInputBits=sampler.inputBits
 			for pc in q1:
 
 				# remove computers that changed status from START_AFTER_STOPPED
-				status=getComputerStatus(pc,powerInputBits.value())
+				status=getComputerStatus(pc,powerInputBits)
 				if status!=Status.START_AFTER_STOPPED:
 					q1.remove(pc)
+					startAfterStoppedParents.pop(pc,None)
 					log.info('Unqueueing computer '+pc.name+' from startAfterStopped procedure.')
 				else:
 
 					# detect power off
-					if powerInputBits.value()&pc.powerBitMask==0:
+					if powerInputBits&pc.powerBitMask==0:
 						q1.remove(pc)
 						if not pc in q2:
 							q2.append(pc)
@@ -846,50 +1144,52 @@ async def startAfterStoppedHandler():
 				if d<0:
 
 					# remove computer from queue
+					# (no new press is started during the daemon upgrade)
 					pc=q2.pop(i)
 					del q3[i]
+					while not powerButtonsAvailable.is_set():
+						await powerButtonsAvailable.wait()
 
 					if pc.status==Status.START_AFTER_STOPPED:
 
 						# test if computer is still unpowered
-						r=dataInput.Read(0,powerInputBits)
-						if r!=0: raise OSError(r,'USB-4761 device error (error code: '+hex(r)+').')
-						if powerInputBits.value()&pc.powerBitMask!=0:
+						powerInputBits=sampler.inputBits
+						parent=startAfterStoppedParents.pop(pc,None)
+						if powerInputBits&pc.powerBitMask!=0:
 
 							# somebody powered computer in between
-							pc.status=Status.STARTING
+							powerOnParents[pc]=parent
+							fleet.dispatch(pc,Event.STARTED)
 
 						else:
 
 							# start computer
+							# (press power button for the press length of computer's pulse profile;
+							# the span is the parent of the boot of the computer)
 							log.info('Starting computer '+pc.name+' in startAfterStopped procedure...')
-							powerOutputBits|=pc.powerBitMask
-							dataOutput.Write(0,powerOutputBits)
-							await asyncio.sleep(0.5)
-
-							# if OFF, deactivate power signal after 0.5 second
-							powerOutputBits&=~pc.powerBitMask
-							dataOutput.Write(0,powerOutputBits)
-
-							# update computer state
-							r=dataInput.Read(0,powerInputBits)
-							if r!=0: raise OSError(r,'USB-4761 device error (error code: '+hex(r)+').')
-
-							# if still did not came up, give it three times another 0.5 second
-							for i in [1,2,3]:
-								if powerInputBits.value()&pc.powerBitMask==0:
-									await asyncio.sleep(0.5)
-
-									# test again if it came up
-									r=dataInput.Read(0,powerInputBits)
-									if r!=0: raise OSError(r,'USB-4761 device error (error code: '+hex(r)+').')
-
-							if powerInputBits.value()&pc.powerBitMask==0:
-								pc.status=Status.OFF
-								log.info('Computer '+pc.name+' failed to start (state OFF) and left startAfterStopped procedure.')
-							else:
-								pc.status=Status.STARTING
-								log.info('Computer '+pc.name+' is now STARTING and left startAfterStopped procedure.')
+							beginPowerButtonOperation()
+							try:
+								with tracer.span('start after stopped '+pc.name,'scheduler',parent,{'computer':pc.name}) as span:
+									powerOnParents[pc]=span
+									try:
+										await pressPowerButton(pc,pc.pulseProfile.pressLength).done
+									except BlockingIOError:
+										log.error('Power button of computer '+pc.name+' is already being pressed.')
+
+									# if still did not came up, wait for power on during confirmation window
+									await waitForPower(pc,True,pc.pulseProfile.confirmationWindow)
+
+									# update computer state
+									powerInputBits=sampler.inputBits
+									if powerInputBits&pc.powerBitMask==0:
+										fleet.dispatch(pc,Event.START_FAILED)
+										log.info('Computer '+pc.name+' failed to start (state OFF) and left startAfterStopped procedure.')
+									else:
+										fleet.dispatch(pc,Event.STARTED)
+										log.info('Computer '+pc.name+' is now STARTING and left startAfterStopped procedure.')
+									powerOnParents.pop(pc,None)
+							finally:
+								endPowerButtonOperation()
 
 			if q1 or q2: # non-empty lists
 				await asyncio.sleep(0.5)  # sleep 500ms
@@ -897,73 +1197,782 @@ async def startAfterStoppedHandler():
 				break
 
 
-async def pingHandler():
+async def killComputer(pc,wlog):
 
-	while True:
+	# forcefully power off the computer by holding its power button
+	# (returns short outcome used in summaries of group requests)
 
-		# sleep 10s
-		await asyncio.sleep(10)
+	# read computer state
+	powerInputBits=sampler.inputBits
+	status=getComputerStatus(pc,powerInputBits)
+
+	# if OFF, do nothing
+	if status==Status.OFF:
+		wlog.info('Computer '+pc.name+' is already switched off.')
+		return 'already OFF'
+
+	# without wires, power off can not be detected
+	if pc.powerBitMask==0:
+		wlog.critical('Computer '+pc.name+' is not connected by wires. It can not be forcefully powered off.')
+		return 'not connected by wires'
+
+	# press power button until released
+	try:
+		pulse=pressPowerButton(pc)
+	except BlockingIOError:
+		wlog.critical('Power button of computer '+pc.name+' is already being pressed.')
+		return 'power button already being pressed'
+	wlog.info('Forcefully shutting down computer '+pc.name+'...')
+
+	# wait for power off, at most for kill hold limit of computer's pulse profile
+	# (power inputs are sampled with high rate meanwhile to release the button right on power off)
+	sampler.boost(powerKillSamplingRate)
+	try:
+		powerOffTime=await waitForPower(pc,False,pc.pulseProfile.killHoldLimit)
 
-		# prepare data to send
-		data3=pickle.dumps(time.monotonic(),protocol=2)
-		data1=struct.pack('!I',MSG_PING_SCHEDULE)
-		data2=struct.pack('!I',len(data3))
-		message=data1+data2+data3
+	# release power button
+	# (the button is released even if the request is cancelled)
+	finally:
+		pulseEngine.release(pulse)
+		sampler.unboost(powerKillSamplingRate)
+	duration=await pulse.done
+	wlog.info('Power button of computer '+pc.name+' pressed for {:.3f} seconds.'.format(duration))
+
+	# update computer state
+	powerInputBits=sampler.inputBits
+	status=getComputerStatus(pc,powerInputBits)
+
+	# if OFF
+	# (power off time is given by the first sample with power LED off)
+	if status==Status.OFF and powerOffTime!=None:
+		outcome='powered off in {:.3f} seconds, at {}'.format(powerOffTime-pulse.pressTime,formatMonotonicTime(powerOffTime))
+		wlog.critical('Computer '+pc.name+' successfully '+outcome+'.')
+		return outcome
+	elif status==Status.OFF:
+		wlog.critical('Computer '+pc.name+' successfully powered off.')
+		return 'powered off'
+	else:
+		wlog.critical('Failed to forcefully power off computer '+pc.name+'.\n'
+		              '   Computer left in the state: '+Status.str(status)+'.')
+		return 'failed to power off (state: '+Status.str(status)+')'
+
+
+# power-on scheduler
+# (all power-on presses are issued by a single task in the order of scheduling,
+# consecutive presses are at least powerOnInterval apart to limit inrush current;
+# power-on confirmation of the pressed computers runs by callbacks,
+# thus the next press does not wait for the previous computer to come up;
+# each scheduled computer is traced by a span from its scheduling until its future is done)
+class PowerOnScheduler:
+
+	def __init__(self,interval):
+		self.interval=interval
+		self.queue=collections.deque()
+		self.wakeup=None
+		self.lastPressTime=None
+		self.task=None
+
+	def start(self):
+		self.task=loop.create_task(self._run())
+
+	def schedule(self,pc,event,wlog):
+		# (returns future of (status,duration) where duration of the press is None if the computer
+		# was not OFF; BlockingIOError is set if the power button is already being pressed)
+		future=loop.create_future()
+		span=tracer.begin('power on '+pc.name,'scheduler',args={'computer':pc.name})
+		future.add_done_callback(lambda f: tracer.end(span))
+		beginPowerButtonOperation()
+		future.add_done_callback(endPowerButtonOperation)
+		self.queue.append((pc,event,wlog,future,span))
+		if self.wakeup!=None and not self.wakeup.done():
+			self.wakeup.set_result(None)
+		return future
+
+	async def _run(self):
 
-		# pingHandler scheduled sending of ping
-		# (do not use any await or yield calls in this code block!)
-		for pc in activeComputerList:
+		while True:
 
-			# only ON computers are processed
-			if pc.status!=Status.ON:
+			# wait for a request
+			if not self.queue:
+				currentSpan.set(None)
+				self.wakeup=loop.create_future()
+				await self.wakeup
+				continue
+			pc,event,wlog,future,span=self.queue.popleft()
+			if future.done():  # cancelled by the requester
 				continue
 
-			# feed data to the reader
-			pc.reader.feed_data(message)
-			continue
+			# the span of the computer is the current span while it is processed
+			# (it is the parent of the pulse, of the confirmation and of the boot of the computer)
+			currentSpan.set(span)
+
+			# stagger the presses
+			# (computers without wires do not take a slot)
+			if pc.status==Status.OFF and pc.powerBitMask!=0 and self.lastPressTime!=None:
+				delay=self.lastPressTime+self.interval-loop.time()
+				if delay>0:
+					with tracer.span('stagger presses','sleep'):
+						await asyncio.sleep(delay)
+					if future.done():
+						continue
+
+			# atomically process computer state update
+			# (do not put any await or yield calls the following block starting from
+			# read computer state, through processing the event, finishing by activation of power signal;
+			# power output writes are not awaited, they are performed in the order of issuing)
+
+			# read computer state
+			powerInputBits=sampler.inputBits
+			status=getComputerStatus(pc,powerInputBits)
+
+			# if OFF, press power button for the press length of computer's pulse profile
+			pulse=None
+			if status==Status.OFF:
+				try:
+					pulse=pressPowerButton(pc,pc.pulseProfile.pressLength)
+				except BlockingIOError as e:
+					future.set_exception(e)
+					continue
+				powerOnParents[pc]=span
+				if pc.powerBitMask!=0:
+					self.lastPressTime=loop.time()
 
+			# process the event by transition table
+			if not fleet.dispatch(pc,event,wlog):
+				wlog.critical('Computer '+pc.name+' is in unknown state.')
 
-def getComputer(name):
-	global computerList
-	pcList=[x for x in computerList if name in x.names]
-	if len(pcList)==0:
+			# finish the request, after the pulse and confirmation window if the button was pressed
+			if pulse==None:
+				future.set_result((pc.status,None))
+			else:
+				pulse.done.add_done_callback(lambda f,pc=pc,future=future: self._pulseDone(pc,f,future))
+
+	def _pulseDone(self,pc,pulseDone,future):
+		if future.done():
+			powerOnParents.pop(pc,None)
+			return
+		if pulseDone.exception()!=None:
+			powerOnParents.pop(pc,None)
+			future.set_exception(pulseDone.exception())
+			return
+		duration=pulseDone.result()
+		waiter=waitForPower(pc,True,pc.pulseProfile.confirmationWindow)
+		waiter.add_done_callback(lambda f: self._confirmed(pc,duration,future))
+
+	def _confirmed(self,pc,duration,future):
+		# (the computer that did not power on does not keep the span as the parent of its next boot)
+		powerOnParents.pop(pc,None)
+		if not future.done():
+			future.set_result((getComputerStatus(pc,sampler.inputBits),duration))
+
+
+def logTransition(transition):
+
+	# log all state transitions in debug mode
+	# (subscriber of fleet transition event bus)
+	log.debug(transition.pc.name+': '+Status.str(transition.oldStatus)+' -> '+Status.str(transition.newStatus)+
+	          ' ('+Event.str(transition.event)+').')
+
+
+def metricsTransition(transition):
+
+	# count transitions and time spent in the left state
+	# (subscriber of fleet transition event bus)
+	pc=transition.pc
+	now=time.monotonic()
+	oldStatus=Status.str(transition.oldStatus)
+	transitionMetric.inc((pc.name,oldStatus,Status.str(transition.newStatus)))
+	stateTimeMetric.inc((pc.name,oldStatus),now-stateEnteredTimes.get(pc.name,now))
+	stateEnteredTimes[pc.name]=now
+
+
+def metricsStartCounting():
+
+	# start counting time in state of computers that are not counted yet
+	# (used on initialization and configuration reload)
+	now=time.monotonic()
+	for pc in registry.computers:
+		stateEnteredTimes.setdefault(pc.name,now)
+
+
+def metricsRequest(params,duration):
+	if len(params)>0 and params[0] in requestCommands: command=params[0]
+	else: command='unknown'
+	requestMetric.observe(duration,(command,))
+
+
+def usbTransaction(kind,startTime,duration,spans):
+
+	# USB transaction performed by the hardware thread
+	# (spans are current spans of the requests served by the transaction)
+	usbTransactionMetric.observe(duration,(kind,))
+	for span in spans:
+		tracer.record('USB '+kind,'usb',startTime,startTime+duration,span,thread='USB-4761')
+
+
+def collectMetrics():
+
+	# update metrics computed from the state of the daemon
+	# (called by the metrics server right before rendering)
+	now=time.monotonic()
+	computers=len(activeComputerList)
+	connectionsMetric.set(computers,('computer',))
+	connectionsMetric.set(len(connectionList)-computers,('other',))
+	bytesMetric.values={('sent',):closedConnectionBytes['sent']+sum(c.bytesSent for c in connectionList),
+	                    ('received',):closedConnectionBytes['received']+sum(c.bytesReceived for c in connectionList)}
+	overflowMetric.values={():MessageStream.overflowedConnections}
+	stateMetric.clear()
+	roundTripTimeMetric.clear()
+	clockOffsetMetric.clear()
+	for pc in registry.computers:
+		status=Status.str(pc.status)
+		for s in _status2string.values():
+			stateMetric.set(1 if s==status else 0,(pc.name,s))
+		stateTimeMetric.inc((pc.name,status),now-stateEnteredTimes.get(pc.name,now))
+		stateEnteredTimes[pc.name]=now
+		if pc.stream!=None and pc.stream.heartbeat!=None:
+			statistics=pc.stream.heartbeat.statistics()
+			for key,quantile in (('roundTripTimeP50','0.5'),('roundTripTimeP90','0.9'),('roundTripTimeP99','0.99')):
+				if statistics[key]!=None:
+					roundTripTimeMetric.set(statistics[key],(pc.name,quantile))
+			if statistics['clockOffset']!=None:
+				clockOffsetMetric.set(statistics['clockOffset'],(pc.name,))
+
+
+def traceTransition(transition):
+
+	# trace boots of the computers
+	# (subscriber of fleet transition event bus; the boot span lasts from power on until the computer
+	# gets ON, OFF, FROZEN or STOPPING, its phases are ended by "Got alive" messages of the computer;
+	# the spans are ended in the next iteration of the event loop, thus they enclose
+	# the spans of the processing that caused the transition)
+	pc=transition.pc
+	spans=bootSpans.get(pc)
+	if transition.newStatus==Status.STARTING:
+		if spans==None:
+			if transition.event==Event.POWER_ON and sampler.edgeTime!=None: start=sampler.edgeTime
+			else: start=time.monotonic()
+			boot=tracer.begin('boot '+pc.name,'boot',powerOnParents.pop(pc,None),start,{'computer':pc.name})
+			bootSpans[pc]=[boot,tracer.begin('firmware and OS boot','boot',boot,start)]
+	elif spans!=None and transition.newStatus!=Status.STOP_AFTER_STARTED:
+		del bootSpans[pc]
+		spans[0].args['outcome']=Status.str(transition.newStatus)
+		def endSpans():
+			for span in reversed(spans):
+				if span!=None:
+					tracer.end(span)
+		loop.call_soon(endSpans)
+
+
+def bootPhase(pc,name):
+
+	# end the current boot phase of the computer and begin the next one
+	# (name None only ends the phase; returns the boot span or None if the computer is not booting)
+	spans=bootSpans.get(pc)
+	if spans==None:
 		return None
+	if spans[1]!=None:
+		tracer.end(spans[1])
+	spans[1]=None if name==None else tracer.begin(name,'boot',spans[0])
+	return spans[0]
+
+
+def pressPowerButton(pc,duration=None):
+
+	# press power button of the computer and trace the pulse
+	# (raises BlockingIOError as PulseEngine.press(); the pulse span is the current span
+	# while the pulse is issued, thus its USB writes are traced as its children)
+	span=tracer.begin('power button '+pc.name,'pulse',args={'computer':pc.name})
+	token=currentSpan.set(span)
+	try:
+		pulse=pulseEngine.press(pc.powerBitMask,duration)
+	except BlockingIOError:
+		tracer.end(span)
+		raise
+	finally:
+		currentSpan.reset(token)
+	pulse.done.add_done_callback(lambda f: tracePulse(pulse,span))
+	return pulse
+
+
+def tracePulse(pulse,span):
+
+	# record phases of the finished pulse
+	# (press and release writes from their issuing to their completion and holding between them)
+	if pulse.pressTime!=None:
+		tracer.record('press write','pulse',pulse.pressRequestTime,pulse.pressTime,span)
+	if pulse.releaseTime!=None:
+		releaseRequestTime=max(pulse.releaseRequestTime,pulse.pressTime)
+		tracer.record('hold','pulse',pulse.pressTime,releaseRequestTime,span)
+		tracer.record('release write','pulse',releaseRequestTime,pulse.releaseTime,span)
+		span.args['duration']=pulse.releaseTime-pulse.pressTime
 	else:
-		return pcList[0]
+		span.args['failed']=True
+	tracer.end(span)
+
+
+def traceClientSpans(pc,stream,records):
+
+	# add spans finished by the client computer to the traces
+	# (client times are converted by the clock offset measured by the heartbeat;
+	# spans starting a new trace on the client, such as connecting to the daemon,
+	# join the boot of the computer; raises ValueError or TypeError on invalid records)
+	clockOffset=None
+	if stream.heartbeat!=None:
+		clockOffset=stream.heartbeat.statistics()['clockOffset']
+	offset=(clockOffset or 0.0)+time.time()-time.monotonic()
+	spans=bootSpans.get(pc)
+	traceIds={}
+	for name,category,traceId,spanId,parentId,start,duration,args in records:
+		if parentId==None and spans!=None:
+			traceIds[traceId]=spans[0].traceId
+			parentId=spans[0].spanId
+		span=Span(str(name),str(category),traceIds.get(traceId,traceId),spanId,parentId,start-offset,dict(args),pc.name)
+		span.end=span.start+duration
+		tracer.spans.append(span)
+
+
+def powerInputsChanged(powerInputBits,changedBits):
+
+	# update computer states on power LED edges
+	# (called by power sampler in the event loop whenever debounced power inputs change;
+	# do not put any await or yield calls here!)
+	edges=[(pc,pc.status) for pc in registry.computers if changedBits&pc.powerBitMask!=0]
+	fleet.evaluate(powerInputBits)
+	for pc,oldStatus in edges:
+		pc.timeOfLastPowerEdge=sampler.edgeTime
+		if powerInputBits&pc.powerBitMask!=0: t='Power on'
+		else: t='Power off'
+		log.info(pc.name+': '+t+' detected (state: '+Status.str(oldStatus)+' -> '+Status.str(pc.status)+').')
+
+	# wake up waiters for power on/off
+	for pc,powered,future in powerWaiters:
+		if (powerInputBits&pc.powerBitMask!=0)==powered and not future.done():
+			future.set_result(sampler.edgeTime)
+
+
+def waitForPower(pc,powered,timeout):
+
+	# wait until power LED of the computer goes on (powered=True) or off (powered=False)
+	# (returns future of time.monotonic() of the power edge, current time if already in the requested state,
+	# or None on timeout; the waiter is woken up by powerInputsChanged() right on the debounced edge;
+	# cancelling the future removes the waiter)
+	future=loop.create_future()
+	if (sampler.inputBits&pc.powerBitMask!=0)==powered:
+		future.set_result(time.monotonic())
+		return future
+	waiter=(pc,powered,future)
+	powerWaiters.append(waiter)
+	timer=loop.call_later(timeout,lambda: future.done() or future.set_result(None))
+	span=tracer.begin('wait for power '+('on' if powered else 'off'),'wait',args={'computer':pc.name})
+	def removeWaiter(f):
+		timer.cancel()
+		powerWaiters.remove(waiter)
+		span.args['reached']=not f.cancelled() and f.result()!=None
+		tracer.end(span)
+	future.add_done_callback(removeWaiter)
+	return future
+
+
+def formatMonotonicTime(t):
+
+	# format time.monotonic() value as local wall clock time with milliseconds
+	t+=time.time()-time.monotonic()
+	return time.strftime('%Y-%m-%d %H:%M:%S',time.localtime(t))+'.{:03d}'.format(int(t*1000)%1000)
 
 
-def getComputerOperatingSystemByName(pc,osName):
-	if osName==None:
-		return None
-	for os in pc.operatingSystems:
-		for n in os.names:
-			if n.casefold()==osName.casefold():
-				return os
-	return None
+def getComputer(name):
+	return registry.get(name)
 
 
-def getComputerOperatingSystemByPartition(pc,partition):
-	if partition==None or partition=='':
-		return None
-	for os in pc.operatingSystems:
-		if os.partition==partition:
-			return os
-	return None
+async def reloadConfiguration(wlog):
+
+	# re-read pcconfig.py and compile new registry
+	# (the live registry is kept if the configuration is not valid)
+	global registry
+	try:
+		config=importlib.reload(sys.modules['pcconfig'])
+		newRegistry=Registry(config.computerList,config.defaultPulseProfile)
+	except Exception as e:
+		wlog.critical('Error: Configuration not reloaded.\n'
+		              '   '+type(e).__name__+': '+str(e))
+		return
+
+	# atomically apply the differences
+	# (computers of the same name keep their records, thus their state and connections;
+	# records of removed computers are detached from the fleet;
+	# do not put any await or yield calls in this block!)
+	added,removed,changed=newRegistry.adopt(registry)
+	for pc in registry.computers:
+		if pc.name in removed:
+			pc.index=-1
+			pc.status=None
+	oldPowerBitMask=registry.powerBitMask
+	registry=newRegistry
+	fleet.setComputers(registry.computers)
+	metricsStartCounting()
+	fleet.evaluate(sampler.inputBits)
+	powerOnScheduler.interval=config.powerOnInterval
+	for pc in registry.computers:
+		journalMark(pc)
+
+	# report
+	text='Configuration reloaded ('+str(len(registry.computers))+' computers).'
+	for title,names in [('Added',added),('Removed',removed),('Changed',changed)]:
+		if names:
+			text+='\n   '+title+': '+', '.join(names)
+	if not added and not removed and not changed:
+		text+='\n   No computer changed.'
+	log.info(text)
+	wlog.critical(text)
+	if config.pcwakerListeningPort!=pcwakerListeningPort:
+		wlog.warning('Change of listening port requires daemon restart.')
+	if config.pcwakerMetricsPort!=pcwakerMetricsPort:
+		wlog.warning('Change of metrics port requires daemon restart.')
+
+	# update change-of-state interrupt mask
+	if registry.powerBitMask!=oldPowerBitMask and hardware.changeOfStateEnabled:
+		try:
+			await hardware.enableChangeOfState(registry.powerBitMask)
+		except (NotImplementedError,OSError) as e:
+			wlog.error('Change-of-state interrupts not updated ('+str(e)+').')
+
+
+# zero-downtime upgrade
+#
+# The running daemon starts a new daemon process (usually of upgraded code) and passes it
+# the listening sockets and the connections of the computers over a unix socket by SCM_RIGHTS,
+# together with the snapshot of computer states and of unread data of the connections.
+# Thus, the computers stay connected and their states are not lost. USB-4761 device is released
+# before the snapshot is sent and the new process opens it after receiving the snapshot.
+# The old process terminates when the new one confirms it is up and running; otherwise,
+# it takes the device and the connections back and continues.
+#
+# The daemon is quiesced first: user requests are refused, listening sockets stop accepting
+# (their duplicates are kept for the new process and for the rollback) and startAfterStopped
+# procedure does not start new presses. Accepted power-on requests, kills and presses in progress
+# are finished (at most for upgradeQuiesceTimeout seconds, otherwise the upgrade is abandoned).
+# Then the power sampling is stopped and outstanding USB transactions are awaited, thus no state
+# transition happens after the snapshot. The new process confirms the take over before it reads
+# any of the connections, thus no data are lost if it fails.
+upgradeQuiesceTimeout=60
+
+async def upgradeDaemon(wlog):
+
+	global hardware,pulseEngine,journal,upgradeFlag,upgrading,servers
+
+	# quiesce
+	upgrading=True
+	powerButtonsAvailable.clear()
+	listeningSockets=[sock.dup() for server in servers for sock in server.sockets]
+	for server in servers:
+		server.close()
+	servers=[]
+	async def resume():
+		global servers,upgrading
+		servers=[await loop.create_server(lambda: MessageStream(serverConnectionHandler),sock=sock)
+		         for sock in listeningSockets]
+		upgrading=False
+		powerButtonsAvailable.set()
+	if powerButtonOperations!=0 or pulseEngine.ownedBits!=0:
+		wlog.info('Waiting for power button operations to finish...')
+		if not await waitUntil(lambda: powerButtonOperations==0 and pulseEngine.ownedBits==0,upgradeQuiesceTimeout):
+			wlog.critical('Error: Power buttons are still being used. Try the upgrade later.')
+			await resume()
+			return False
+
+	# flush outgoing messages of the computers
+	for pc in registry.computers:
+		if pc.stream!=None:
+			await pc.stream.drain()
+
+	# start new process
+	# (log records are written first as the new process rolls the log file over)
+	await loop.run_in_executor(None,logWriter.flush)
+	parentSocket,childSocket=socket.socketpair(socket.AF_UNIX,socket.SOCK_STREAM)
+	cmd=[os.path.dirname(os.path.abspath(__file__))+'/pcwakerd','--handoff-fd',str(childSocket.fileno())]
+	if args.debug: cmd.append('--debug')
+	if args.debug_level: cmd+=['--debug-level',args.debug_level]
+	try:
+		process=subprocess.Popen(cmd,pass_fds=[childSocket.fileno()],stdin=subprocess.DEVNULL,stdout=subprocess.DEVNULL)
+	except OSError as e:
+		wlog.critical('Error: Can not start new daemon process ('+e.strerror+').')
+		parentSocket.close()
+		await resume()
+		return False
+	finally:
+		childSocket.close()
+	wlog.info('Handing over to new daemon process (pid '+str(process.pid)+')...')
+
+	# stop power sampling and wait for outstanding USB transactions
+	await sampler.stop()
+	if not await waitUntil(lambda: hardware.pendingRequests==0,5):
+		wlog.critical('Error: USB-4761 device does not respond. Continuing with this process.')
+		process.kill()
+		await loop.run_in_executor(None,process.wait)
+		parentSocket.close()
+		sampler.start(sampler.inputBits)
+		await resume()
+		return False
+
+	# atomically take the snapshot and detach connections of the computers
+	# (do not put any await or yield calls in this block!)
+	snapshot={'computers':[],'listeners':len(listeningSockets),'connections':[]}
+	fds=[sock.fileno() for sock in listeningSockets]
+	for pc in registry.computers:
+		snapshot['computers'].append({
+			'name':pc.name,
+			'status':pc.status,
+			'requestedOS':pc.requestedOS.name if pc.requestedOS not in (None,noRequestedOS) else None,
+			'currentOS':pc.currentOS.name if pc.currentOS not in (None,noRequestedOS) else None,
+			'timeOfStatusChange':pc.timeOfStatusChange,
+			'timeOfLastPowerEdge':pc.timeOfLastPowerEdge})
+	detached=[]
+	for pc in registry.computers:
+		if pc.stream!=None and not pc.stream.is_closing():
+			messages,data=pc.stream.detach()
+			detached.append((pc.stream,messages,data))
+			snapshot['connections'].append({'computer':pc.name,'codec':pc.stream.codec,
+			                                'pickleAllowed':pc.stream.pickleAllowed,'peerTracing':pc.stream.peerTracing,
+			                                'messages':messages,'data':data})
+			fds.append(pc.stream.get_extra_info('socket').fileno())
+
+	# release USB-4761 device, state journal and metrics port
+	if metricsServer:
+		metricsServer.close()
+	await loop.run_in_executor(None,hardware.close)
+	if journal:
+		await journal.aclose()
+
+	# send the snapshot with the sockets and wait for the confirmation
+	try:
+		parentSocket.setblocking(False)
+		blob=pickle.dumps(snapshot,pickle.HIGHEST_PROTOCOL)
+		socket.send_fds(parentSocket,[struct.pack('!I',len(blob))],fds)
+		await loop.sock_sendall(parentSocket,blob)
+		answer=await asyncio.wait_for(loop.sock_recv(parentSocket,16),30)
+	except (OSError,asyncio.TimeoutError) as e:
+		answer=b''
+	finally:
+		parentSocket.close()
+	if answer==b'ok':
+		upgradeFlag=True
+		hardware=None
+		wlog.critical('Daemon upgraded. New process (pid '+str(process.pid)+') took over '+
+		              str(len(detached))+' computer connection(s).')
+		return True
+
+	# the new process failed, take everything back
+	# (the connections are restored first, the daemon continues without the device if it can not be reopened)
+	wlog.critical('Error: New daemon process failed to take over. Continuing with this process.')
+	if process.poll()==None:
+		process.kill()
+	await loop.run_in_executor(None,process.wait)
+	for stream,messages,data in detached:
+		stream.restore(messages,data)
+	await resume()
+	if journal:
+		try:
+			journal.open()
+		except OSError as e:
+			wlog.error('State journal not available ('+str(e)+').')
+			journal=None
+	if metricsServer:
+		try:
+			await metricsServer.start('127.0.0.1',pcwakerMetricsPort)
+		except OSError as e:
+			wlog.error('Metrics server not available ('+e.strerror+').')
+	hardware=HardwareService(loop,'USB-4761,BID#0')
+	hardware.changeOfStateCallback=sampler.changeOfState
+	hardware.transactionCallback=usbTransaction
+	pulseEngine=PulseEngine(hardware)
+	sampler.hardware=hardware
+	try:
+		await hardware.open()
+		try:
+			await hardware.enableChangeOfState(registry.powerBitMask)
+		except NotImplementedError:
+			pass
+		sampler.start(await hardware.read())
+	except OSError as e:
+		hardware.close()
+		wlog.critical('Error: Can not reopen USB-4761 device ('+e.strerror+').\n'
+		              '   Power buttons and power inputs are not available. Restart the daemon.')
+	return False
+
+
+async def waitUntil(condition,timeout):
+	# (polls the condition; returns False if it did not become true within timeout seconds)
+	deadline=loop.time()+timeout
+	while not condition():
+		if loop.time()>=deadline:
+			return False
+		await asyncio.sleep(0.05)
+	return True
+
+
+def receiveHandoff(fd):
+
+	# receive the snapshot and the sockets sent by upgradeDaemon() of the previous daemon process
+	# (returns (socket,snapshot,fds); the socket is used to confirm the take over)
+	handoffSocket=socket.socket(fileno=fd)
+	header,fds,flags,address=socket.recv_fds(handoffSocket,struct.calcsize('!I'),256)
+	if len(header)!=struct.calcsize('!I'):
+		raise EOFError('Previous daemon process closed the connection.')
+	size,=struct.unpack('!I',header)
+	blob=bytearray()
+	while len(blob)<size:
+		data=handoffSocket.recv(size-len(blob))
+		if not data:
+			raise EOFError('Previous daemon process closed the connection.')
+		blob+=data
+	return handoffSocket,pickle.loads(blob),fds
+
+
+def restoreHandoff(snapshot,fds):
+
+	# restore computer states and create streams of the connections
+	# (called before the fleet is created, thus the states are reconciled with power inputs
+	# by the first evaluation of the fleet; returns (listeningSockets,[(socket,stream)]))
+	for record in snapshot['computers']:
+		pc=registry.get(record['name'])
+		if pc==None or pc.name!=record['name']:
+			continue
+		pc.status=record['status']
+		pc.stream=None
+		pc.requestedOS=pc.getOperatingSystemByName(record['requestedOS']) or noRequestedOS
+		if record['currentOS']!=None:
+			pc.currentOS=pc.getOperatingSystemByName(record['currentOS']) or noRequestedOS
+		pc.timeOfStatusChange=record.get('timeOfStatusChange')
+		pc.timeOfLastPowerEdge=record.get('timeOfLastPowerEdge')
+	listeningSockets=[socket.socket(fileno=fd) for fd in fds[:snapshot['listeners']]]
+	connections=[]
+	for record,fd in zip(snapshot['connections'],fds[snapshot['listeners']:]):
+		sock=socket.socket(fileno=fd)
+		pc=registry.get(record['computer'])
+		if pc==None or pc.status==None:
+			sock.close()
+			continue
+		stream=MessageStream(functools.partial(serverConnectionHandler,handoff=record),record['codec'])
+		stream.pickleAllowed=record['pickleAllowed']
+		stream.peerTracing=record.get('peerTracing',False)
+		pc.stream=stream
+		connections.append((sock,stream))
+	return listeningSockets,connections
+
+
+def journalRecord(pc):
+	return {'name':pc.name,
+	        'status':Status.str(pc.status),
+	        'requestedOS':pc.requestedOS.name if pc.requestedOS not in (None,noRequestedOS) else None,
+	        'currentOS':pc.currentOS.name if pc.currentOS not in (None,noRequestedOS) else None,
+	        'time':time.time()}
+
+
+def journalSnapshot():
+	return [journalRecord(pc) for pc in registry.computers]
+
+
+def journalMark(pc):
+	# (the state of the computer is written to the state journal by the next batch;
+	# do not put any await or yield calls here)
+	if journal:
+		journal.mark(pc)
+
+
+def journalTransition(transition):
+	# (subscriber of fleet transition event bus)
+	journalMark(transition.pc)
+
+
+def restoreJournal(records):
+
+	# restore computer states replayed from the state journal
+	# (called before the fleet is created, thus the states are reconciled with power inputs
+	# by the first evaluation of the fleet; computers that were ON wait in STARTING state for their
+	# connections, otherwise they would be considered FROZEN; returns the number of restored computers)
+	string2status={v:k for k,v in _status2string.items()}
+	count=0
+	for pc in registry.computers:
+		record=records.get(pc.name)
+		if record==None:
+			continue
+		status=string2status.get(record.get('status'))
+		if status==None:
+			continue
+		if status==Status.ON:
+			status=Status.STARTING
+		pc.status=status
+		pc.stream=None
+		pc.requestedOS=pc.getOperatingSystemByName(record.get('requestedOS')) or noRequestedOS
+		if record.get('currentOS')!=None:
+			pc.currentOS=pc.getOperatingSystemByName(record['currentOS']) or noRequestedOS
+		count+=1
+	return count
+
+
+def isGroupRequest(names):
+
+	# more computers or any tag given
+	pcList,unknownNames=registry.resolve(names)
+	if len(pcList)>1:
+		return True
+	return any(registry.isTag(name) for name in names)
+
+
+# data stream sent by client computer that is forwarded to pcwaker.py
+# (each chunk is forwarded as it arrives, thus the memory consumption does not depend
+# on the amount of data; the sending computer is slowed down when pcwaker.py does not keep up)
+class ForwardedDataStream:
+
+	def __init__(self,pc,stream,requestId):
+		self.pc=pc
+		self.streamId=allocateStreamId()
+		self.sender=DataStreamSender(stream,self.streamId,requestId)
+		self.receiver=DataStreamReceiver()
+		self.done=loop.create_future()
+		forwardedDataStreams[self.streamId]=self
+
+	async def forward(self,message):
+		try:
+			data=self.receiver.receive(message)
+		except OSError:
+			log.error(self.pc.name+': Chunk of data stream '+str(self.streamId)+' out of sequence.')
+			self.finish()
+			return
+		if self.receiver.ended:
+			await self.sender.close(data)
+			self.finish()
+		else:
+			await self.sender.send(data)
+
+	def finish(self):
+		forwardedDataStreams.pop(self.streamId,None)
+		if not self.done.done():
+			self.done.set_result(None)
+
+
+def allocateStreamId():
+	global nextStreamId
+	streamId=nextStreamId
+	nextStreamId=nextStreamId%0x7fffffff+1
+	return streamId
 
 
 # log handler that sends log messages over the stream back to the client
 class ConnectionLogHandler(logging.Handler):
 
-	def __init__(self,writer):
+	def __init__(self,stream,requestId=None):
 		logging.Handler.__init__(self)
-		self.writer=writer
+		self.stream=stream
+		self.requestId=requestId
 
 	def emit(self,record):
 		# multithreaded lock is in handle() method,
 		# thus only single thread may enter this method
+		# (the text is shared with the log file; the message is encoded when the stream is flushed)
 		try:
-			text=self.format(record)
-			stream_write_message(self.writer,MSG_LOG,text)
+			stream_write_message(self.stream,MSG_LOG,recordText(record),self.requestId)
 		except Exception:
 			self.handleError(record)
 
@@ -984,41 +1993,67 @@ def cleanUp():
 		log.debug('Starting clean up...')
 
 	# remove listening port file
+	# (after upgrade, the file belongs to the new process)
 	global listeningPortFilePath
 	if listeningPortFilePath:
 		listeningPortFile.close()
-		os.remove(listeningPortFilePath)
+		if not upgradeFlag:
+			os.remove(listeningPortFilePath)
 		listeningPortFilePath=''
 
-	# close server (and its listening socket)
-	if 'server' in globals():
-		global server
-		server.close()
+	# close metrics server
+	global metricsServer
+	if metricsServer:
+		metricsServer.close()
+		metricsServer=None
+
+	# close servers (and their listening sockets)
+	# (after upgrade, the sockets stay open in the new process)
+	if 'servers' in globals():
+		global servers
+		for server in servers:
+			server.close()
 		log.info('Server stopped.');
 
 		# wait on server closing
 		log.debug('Terminating...')
-		serverTmp=server
-		del server
-		loop.run_until_complete(serverTmp.wait_closed())
-		del serverTmp
+		serversTmp=servers
+		del servers
+		for server in serversTmp:
+			loop.run_until_complete(server.wait_closed())
+		del serversTmp
+
+	# stop power sampling
+	global sampler
+	if sampler:
+		loop.run_until_complete(sampler.stop())
+		sampler=None
 
 	# dispose USB-4761 IO module
-	if 'dataInput' in globals() or 'dataOutput' in globals():
+	# (power buttons still being pressed are released;
+	# hardware service thread disposes the device and terminates)
+	global hardware
+	if hardware:
 		log.info('Cleaning up USB-4761 IO module...')
-	if 'dataInput' in globals():
-		global dataInput
-		dataInput.Dispose()
-		del dataInput
-	if 'dataOutput' in globals():
-		global dataOutput
-		dataOutput.Dispose()
-		del dataOutput
+		if pulseEngine and pulseEngine.outputBits!=0:
+			try:
+				loop.run_until_complete(hardware.write(0))
+			except OSError as e:
+				log.error('Failed to release power buttons ('+e.strerror+').')
+		hardware.close()
+		hardware=None
+
+	# write the rest of state journal
+	global journal
+	if journal:
+		journal.close()
+		journal=None
 
 	if restartFlag:
 
 		# restart the process
 		log.info('Restarting process...')
+		logWriter.flush()
 		p=subprocess.Popen(["./pcwakerd","--init-print-log"],stdout=subprocess.PIPE)
 
 		# write new process output to log
@@ -1028,6 +2063,9 @@ def cleanUp():
 			s=s[:-1]
 		log.info(s)
 
+	elif upgradeFlag:
+		log.info('Done. Daemon continues in the new process.')
+
 	else:
 		if 'log' in globals():
 			log.info('Done.')
@@ -1037,7 +2075,7 @@ def cleanUp():
 	if shutdownLog:
 		log.parent=savedParent
 		for h in shutdownLog.handlers:
-			h.writer.close()
+			h.stream.close()
 			h.close()
 		shutdownLog=None
 
@@ -1072,6 +2110,7 @@ def signalHandler(signum,stackframe):
 
       # log message and exit without any clean up
       log.critical('Another terminating signal ('+sigName+') received. Terminating immediately.')
+      logWriter.flush(1.0)
       os._exit(2)
 
 
@@ -1088,14 +2127,21 @@ argParser.add_argument('--debug-level',type=str,help='Sets debug level. '
                        action='store')
 argParser.add_argument('--init-print-log',action='store_true')
 argParser.add_argument('--signal-start-to-parent',action='store_true')
+argParser.add_argument('--handoff-fd',type=int,action='store')
 args=argParser.parse_args()
 
 # initialize logger
+# (log records are written by LogWriter thread; the records still queued are written on exit;
+# the log is not rolled over on upgrade as the previous daemon process still writes to it)
 rootLog=logging.getLogger()
 logFileHandler=logging.handlers.RotatingFileHandler(logFilePath,maxBytes=100*1024,backupCount=1)
 logFileHandler.setFormatter(logging.Formatter('%(asctime)-15s %(message)s'))
-rootLog.addHandler(logFileHandler)
-logFileHandler.doRollover()
+if args.handoff_fd==None:
+	logFileHandler.doRollover()
+logWriter=LogWriter(queue.SimpleQueue(),logFileHandler)
+logWriter.start()
+atexit.register(logWriter.stop)
+rootLog.addHandler(LogQueueHandler(logWriter))
 rootLog.setLevel(logging.INFO)
 if args.debug:
 	rootLog.setLevel(logging.DEBUG)
@@ -1107,7 +2153,7 @@ if os.isatty(sys.stdout.fileno()) or args.init_print_log:
 	# http://stackoverflow.com/questions/24861351/how-to-detect-if-python-script-is-being-run-as-a-background-process
 	# http://stackoverflow.com/questions/14894261/programmatically-check-if-a-process-is-being-run-in-the-background
 	logStdOutHandler=logging.StreamHandler(stream=sys.stdout)
-	rootLog.addHandler(logStdOutHandler)
+	logWriter.addHandler(logStdOutHandler)
 	rootLog.debug('Log brought up and output to stdout was added.')
 log=logging.getLogger('main')
 log.setLevel(rootLog.level)
@@ -1119,42 +2165,90 @@ signal.signal(signal.SIGINT,signalHandler) # Ctrl-C handler
 signal.signal(signal.SIGHUP,signalHandler) # hang-up or death of controlling process
 signal.signal(signal.SIGTERM,signalHandler) # terminate request
 
+# compile computer registry from pcconfig
+try:
+	registry=Registry(computerList,defaultPulseProfile)
+except ValueError as e:
+	log.critical('Error: Invalid configuration in pcconfig.py.\n'
+	             '   '+str(e))
+	exit(1)
+
+# take over from the previous daemon process on upgrade
+# (the previous process releases USB-4761 device before it sends the snapshot)
+handoffSocket=None
+if args.handoff_fd!=None:
+	try:
+		handoffSocket,handoff,handoffFds=receiveHandoff(args.handoff_fd)
+		handoffListeningSockets,handoffConnections=restoreHandoff(handoff,handoffFds)
+	except Exception as e:
+		log.critical('Error: Can not take over from the previous daemon process ('+type(e).__name__+': '+str(e)+').')
+		exit(1)
+	del handoff,handoffFds
+
 # initialize USB-4761 IO module
+# (the device is owned by the thread of hardware service)
 log.debug('Initializing USB-4761 IO module...')
 try:
-	import bdaqctrl
+	from pcwaker_hardware import *
 except ImportError as e:
 	log.critical('Error: Can not load bdaqctrl module.\n'
 	             '   Error string: '+e.msg+'.')
 	exit(1)
-deviceInformation=bdaqctrl.DeviceInformation('USB-4761,BID#0')
-dataInput=bdaqctrl.AdxInstantDiCtrlCreate()
-dataOutput=bdaqctrl.AdxInstantDoCtrlCreate()
-r1=dataInput.setSelectedDevice(deviceInformation)
-r2=dataOutput.setSelectedDevice(deviceInformation)
-if(r1!=0 or r2!=0):
+loop=asyncio.get_event_loop()
+statusWaiters=StatusWaiters(loop)
+hardware=HardwareService(loop,'USB-4761,BID#0')
+hardware.transactionCallback=usbTransaction
+try:
+	loop.run_until_complete(hardware.open())
+except OSError:
 	log.critical('Error: Can not connect to USB-4761 device.')
 	exit(1)
-powerInputBits=bdaqctrl.uint8()
-powerOutputBits=0
-r1=dataInput.Read(0,powerInputBits)
-r2=dataOutput.Write(0,0)
-if(r1!=0 or r2!=0):
+try:
+	powerInputBits=loop.run_until_complete(hardware.read())
+	r,_=loop.run_until_complete(hardware.write(0))
+	if r!=0: raise OSError(r,'USB-4761 device error (error code: '+hex(r)+').')
+except OSError:
 	log.critical('Error: Can not write to USB-4761 device.')
 	exit(1)
+pulseEngine=PulseEngine(hardware)
 log.info('USB-4761 IO module initialized successfully.')
 
+# replay state journal
+# (not used on upgrade, the states were handed over by the previous daemon process)
+journal=StateJournal(loop,journalFilePath,journalRecord,journalSnapshot)
+if not handoffSocket:
+	n=restoreJournal(journal.replay())
+	if n!=0:
+		log.info('States of '+str(n)+' computer(s) restored from state journal.')
+	del n
+
 # initialize computers
+# (restored states are reconciled with the power inputs read above)
 computerListText=''
 runningComputers=''
-for pc in computerList:
-	pc.status=Status.OFF
-	pc.reader=None
-	pc.writer=None
-	pc.requestedOS=noRequestedOS
+fleet=Fleet(registry.computers,transitionTable)
+fleet.subscribe(logTransition)
+fleet.subscribe(statusWaiters.transition)
+fleet.subscribe(metricsTransition)
+fleet.subscribe(traceTransition)
+metricsStartCounting()
+fleet.evaluate(powerInputBits)
+for pc in registry.computers:
+	if pc.status==Status.START_AFTER_STOPPED:
+		startAfterStoppedQueue.put_nowait(pc)
+
+# open state journal
+# (it is compacted to the reconciled states, transitions are journaled from now on)
+try:
+	journal.open()
+	fleet.subscribe(journalTransition)
+except OSError as e:
+	log.error('State journal not available ('+str(e)+').')
+	journal=None
+for pc in registry.computers:
 	if computerListText=='': computerListText=pc.name
 	else: computerListText+=', '+pc.name
-	if getComputerStatus(pc,powerInputBits.value())!=Status.OFF:
+	if pc.status!=Status.OFF:
 		if runningComputers=='': runningComputers=pc.name
 		else: runningComputers+=', '+pc.name
 if computerListText=='': computerListText='none'
@@ -1164,10 +2258,24 @@ log.info('Currently powered computers: '+runningComputers)
 del computerListText
 del runningComputers
 
+# sense power changes
+# (power inputs are sampled periodically; if available, change-of-state interrupts
+# provide samples on each edge and the periodic sampling is reduced to a backstop)
+sampler=PowerSampler(hardware,powerSamplingRate,powerDebounceSamples,powerHistoryLength,powerBackstopSamplingRate)
+sampler.inputChangedCallback=powerInputsChanged
+hardware.changeOfStateCallback=sampler.changeOfState
+try:
+	loop.run_until_complete(hardware.enableChangeOfState(registry.powerBitMask))
+	log.info('Power inputs are sampled by change-of-state interrupts ('+str(powerSamplingRate)+' Hz after each of them)\n'
+	         '   and at '+str(powerBackstopSamplingRate)+' Hz otherwise.')
+except NotImplementedError as e:
+	log.info('Power inputs are sampled at '+str(powerSamplingRate)+' Hz\n'
+	         '   (change-of-state interrupts not available: '+str(e)+').')
+
 # create listeningPortFile
 if listeningPortFilePath:
    try:
-      listeningPortFile=open(listeningPortFilePath,mode='x')
+      listeningPortFile=open(listeningPortFilePath,mode='w' if handoffSocket else 'x')
    except FileNotFoundError:
       log.critical('Error: Can not create file '+listeningPortFilePath+'.\n'
                    '   Make sure parent directories exist and proper access rights are set.')
@@ -1182,15 +2290,18 @@ if listeningPortFilePath:
       exit(1)
 
 # create listening socket
+# (on upgrade, listening sockets of the previous process are used;
+# they start accepting after the take over is confirmed)
 log.debug('Initializing network:')
-loop=asyncio.get_event_loop()
-if pcwakerListeningPort!=0:
-	coro=asyncio.start_server(serverConnectionHandler,'',pcwakerListeningPort,loop=loop)
-else:
-	coro=asyncio.start_server(serverConnectionHandler,'127.0.0.1',0,loop=loop)
 try:
-	server=loop.run_until_complete(coro)
-	if server.sockets==None:
+	if handoffSocket:
+		servers=[loop.run_until_complete(loop.create_server(lambda: MessageStream(serverConnectionHandler),sock=s,start_serving=False))
+		         for s in handoffListeningSockets]
+	elif pcwakerListeningPort!=0:
+		servers=[loop.run_until_complete(loop.create_server(lambda: MessageStream(serverConnectionHandler),'',pcwakerListeningPort))]
+	else:
+		servers=[loop.run_until_complete(loop.create_server(lambda: MessageStream(serverConnectionHandler),'127.0.0.1',0))]
+	if len(servers)==0 or servers[0].sockets==None:
 		raise OSError(5,"Failed to create listening socket.")
 except OSError as msg:
 	log.critical('Network error ('+msg.strerror+'). Terminating.')
@@ -1201,7 +2312,7 @@ except OSError as msg:
 # get listening port number
 listeningPort4=0
 listeningPort6=0
-for s in server.sockets:
+for s in [s for server in servers for s in server.sockets]:
 	if s.family==socket.AF_INET: listeningPort4=s.getsockname()[1]
 	if s.family==socket.AF_INET6: listeningPort6=s.getsockname()[1]
 if listeningPort4!=listeningPort6 and listeningPort4!=0 and listeningPort6!=0:
@@ -1228,18 +2339,56 @@ if listeningPortFilePath:
 	listeningPortFile.flush()
 log.info('Waiting connections on '+ipFamilyString+str(listeningPort)+'...');
 
+# export metrics
+# (on upgrade, the previous process closed its metrics server before the handoff)
+metrics.collectors.append(collectMetrics)
+loopLagMonitor=LoopLagMonitor(loop,loopLagMetric,lastLoopLagMetric)
+loopLagMonitor.start()
+if pcwakerMetricsPort!=0:
+	metricsServer=MetricsServer(metrics)
+	try:
+		loop.run_until_complete(metricsServer.start('127.0.0.1',pcwakerMetricsPort))
+		log.info('Metrics exported on http://127.0.0.1:'+str(pcwakerMetricsPort)+'/metrics.')
+	except OSError as e:
+		log.error('Metrics server not available ('+e.strerror+').')
+		metricsServer=None
+
+# confirm the take over and continue connections handed over by the previous daemon process
+# (nothing is read from the connections before the confirmation, thus the previous process
+# continues them without any loss if the confirmation fails)
+if handoffSocket:
+	try:
+		handoffSocket.sendall(b'ok')
+	except OSError as e:
+		log.critical('Error: Can not confirm the take over to the previous daemon process ('+e.strerror+'). Terminating.')
+		if listeningPortFilePath:  # (the file stays with the previous process)
+			listeningPortFile.close()
+			listeningPortFilePath=''
+		cleanUp()
+		sys.exit(1)
+	finally:
+		handoffSocket.close()
+	for sock,stream in handoffConnections:
+		loop.run_until_complete(loop.connect_accepted_socket(lambda stream=stream: stream,sock=sock))
+	for server in servers:
+		loop.run_until_complete(server.start_serving())
+	log.info('Took over '+str(len(handoffConnections))+' computer connection(s) from the previous daemon process.')
+	del handoffConnections,handoffListeningSockets
+
 # stop logging to stdout for --init-print-log here
 log.info('Server up and running...')
 if args.init_print_log:
-	rootLog.removeHandler(logStdOutHandler)
+	logWriter.removeHandler(logStdOutHandler)
 	sys.stdout.flush()
 	os.close(sys.stdout.fileno())
 if args.signal_start_to_parent:
 	os.kill(os.getppid(),signal.SIGHUP)
 
 # create tasks
-#pingTask=loop.create_task(pingHandler())
 startAfterStoppedTask=loop.create_task(startAfterStoppedHandler())
+powerOnScheduler=PowerOnScheduler(powerOnInterval)
+powerOnScheduler.start()
+sampler.start(powerInputBits)
 
 # run main loop
 try:
@@ -0,0 +1,403 @@
+import asyncio
+import os
+import pickle
+import time
+
+import pytest
+
+from pcwaker_common import *
+
+
+# tests of the wire protocol
+# (run by "python -m pytest" in this directory)
+
+
+# transport collecting written data
+class FakeTransport:
+
+	def __init__(self):
+		self.data=bytearray()
+		self.closed=False
+		self.readingPaused=False
+
+	def write(self,data):
+		self.data+=data
+
+	def writelines(self,buffers):
+		for data in buffers:
+			self.data+=data
+
+	def is_closing(self):
+		return self.closed
+
+	def close(self):
+		self.closed=True
+
+	def abort(self):
+		self.closed=True
+
+	def pause_reading(self):
+		self.readingPaused=True
+
+	def resume_reading(self):
+		self.readingPaused=False
+
+
+def connectedStream(codec=CODEC_PICKLE):
+	stream=MessageStream(codec=codec)
+	stream.connection_made(FakeTransport())
+	return stream
+
+
+def encodeFrames(messages,codec=CODEC_PICKLE,peerTracing=False):
+	# (returns bytes written by MessageStream for (msgType,message,requestId,traceContext) items)
+	stream=connectedStream(codec)
+	stream.peerTracing=peerTracing
+	for msgType,message,requestId,traceContext in messages:
+		stream.send_nowait(msgType,message,requestId,traceContext)
+	stream._flush(force=True)
+	return bytes(stream.transport.data)
+
+
+# frame decoder
+
+def test_framesFedByteByByte():
+	async def run():
+		data=encodeFrames([(MSG_USER,['status'],None,None),(MSG_LOG,'text',None,None)])
+		stream=connectedStream()
+		for i in range(len(data)):
+			stream.feed_data(data[i:i+1])
+		return [await stream.read_message(),await stream.read_message()]
+	assert asyncio.run(run())==[(MSG_USER,['status'],None),(MSG_LOG,'text',None)]
+
+
+def test_framesLargerThanBufferInOneChunk():
+	async def run():
+		data=encodeFrames([(MSG_USER,'x'*200000,None,None),(MSG_USER,'y',None,None)])
+		stream=connectedStream()
+		stream.feed_data(data[:10])
+		stream.feed_data(data[10:])
+		return await stream.read_messages()
+	assert asyncio.run(run())==[(MSG_USER,'x'*200000,None),(MSG_USER,'y',None)]
+
+
+def test_eofAfterFrames():
+	async def run():
+		stream=connectedStream()
+		stream.feed_data(encodeFrames([(MSG_USER,'last',None,None)]))
+		stream.feed_eof()
+		return [await stream.read_message(),await stream.read_message()],stream.at_eof()
+	assert asyncio.run(run())==([(MSG_USER,'last',None),(MSG_EOF,b'',None)],True)
+
+
+def test_oversizedFrameClosesConnection():
+	async def run():
+		stream=connectedStream()
+		stream.feed_data(headerStruct.pack(MSG_USER,maxMessageSize+1))
+		with pytest.raises(OSError):
+			await stream.read_message()
+		return stream
+	assert asyncio.run(run()).transport.closed
+
+
+def test_readingIsPausedWhenReaderDoesNotKeepUp():
+	async def run():
+		stream=connectedStream()
+		stream.feed_data(encodeFrames([(MSG_LOG,str(i),None,None) for i in range(MessageStream.maxPendingMessages)]))
+		paused=stream.transport.readingPaused
+		messages=await stream.read_messages()
+		return paused,len(messages),stream.transport.readingPaused
+	assert asyncio.run(run())==(True,MessageStream.maxPendingMessages,False)
+
+
+# binary codec
+
+@pytest.mark.parametrize('message',[
+	'Computer i9 is already running.',
+	1234.5,
+	['start','cadwork-i9','linux'],
+	['Got alive','i9','linux','/dev/sda1',[1],['trace']],
+	['some','arguments'],
+	[],
+	None,
+	{'name':'i9','reached':True,'waitTime':0.25,'status':'ON','error':None,
+	 'nested':[1,-2,2**40,b'\x00\xff',{'a':[False,'x']}]},
+])
+def test_binaryCodecRoundTrip(message):
+	data=encode_message(CODEC_BINARY,MSG_USER,message)
+	assert decode_message(CODEC_BINARY,MSG_USER,bytes(data))==message
+
+
+def test_binaryCodecChunk():
+	chunk=[3,7,STREAM_END,b'log data']
+	data=encode_message(CODEC_BINARY,MSG_STREAM,chunk)
+	assert decode_message(CODEC_BINARY,MSG_STREAM,bytes(data))==chunk
+
+
+def nestedList(depth):
+	value=[]
+	for i in range(depth):
+		value=[value]
+	return value
+
+@pytest.mark.parametrize('data',[
+	b'',
+	b'\x01',
+	b'\x63\x00',                           # unknown codec version
+	b'\x01\x63\x00\x00',                   # unknown kind
+	b'\x01\x00\x07\xff\xff\xff\xff',       # truncated list
+	b'\x01\x00\x05\x00\x00\x00\x02\xff\xfe',  # invalid utf-8
+	b'\x01\x00\x00\x00',                   # trailing data
+	bytes(encode_message(CODEC_BINARY,MSG_USER,nestedList(maxValueDepth+1))),
+	b'\x01\x00'+b'\x07\x00\x00\x00\x01'*100000,  # nested deeper than the recursion limit
+])
+def test_binaryCodecRejectsGarbage(data):
+	with pytest.raises(OSError) as e:
+		decode_message(CODEC_BINARY,MSG_USER,data)
+	assert e.value.errno==84
+
+
+def test_binaryCodecNestingLimit():
+	data=encode_message(CODEC_BINARY,MSG_USER,nestedList(maxValueDepth))
+	assert decode_message(CODEC_BINARY,MSG_USER,bytes(data))==nestedList(maxValueDepth)
+
+
+# pickle codec of the previous versions
+
+def test_pickleCodecLegacyMessages():
+	# (MSG_COMPUTER messages of the previous versions are pickled twice)
+	legacy=pickle.dumps(pickle.dumps(['Got alive','i9','linux'],protocol=2),protocol=2)
+	assert decode_message(CODEC_PICKLE,MSG_COMPUTER,legacy)==['Got alive','i9','linux']
+	assert encode_message(CODEC_PICKLE,MSG_COMPUTER,['Got alive','i9','linux'])==legacy
+	message={'bytes':b'\x00\x01','set':{1,2},'tuple':(1,'a'),'float':1.5}
+	assert decode_message(CODEC_PICKLE,MSG_USER,pickle.dumps(message,protocol=2))==message
+
+
+class Evil:
+	def __reduce__(self):
+		return (os.system,('false',))
+
+def test_pickleCodecRefusesGlobals():
+	for data in (pickle.dumps(Evil(),protocol=2),pickle.dumps(pickle.dumps(Evil(),protocol=2),protocol=2),
+	             pickle.dumps(FakeTransport,protocol=2)):
+		with pytest.raises(OSError) as e:
+			decode_message(CODEC_PICKLE,MSG_COMPUTER,data)
+		assert e.value.errno==84
+
+
+# codec negotiation
+
+def test_streamSwitchesToBinaryCodecOfPeer():
+	async def run():
+		stream=connectedStream()
+		stream.feed_data(encodeFrames([(MSG_CODEC,CODEC_BINARY,None,None)]))
+		pickled=await stream.read_message(),stream.codec,stream.pickleAllowed
+		stream.feed_data(encodeFrames([(MSG_USER,['status'],None,None)],CODEC_BINARY))
+		binary=await stream.read_message(),stream.codec,stream.pickleAllowed
+		stream.feed_data(encodeFrames([(MSG_USER,['status'],None,None)]))
+		with pytest.raises(OSError):
+			await stream.read_message()
+		return pickled,binary
+	assert asyncio.run(run())==(((MSG_CODEC,CODEC_BINARY,None),CODEC_PICKLE,True),
+	                            ((MSG_USER,['status'],None),CODEC_BINARY,False))
+
+
+def test_unknownCodecIsRefused():
+	async def run():
+		stream=connectedStream()
+		data=bytearray(encodeFrames([(MSG_USER,['status'],None,None)],CODEC_BINARY))
+		data[1]=0x63  # codec id in bits 16..23 of msgType
+		stream.feed_data(bytes(data))
+		with pytest.raises(OSError):
+			await stream.read_message()
+		return stream.codec,stream.pickleAllowed,stream.transport.closed
+	assert asyncio.run(run())==(CODEC_PICKLE,True,True)
+
+
+# outgoing queue
+
+def test_logMessagesAboveHighWaterMarkAreMergedOrDropped():
+	async def run():
+		stream=connectedStream()
+		stream.pause_writing()
+		for i in range(MessageStream.maxQueuedMessages):
+			stream.send_nowait(MSG_USER,i)
+		stream.send_nowait(MSG_LOG,'a')
+		stream.send_nowait(MSG_LOG,'b')
+		stream.send_nowait(MSG_LOG,'c',requestId=5)
+		return stream.queueDepth,stream.droppedMessages,stream.mergedMessages
+	assert asyncio.run(run())==(MessageStream.maxQueuedMessages,3,0)
+
+
+def test_sendWaitsForDrain():
+	async def run():
+		stream=connectedStream()
+		stream.pause_writing()
+		for i in range(MessageStream.maxQueuedMessages):
+			stream.send_nowait(MSG_USER,i)
+		task=asyncio.ensure_future(stream.send(MSG_USER,'last'))
+		await asyncio.sleep(0)
+		waiting=not task.done()
+		stream.resume_writing()
+		await task
+		await asyncio.sleep(0)
+		stream.feed_data(bytes(stream.transport.data))
+		messages=await stream.read_messages()
+		return waiting,len(messages),messages[-1]
+	assert asyncio.run(run())==(True,MessageStream.maxQueuedMessages+1,(MSG_USER,'last',None))
+
+
+def test_connectionIsAbortedOnHardLimit():
+	async def run():
+		stream=connectedStream()
+		stream.pause_writing()
+		overflowed=MessageStream.overflowedConnections
+		for i in range(MessageStream.maxOutgoingMessages):
+			stream.send_nowait(MSG_USER,i)
+		before=stream.transport.closed
+		stream.send_nowait(MSG_USER,'one too many')
+		return before,stream.transport.closed,stream.queueDepth,MessageStream.overflowedConnections-overflowed
+	assert asyncio.run(run())==(False,True,0,1)
+
+
+# requests carrying request id
+
+def connectedRequestConnection():
+	connection=RequestConnection()
+	connection.stream=connectedStream(CODEC_BINARY)
+	connection._readerTask=asyncio.get_event_loop().create_task(connection._read_responses())
+	return connection
+
+
+def test_requestResponsesAreMatchedByRequestId():
+	async def run():
+		connection=connectedRequestConnection()
+		first=asyncio.ensure_future(connection.request(['status']))
+		second=asyncio.ensure_future(connection.request(['history','i9']))
+		await asyncio.sleep(0)
+		connection.stream.feed_data(encodeFrames([(MSG_LOG,'history',2,None),(MSG_USER,{'computers':[]},1,None),
+		                                          (MSG_DONE,'',2,None),(MSG_DONE,'',1,None)],CODEC_BINARY))
+		return await first,await second
+	assert asyncio.run(run())==([(MSG_USER,{'computers':[]})],[(MSG_LOG,'history')])
+
+
+def test_requestWithCallbackFailsOnEofBeforeDone():
+	async def run():
+		connection=connectedRequestConnection()
+		received=[]
+		task=asyncio.ensure_future(connection.request(['watch'],lambda msgType,message: received.append(message)))
+		await asyncio.sleep(0)
+		connection.stream.feed_data(encodeFrames([(MSG_USER,'first',1,None)],CODEC_BINARY))
+		connection.stream.feed_eof()
+		with pytest.raises(ConnectionResetError):
+			await task
+		return received
+	assert asyncio.run(run())==['first']
+
+
+# heartbeats
+
+def test_pingRequestIsAnswered():
+	async def run():
+		stream=connectedStream()
+		stream.feed_data(encodeFrames([(MSG_PING_REQUEST,12.5,None,None)]))
+		stream._flush(force=True)
+		return stream
+	stream=asyncio.run(run())
+	assert not stream._messages
+	msgType,size=headerStruct.unpack_from(stream.transport.data,0)
+	assert msgType&0xffff==MSG_PING_ANSWER
+	answer=decode_message((msgType>>16)&0xff,MSG_PING_ANSWER,bytes(stream.transport.data[headerStruct.size:]))
+	assert answer[0]==12.5
+
+
+def test_timerWheel():
+
+	async def run():
+		wheel=TimerWheel(tickInterval=0.01,wheelSize=8)
+		fired=[]
+		start=time.monotonic()
+		for delay in (0.15,0.02,0.05):
+			wheel.schedule(delay,lambda delay=delay: fired.append((delay,time.monotonic()-start)))
+		cancelled=wheel.schedule(0.03,lambda: fired.append('cancelled'))
+		wheel.cancel(cancelled)
+		wheel.cancel(cancelled)
+		assert wheel.count==3
+		await asyncio.sleep(0.3)
+		return wheel,fired
+
+	wheel,fired=asyncio.run(run())
+	assert [delay for delay,elapsed in fired]==[0.02,0.05,0.15]
+	for delay,elapsed in fired:
+		assert elapsed>=delay  # never early
+	assert wheel.count==0 and wheel.handle==None
+
+
+def test_timerWheelStopsWhenAllTimersAreCancelled():
+	async def run():
+		wheel=TimerWheel(tickInterval=0.01)
+		timer=wheel.schedule(1,lambda: None)
+		assert wheel.handle!=None
+		wheel.cancel(timer)
+		return wheel
+	wheel=asyncio.run(run())
+	assert wheel.count==0 and wheel.handle==None
+
+
+def test_phiGrowsWithSilenceRelativeToJitter():
+	steady=PhiAccrualDetector(1.0,acceptablePause=0)
+	jittery=PhiAccrualDetector(1.0,acceptablePause=0)
+	t=0.0
+	for i in range(50):
+		t+=1.0
+		steady.heartbeat(t)
+		jittery.heartbeat(t+(0.8 if i%2 else -0.8))
+	assert steady.phi(t+0.5)<1 and jittery.phi(t+0.5)<1
+	assert steady.phi(t+3)>8
+	assert jittery.phi(t+3)<steady.phi(t+3)
+	assert steady.phi(t+10)>steady.phi(t+3)
+
+
+# trace context in frame headers
+
+def test_framesWithRequestIdAndTraceContext():
+
+	async def run():
+		data=encodeFrames([(MSG_USER,['status'],None,None),
+		                   (MSG_USER,{'computers':[]},17,None),
+		                   (MSG_COMPUTER,['command','ls'],None,(0x1234,0x5678)),
+		                   (MSG_LOG,'text',2**32-1,(1,2))],CODEC_BINARY,peerTracing=True)
+
+		# feed the frames byte by byte
+		stream=connectedStream(CODEC_BINARY)
+		for i in range(len(data)):
+			stream.feed_data(data[i:i+1])
+		result=[]
+		for i in range(4):
+			msgType,message,requestId=await stream.read_message()
+			result.append((msgType,message,requestId,stream.traceContext))
+		return result
+
+	assert asyncio.run(run())==[(MSG_USER,['status'],None,None),
+	                            (MSG_USER,{'computers':[]},17,None),
+	                            (MSG_COMPUTER,['command','ls'],None,(0x1234,0x5678)),
+	                            (MSG_LOG,'text',2**32-1,(1,2))]
+
+
+def test_traceContextIsNotSentToPeerWithoutTracing():
+	async def run():
+		return encodeFrames([(MSG_COMPUTER,['restart'],None,(1,2))])
+	data=asyncio.run(run())
+	msgType,size=headerStruct.unpack_from(data,0)
+	assert msgType&MSG_FLAG_TRACE_CONTEXT==0
+	assert len(data)==headerStruct.size+size
+
+
+def test_tracedMessageIsRecordedAsNetworkWrite():
+	async def run():
+		with tracer.span('request','request') as span:
+			encodeFrames([(MSG_USER,'reply',3,traceContext())],CODEC_BINARY)
+		return span
+	span=asyncio.run(run())
+	writes=[s for s in tracer.spans if s.category=='network' and s.parentId==span.spanId]
+	assert len(writes)==1 and writes[0].traceId==span.traceId and writes[0].args['msgType']==MSG_USER
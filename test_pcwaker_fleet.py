@@ -0,0 +1,172 @@
+import asyncio
+import time
+
+import pytest
+
+from pcwaker_common import *
+from pcwaker_fleet import *
+from pcwaker_registry import *
+
+
+# tests of the fleet model
+# (run by "python -m pytest" in this directory; the transition table
+# is a subset of transitionTable of pcwakerd.py)
+
+class FakeLog:
+
+	def __init__(self):
+		self.messages=[]
+
+	def info(self,message):
+		self.messages.append(message)
+
+
+def makeFleet(*powerBitMasks):
+	configs=[type('Computer'+str(i),(),{'name':'pc'+str(i),'names':['pc'+str(i)],'powerBitMask':mask})
+	         for i,mask in enumerate(powerBitMasks)]
+	registry=Registry(configs,None)
+	actions=[]
+	def action(pc,wlog):
+		actions.append(pc.name)
+	table={
+		(Status.OFF,Event.POWER_ON):       (Status.STARTING,None,None),
+		(Status.OFF,Event.START):          (None,None,'Starting computer {}...'),
+		(Status.STARTING,Event.POWER_LOST):(Status.OFF,action,None),
+		(Status.STARTING,Event.CONNECTED): (Status.ON,None,None),
+		(Status.ON,Event.POWER_LOST):      (Status.OFF,action,None),
+		(Status.ON,Event.DISCONNECTED):    (Status.FROZEN,None,None),
+		(Status.ON,Event.STOP):            (Status.STOPPING,action,'Stopping computer {}...'),
+		(Status.FROZEN,Event.POWER_LOST):  (Status.OFF,None,None),
+	}
+	fleet=Fleet(registry.computers,table)
+	transitions=[]
+	fleet.subscribe(transitions.append)
+	return fleet,registry.computers,actions,transitions
+
+
+def test_fleetPowerEdges():
+	fleet,pcs,actions,transitions=makeFleet(0x01,0x02,0x100,0)
+	assert all(pc.status==Status.OFF for pc in pcs)
+
+	# power on of computers on both bytes of power inputs
+	changed=fleet.evaluate(0x101)
+	assert changed==0b101
+	assert [pc.status for pc in pcs]==[Status.STARTING,Status.OFF,Status.STARTING,Status.OFF]
+	assert [(t.pc.name,t.oldStatus,t.newStatus,t.event) for t in transitions]==[
+		('pc0',Status.OFF,Status.STARTING,Event.POWER_ON),('pc2',Status.OFF,Status.STARTING,Event.POWER_ON)]
+
+	# no change of power inputs, no transitions
+	assert fleet.evaluate(0x101)==0
+
+	# power lost; computers without wires are not affected
+	pcs[3].status=Status.STARTING
+	fleet.setComputers(pcs)
+	assert fleet.evaluate(0x001)==0b100
+	assert [pc.status for pc in pcs]==[Status.STARTING,Status.OFF,Status.OFF,Status.STARTING]
+	assert actions==['pc2']
+	assert fleet.stateBits[Status.STARTING]==0b1001 and fleet.stateBits[Status.OFF]==0b0110
+
+
+def test_fleetDisconnected():
+	fleet,pcs,actions,transitions=makeFleet(0x01,0x02)
+	fleet.evaluate(0x03)
+	for pc in pcs:
+		fleet.dispatch(pc,Event.CONNECTED)
+	fleet.setStream(pcs[0],object())
+	assert fleet.evaluate(0x03)==0b10
+	assert [pc.status for pc in pcs]==[Status.ON,Status.FROZEN]
+
+
+def test_fleetDispatch():
+	fleet,pcs,actions,transitions=makeFleet(0x01)
+	wlog=FakeLog()
+
+	# event without transition only logs the message
+	assert fleet.dispatch(pcs[0],Event.START,wlog)
+	assert pcs[0].status==Status.OFF and wlog.messages==['Starting computer pc0...'] and not transitions
+
+	# event not valid in the state
+	assert not fleet.dispatch(pcs[0],Event.STOP,wlog)
+
+	# transition with action; failing subscriber does not stop the others
+	def failingSubscriber(transition):
+		raise RuntimeError('subscriber failure')
+	fleet.subscribers.insert(0,failingSubscriber)
+	fleet.evaluate(0x01)
+	fleet.setStream(pcs[0],object())
+	fleet.dispatch(pcs[0],Event.CONNECTED)
+	assert fleet.dispatch(pcs[0],Event.STOP,wlog)
+	assert pcs[0].status==Status.STOPPING and fleet.states[0]==Status.STOPPING
+	assert actions==['pc0'] and wlog.messages[-1]=='Stopping computer pc0...'
+	assert [t.newStatus for t in transitions]==[Status.STARTING,Status.ON,Status.STOPPING]
+
+
+def test_fleetMakesOneTransitionPerEvent():
+	# (moves are computed before they are made, thus STARTING->OFF and OFF->STARTING
+	# transitions of the same event do not chain)
+	fleet,pcs,actions,transitions=makeFleet(0x01,0x02)
+	fleet.evaluate(0x01)
+	fleet.eventTransitions[Event.PING_TIMEOUT]=[(Status.STARTING,Status.OFF,None),(Status.OFF,Status.STARTING,None)]
+	assert fleet._dispatchAll(Event.PING_TIMEOUT,0b11)==0b11
+	assert [pc.status for pc in pcs]==[Status.OFF,Status.STARTING]
+
+
+# replies of watch request
+# (the replies must be encodable by the binary codec)
+
+def test_watchRepliesOfCurrentStateAndTransitions():
+	fleet,pcs,actions,transitions=makeFleet(0x01,0x02)
+	replies=[currentStatusReply(pc,1000.0) for pc in pcs]
+	fleet.subscribe(lambda transition: replies.append(transitionReply(transition)))
+	fleet.evaluate(0x02)
+	replies=[decode_message(CODEC_BINARY,MSG_USER,bytes(encode_message(CODEC_BINARY,MSG_USER,r))) for r in replies]
+	assert replies[:2]==[{'name':'pc0','oldStatus':None,'status':'OFF','event':None,'time':1000.0},
+	                     {'name':'pc1','oldStatus':None,'status':'OFF','event':None,'time':1000.0}]
+	assert replies[2]=={'name':'pc1','oldStatus':'OFF','status':'STARTING','event':'POWER_ON','time':transitions[0].time}
+	assert len(replies)==3
+
+
+
+# wait request
+
+@pytest.mark.parametrize('params,result',[
+	(['i9','on'],('i9',{Status.ON},None)),
+	(['i9','OFF,Frozen','--timeout','2.5'],('i9',{Status.OFF,Status.FROZEN},2.5)),
+	(['--timeout','1','i9','ON'],('i9',{Status.ON},1.0)),
+])
+def test_waitParameters(params,result):
+	assert parseWaitParameters(params)==result
+
+
+@pytest.mark.parametrize('params,error',[
+	(['i9'],'Error: Computer name and state(s) expected.'),
+	(['i9','ON','OFF'],'Error: Computer name and state(s) expected.'),
+	(['i9','ON','--timeout'],'Error: --timeout requires number of seconds.'),
+	(['i9','ON','--timeout','soon'],'Error: --timeout requires number of seconds.'),
+	(['i9','ON,SLEEPING'],'Error: Unknown state SLEEPING'),
+])
+def test_waitParameterErrors(params,error):
+	with pytest.raises(ValueError) as e:
+		parseWaitParameters(params)
+	assert str(e.value).startswith(error)
+
+
+def test_waitRepliesOnTransitionAndTimeout():
+	async def run():
+		fleet,pcs,actions,transitions=makeFleet(0x01,0x02)
+		waiters=StatusWaiters(asyncio.get_running_loop())
+		fleet.subscribe(waiters.transition)
+		t=time.monotonic()
+		already=waiters.wait(pcs[0],{Status.OFF})
+		reached=waiters.wait(pcs[0],{Status.ON,Status.STARTING},10)
+		timedOut=waiters.wait(pcs[1],{Status.ON},0.01)
+		cancelled=waiters.wait(pcs[1],{Status.ON})
+		cancelled.cancel()
+		fleet.evaluate(0x01)
+		replies=[waitReply(pcs[0],await already,t),waitReply(pcs[0],await reached,t),waitReply(pcs[1],await timedOut,t)]
+		await asyncio.sleep(0)
+		return replies,waiters.waiters
+	replies,waiters=asyncio.run(run())
+	assert [(r['name'],r['status'],r['reached']) for r in replies]==[('pc0','STARTING',True),('pc0','STARTING',True),
+	                                                                  ('pc1','OFF',False)]
+	assert replies[1]['waitTime']<0.01<=replies[2]['waitTime'] and waiters=={}
@@ -0,0 +1,345 @@
+import asyncio
+import errno
+import time
+
+import pytest
+
+# (pcwaker_hardware needs bdaqctrl wrapper built for the device driver)
+bdaqctrl=pytest.importorskip('bdaqctrl',exc_type=ImportError)
+from pcwaker_hardware import *
+
+
+# tests of the hardware service, power sampling and power button pulses
+# (run by "python -m pytest" in this directory; HardwareService is replaced by FakeHardware
+# in the tests of the sampler and of the pulses)
+
+
+# hardware service double
+# (reads return inputBits, writes are recorded and completed in the next loop iteration)
+class FakeHardware:
+
+	def __init__(self,loop):
+		self.loop=loop
+		self.stopped=False
+		self.changeOfStateEnabled=False
+		self.inputBits=0
+		self.reads=[]
+		self.writes=[]
+		self.writeResults=[]  # results of the next writes (0 if empty)
+
+	def read(self):
+		self.reads.append(time.monotonic())
+		future=self.loop.create_future()
+		future.set_result(self.inputBits)
+		return future
+
+	def write(self,outputBits):
+		self.writes.append(outputBits)
+		future=self.loop.create_future()
+		r=self.writeResults.pop(0) if self.writeResults else 0
+		self.loop.call_soon(future.set_result,(r,time.monotonic()))
+		return future
+
+
+def changes(sampler):
+	result=[]
+	sampler.inputChangedCallback=lambda inputBits,changedBits: result.append((inputBits,changedBits))
+	return result
+
+
+# change-of-state interrupts
+
+def test_changeOfStateEdgeIsDebouncedInSamplingWindow():
+	async def run():
+		hardware=FakeHardware(asyncio.get_running_loop())
+		hardware.changeOfStateEnabled=True
+		sampler=PowerSampler(hardware,samplingRate=100,debounceSamples=3,backstopRate=5)
+		reported=changes(sampler)
+		sampler.start(0)
+		await asyncio.sleep(0.3)
+		backstopReads=len(hardware.reads)
+		hardware.inputBits=0x01
+		t=time.monotonic()
+		sampler.changeOfState(0x01)
+		await asyncio.sleep(0.1)
+		await sampler.stop()
+		return backstopReads,reported,sampler.edgeTime-t
+	backstopReads,reported,edgeDelay=asyncio.run(run())
+	assert backstopReads<=2
+	assert reported==[(0x01,0x01)]
+	assert 0<=edgeDelay<0.005
+
+
+def test_samplingRateIsUsedWithoutChangeOfState():
+	async def run():
+		hardware=FakeHardware(asyncio.get_running_loop())
+		sampler=PowerSampler(hardware,samplingRate=100,debounceSamples=3,backstopRate=5)
+		sampler.start(0)
+		await asyncio.sleep(0.3)
+		await sampler.stop()
+		return len(hardware.reads)
+	assert asyncio.run(run())>=15
+
+
+def test_boostCutsBackstopSleepShort():
+	async def run():
+		hardware=FakeHardware(asyncio.get_running_loop())
+		hardware.changeOfStateEnabled=True
+		sampler=PowerSampler(hardware,samplingRate=100,debounceSamples=3,backstopRate=1)
+		sampler.start(0)
+		await asyncio.sleep(0.05)
+		sampler.boost(200)
+		await asyncio.sleep(0.1)
+		await sampler.stop()
+		return len(hardware.reads)
+	assert asyncio.run(run())>=10
+
+
+
+# debouncing and power history
+# (samples are added directly to the stopped sampler at the times given by the fake clock)
+
+class FakeClock:
+
+	def __init__(self,now=1000.0):
+		self.now=now
+
+	def __call__(self):
+		return self.now
+
+
+def stoppedSampler(inputBits,monkeypatch,**kwargs):
+	async def run():
+		sampler=PowerSampler(FakeHardware(asyncio.get_running_loop()),**kwargs)
+		sampler.start(inputBits)
+		await sampler.stop()
+		return sampler
+	sampler=asyncio.run(run())
+	clock=FakeClock()
+	monkeypatch.setattr(time,'monotonic',clock)
+	return sampler,clock
+
+
+def addSamples(sampler,clock,samples,period=0.05):
+	for rawBits in samples:
+		clock.now+=period
+		sampler.addSample(rawBits)
+
+
+def test_debouncedChangeNeedsAgreeingSamples(monkeypatch):
+	sampler,clock=stoppedSampler(0x00,monkeypatch,debounceSamples=3)
+	reported=changes(sampler)
+	addSamples(sampler,clock,[0x01,0x00,0x01,0x01])
+	assert reported==[] and sampler.inputBits==0x00
+	addSamples(sampler,clock,[0x01])
+	assert reported==[(0x01,0x01)] and sampler.inputBits==0x01
+
+
+def test_bitsAreDebouncedIndependently(monkeypatch):
+	sampler,clock=stoppedSampler(0x01,monkeypatch,debounceSamples=2)
+	reported=changes(sampler)
+	addSamples(sampler,clock,[0x02,0x03,0x02,0x02])
+	assert reported==[(0x03,0x02),(0x02,0x01)]
+
+
+def test_edgeIsDatedByFirstAgreeingSample(monkeypatch):
+	sampler,clock=stoppedSampler(0x00,monkeypatch,debounceSamples=3)
+	addSamples(sampler,clock,[0x00,0x01])
+	firstTime=clock.now
+	addSamples(sampler,clock,[0x01,0x01])
+	assert sampler.edgeTime==firstTime
+	assert sampler.edges(0x01)==[(firstTime,0x01)]
+
+
+def test_historyIsEvictedByTime(monkeypatch):
+	sampler,clock=stoppedSampler(0x00,monkeypatch,debounceSamples=1,historyLength=10)
+	addSamples(sampler,clock,[0x01,0x03,0x02],period=4)
+	assert [bits for t,bits in sampler.edges(0xff)]==[0x01,0x03,0x02]
+	assert [bits for t,bits in sampler.edges(0x02)]==[0x03]
+	clock.now+=3
+	assert [bits for t,bits in sampler.edges(0xff)]==[0x03,0x02]
+	clock.now+=100
+	assert sampler.edges(0xff)==[] and len(sampler.history)==0
+
+
+# hardware service
+# (bdaqctrl controllers are replaced by FakeController whose methods may raise)
+
+class FakeValue:
+
+	def __init__(self):
+		self.v=0
+
+	def assign(self,v):
+		self.v=v
+
+	def value(self):
+		return self.v
+
+
+class FakeController:
+
+	def __init__(self,failures):
+		self.failures=failures  # method name -> exception raised by its next call
+		self.inputBits=0x40
+
+	def _call(self,name):
+		e=self.failures.pop(name,None)
+		if e!=None:
+			raise e
+
+	def setSelectedDevice(self,deviceInformation):
+		self._call('setSelectedDevice')
+		return 0
+
+	def Read(self,port,data):
+		self._call('Read')
+		data.assign(self.inputBits)
+		return 0
+
+	def Write(self,port,value):
+		self._call('Write')
+		return 0
+
+	def Dispose(self):
+		pass
+
+
+def fakeDevice(monkeypatch,failures):
+	monkeypatch.setattr(bdaqctrl,'uint8',FakeValue)
+	monkeypatch.setattr(bdaqctrl,'DeviceInformation',lambda description: description)
+	monkeypatch.setattr(bdaqctrl,'AdxInstantDiCtrlCreate',lambda: FakeController(failures))
+	monkeypatch.setattr(bdaqctrl,'AdxInstantDoCtrlCreate',lambda: FakeController(failures))
+
+
+def test_wrapperExceptionFailsOnlyItsRequest(monkeypatch):
+	fakeDevice(monkeypatch,{'Read':TypeError('in method Read')})
+	async def run():
+		hardware=HardwareService(asyncio.get_running_loop())
+		await hardware.open()
+		try:
+			results=await asyncio.gather(hardware.read(),hardware.write(0x01),hardware.read(),return_exceptions=True)
+		finally:
+			hardware.close()
+		return results,hardware.pendingRequests
+	results,pendingRequests=asyncio.run(run())
+	assert isinstance(results[0],OSError) and results[0].errno==errno.EIO
+	assert isinstance(results[0].__cause__,TypeError)
+	assert results[1][0]==0 and results[2]==0x40 and pendingRequests==0
+
+
+def test_wrapperExceptionOnOpenStopsService(monkeypatch):
+	fakeDevice(monkeypatch,{'setSelectedDevice':RuntimeError('no device')})
+	async def run():
+		hardware=HardwareService(asyncio.get_running_loop())
+		read=hardware.read()
+		opened=asyncio.ensure_future(hardware.open())
+		await asyncio.sleep(0)
+		queued=hardware.read()
+		results=await asyncio.gather(opened,queued,return_exceptions=True)
+		late=await asyncio.gather(hardware.read(),return_exceptions=True)
+		hardware.thread.join(1)
+		return results+late,hardware.stopped,hardware.thread.is_alive(),read.exception()
+	results,stopped,alive,notOpenedYet=asyncio.run(run())
+	assert all(isinstance(e,OSError) for e in results)
+	assert results[0].errno==errno.EIO and results[1].errno==errno.ENODEV and results[2].errno==errno.ENODEV
+	assert stopped and not alive and notOpenedYet.errno==errno.ENODEV
+
+
+# power button pulses
+
+def test_pulseOwnsItsBits():
+	async def run():
+		hardware=FakeHardware(asyncio.get_running_loop())
+		engine=PulseEngine(hardware)
+		first=engine.press(0x01,0.02)
+		second=engine.press(0x02,0.02)
+		with pytest.raises(BlockingIOError):
+			engine.press(0x03,0.02)
+		durations=await asyncio.gather(first.done,second.done)
+		third=engine.press(0x01,0.01)
+		await third.done
+		return hardware.writes,engine.mergedEdges,engine.ownedBits,durations
+	writes,mergedEdges,ownedBits,durations=asyncio.run(run())
+	assert writes[0]==0x03 and writes[-1]==0x00 and ownedBits==0
+	assert mergedEdges>=1
+	assert all(0.02<=d<0.1 for d in durations)
+
+
+def test_pulseIsHeldFromPressCompletion():
+	async def run():
+		loop=asyncio.get_running_loop()
+		hardware=FakeHardware(loop)
+		# (write completion is delayed, as when queued behind other USB transactions)
+		write=hardware.write
+		def slowWrite(outputBits):
+			future=loop.create_future()
+			loop.call_later(0.05,lambda: write(outputBits).add_done_callback(lambda f: future.set_result(f.result())))
+			return future
+		hardware.write=slowWrite
+		engine=PulseEngine(hardware)
+		pulse=engine.press(0x01,0.05)
+		duration=await pulse.done
+		return duration,pulse.pressTime-pulse.pressRequestTime,pulse.releaseTime-pulse.pressRequestTime
+	duration,pressDelay,releaseDelay=asyncio.run(run())
+	assert pressDelay>=0.05 and duration>=0.05 and releaseDelay>=0.1
+
+
+def test_failedWriteKeepsBitsOwnedUntilReleaseIsWritten():
+	async def run():
+		hardware=FakeHardware(asyncio.get_running_loop())
+		hardware.writeResults=[0,5,5]
+		engine=PulseEngine(hardware)
+		engine.releaseRetryInterval=0.02
+		pulse=engine.press(0x01,0.01)
+		with pytest.raises(OSError):
+			await pulse.done
+		with pytest.raises(BlockingIOError):
+			engine.press(0x01)
+		owned=engine.ownedBits
+		await asyncio.sleep(0.1)
+		return owned,engine.ownedBits,hardware.writes
+	owned,ownedAfterRetry,writes=asyncio.run(run())
+	assert owned==0x01 and ownedAfterRetry==0 and writes==[0x01,0x00,0x00,0x00]
+
+
+def test_releaseIsNotRetriedAfterServiceStopped():
+	async def run():
+		hardware=FakeHardware(asyncio.get_running_loop())
+		hardware.writeResults=[5]
+		engine=PulseEngine(hardware)
+		engine.releaseRetryInterval=0.02
+		pulse=engine.press(0x01,0.01)
+		with pytest.raises(OSError):
+			await pulse.done
+		hardware.stopped=True
+		await asyncio.sleep(0.1)
+		return hardware.writes
+	assert asyncio.run(run())==[0x01]
+
+
+def test_heldPulseIsReleasedOnEdge():
+	# (kill holds the power button until the power off edge)
+	async def run():
+		loop=asyncio.get_running_loop()
+		hardware=FakeHardware(loop)
+		engine=PulseEngine(hardware)
+		pulse=engine.press(0x01)
+		loop.call_later(0.05,engine.release,pulse)
+		duration=await pulse.done
+		return duration,hardware.writes,engine.ownedBits
+	duration,writes,ownedBits=asyncio.run(run())
+	assert 0.05<=duration<0.1 and writes==[0x01,0x00] and ownedBits==0
+
+
+def test_releaseBeforePressIsWrittenIsPostponed():
+	async def run():
+		hardware=FakeHardware(asyncio.get_running_loop())
+		engine=PulseEngine(hardware)
+		pulse=engine.press(0x01)
+		engine.release(pulse)
+		engine.release(pulse)
+		duration=await pulse.done
+		return duration,hardware.writes
+	duration,writes=asyncio.run(run())
+	assert duration>=0 and writes==[0x01,0x00]
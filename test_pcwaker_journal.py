@@ -0,0 +1,98 @@
+import asyncio
+import json
+
+from pcwaker_journal import *
+
+
+# tests of the state journal
+# (run by "python -m pytest" in this directory)
+
+
+def journalLines(path):
+	with open(path,'rb') as f:
+		return [json.loads(line) for line in f]
+
+
+def test_journalReplayAndCompaction(tmp_path):
+
+	states={'i9':'OFF','a1':'OFF'}
+	path=str(tmp_path/'pcwakerd.journal')
+
+	async def run():
+		journal=StateJournal(asyncio.get_running_loop(),path,
+		                     lambda name: {'name':name,'status':states[name]},
+		                     lambda: [{'name':name,'status':status} for name,status in states.items()],
+		                     batchDelay=0.01,compactionThreshold=4)
+		journal.open()
+		assert journalLines(path)==[{'name':'i9','status':'OFF'},{'name':'a1','status':'OFF'}]
+
+		# marks are batched and the latest state is written
+		states['i9']='STARTING'
+		journal.mark('i9')
+		states['i9']='ON'
+		journal.mark('i9')
+		await asyncio.sleep(0.1)
+		assert journal.writes==1 and journal.records==1
+		assert journalLines(path)[-1]=={'name':'i9','status':'ON'}
+
+		# compaction rewrites the file to one line per computer
+		for status in ('STOPPING','OFF','STARTING'):
+			states['a1']=status
+			journal.mark('a1')
+			await asyncio.sleep(0.05)
+		assert journalLines(path)==[{'name':'i9','status':'ON'},{'name':'a1','status':'STARTING'}]
+
+		# marks not written yet are written by close()
+		states['a1']='ON'
+		journal.mark('a1')
+		journal.close()
+		return journal
+
+	journal=asyncio.run(run())
+	assert journal.replay()=={'i9':{'name':'i9','status':'ON'},'a1':{'name':'a1','status':'ON'}}
+
+
+def test_journalReplaySkipsTornLines(tmp_path):
+	path=tmp_path/'pcwakerd.journal'
+	path.write_bytes(b'{"name":"i9","status":"OFF"}\nnot json\n{"status":"ON"}\n'
+	                 b'{"name":"i9","status":"ON"}\n{"name":"a1","sta')
+	journal=StateJournal(None,str(path),None,None)
+	assert journal.replay()=={'i9':{'name':'i9','status':'ON'}}
+	assert StateJournal(None,str(tmp_path/'missing'),None,None).replay()=={}
+
+
+
+
+def test_closeWaitsForWriteInExecutor(tmp_path):
+
+	states={'i9':'OFF','a1':'OFF'}
+	path=str(tmp_path/'pcwakerd.journal')
+
+	async def run():
+		journal=StateJournal(asyncio.get_running_loop(),path,
+		                     lambda name: {'name':name,'status':states[name]},
+		                     lambda: [{'name':name,'status':status} for name,status in states.items()],
+		                     batchDelay=0.01,compactionThreshold=1)
+		journal.open()
+
+		# write with compaction is held in the executor by the lock
+		states['i9']='ON'
+		journal.mark('i9')
+		journal.lock.acquire()
+		await asyncio.sleep(0.05)
+		inFlight=journal.flushFuture!=None
+		states['a1']='STARTING'
+		journal.mark('a1')
+		task=asyncio.ensure_future(journal.aclose())
+		await asyncio.sleep(0.05)
+		waiting=not task.done()
+		journal.lock.release()
+		await task
+
+		# compaction of late marks does not reopen the closed journal
+		journal.mark('i9')
+		await asyncio.sleep(0.05)
+		return inFlight,waiting,journal.file
+
+	assert asyncio.run(run())==(True,True,None)
+	assert journalLines(path)==[{'name':'i9','status':'ON'},{'name':'a1','status':'OFF'},{'name':'a1','status':'STARTING'}]
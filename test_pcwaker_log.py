@@ -0,0 +1,59 @@
+import io
+import logging
+import queue
+import threading
+
+from pcwaker_log import *
+
+
+# tests of the background log writer
+# (run by "python -m pytest" in this directory)
+
+
+def makeWriter():
+	output=io.StringIO()
+	handler=logging.StreamHandler(output)
+	handler.setFormatter(logging.Formatter('%(message)s'))
+	return LogWriter(queue.SimpleQueue(),handler),output
+
+
+def makeRecord(text):
+	record=logging.LogRecord('main',logging.INFO,__file__,0,text,None,None)
+	recordText(record)
+	return record
+
+
+def test_flushWaitsForQueuedRecords():
+	writer,output=makeWriter()
+	writer.start()
+	for i in range(1000):
+		writer.put(makeRecord(str(i)))
+	writer.flush()
+	assert output.getvalue()==''.join(str(i)+'\n' for i in range(1000))
+	writer.stop()
+	writer.put(makeRecord('after stop'))
+	assert output.getvalue().endswith('999\nafter stop\n')
+
+
+def test_stopWritesRecordsAndSetsEventsQueuedAfterWriterEnded():
+	writer,output=makeWriter()
+	writer.start()
+	writer.put(makeRecord('first'))
+	writer.queue.put(None)
+	writer.thread.join()
+
+	# (as queued by put() and flush() racing with stop())
+	done=threading.Event()
+	writer.queue.put(makeRecord('late'))
+	writer.queue.put(done)
+	writer.stop()
+	assert done.is_set() and output.getvalue()=='first\nlate\n'
+
+
+def test_flushReturnsWhenWriterIsNotRunning():
+	writer,output=makeWriter()
+	writer.flush()
+	writer.start()
+	writer.stop()
+	writer.flush()
+	assert writer.queue.empty()
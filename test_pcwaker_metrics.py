@@ -0,0 +1,66 @@
+import asyncio
+
+from pcwaker_metrics import *
+
+
+# tests of the metrics
+# (run by "python -m pytest" in this directory)
+
+def test_metricsRendering():
+	metrics=Metrics()
+	requests=metrics.add(Counter('pcwaker_requests_total','Requests.',['command']))
+	connected=metrics.add(Gauge('pcwaker_connected','Connected computers.'))
+	latency=metrics.add(Histogram('pcwaker_latency_seconds','Latency.',['computer'],buckets=(0.1,1.0)))
+	requests.inc(('status',))
+	requests.inc(('status',),2)
+	requests.inc(('say "a\\b"\n',))
+	metrics.collectors.append(lambda: connected.set(3))
+	def failingCollector():
+		raise RuntimeError('collector failure')
+	metrics.collectors.append(failingCollector)
+	for value in (0.05,0.1,0.5,2.0):
+		latency.observe(value,('i9',))
+
+	assert metrics.render()==(
+		'# HELP pcwaker_requests_total Requests.\n'
+		'# TYPE pcwaker_requests_total counter\n'
+		'pcwaker_requests_total{command="status"} 3\n'
+		'pcwaker_requests_total{command="say \\"a\\\\b\\"\\n"} 1\n'
+		'# HELP pcwaker_connected Connected computers.\n'
+		'# TYPE pcwaker_connected gauge\n'
+		'pcwaker_connected 3\n'
+		'# HELP pcwaker_latency_seconds Latency.\n'
+		'# TYPE pcwaker_latency_seconds histogram\n'
+		'pcwaker_latency_seconds_bucket{computer="i9",le="0.1"} 2\n'
+		'pcwaker_latency_seconds_bucket{computer="i9",le="1"} 3\n'
+		'pcwaker_latency_seconds_bucket{computer="i9",le="+Inf"} 4\n'
+		'pcwaker_latency_seconds_sum{computer="i9"} 2.65\n'
+		'pcwaker_latency_seconds_count{computer="i9"} 4\n')
+
+
+def test_metricsServer():
+	async def get(port,request):
+		reader,writer=await asyncio.open_connection('127.0.0.1',port)
+		writer.write(request)
+		response=await reader.read()
+		writer.close()
+		return response
+
+	async def run():
+		metrics=Metrics()
+		metrics.add(Counter('pcwaker_scrapes_total','Scrapes.')).inc()
+		server=MetricsServer(metrics)
+		await server.start('127.0.0.1',0)
+		port=server.server.sockets[0].getsockname()[1]
+		try:
+			return [await get(port,request) for request in (b'GET /metrics HTTP/1.1\r\n\r\n',
+			                                                b'GET / HTTP/1.1\r\n\r\n',
+			                                                b'POST /metrics HTTP/1.1\r\n\r\n')],server.scrapes
+		finally:
+			server.close()
+
+	responses,scrapes=asyncio.run(run())
+	assert responses[0].startswith(b'HTTP/1.1 200 OK\r\n') and responses[0].endswith(b'\r\n\r\n'+
+		b'# HELP pcwaker_scrapes_total Scrapes.\n# TYPE pcwaker_scrapes_total counter\npcwaker_scrapes_total 1\n')
+	assert responses[1].startswith(b'HTTP/1.1 404 ') and responses[2].startswith(b'HTTP/1.1 405 ')
+	assert scrapes==1
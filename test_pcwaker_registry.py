@@ -0,0 +1,80 @@
+import pytest
+
+from pcconfig import OperatingSystem,PulseProfile
+from pcwaker_registry import *
+
+
+# tests of the computer registry
+# (run by "python -m pytest" in this directory)
+
+
+def computerConfig(name,powerBitMask,aliases=(),**attributes):
+	# (returns a computer class as written in pcconfig)
+	attributes.update(name=name,names=[name]+list(aliases),powerBitMask=powerBitMask)
+	return type('pc_'+name,(),attributes)
+
+
+defaultProfile=PulseProfile()
+
+
+def test_namesAndTagsAreResolvedCaseInsensitively():
+	registry=Registry([computerConfig('cadwork-i9',0x40,['i9'],tags=['Intel']),
+	                   computerConfig('cadwork-a1',0x20,['a1'],tags=['amd']),
+	                   computerConfig('cadwork-x5',0,['x5'],tags=['intel'])],defaultProfile)
+	assert registry.get('I9').name=='cadwork-i9' and registry.get('unknown')==None and registry.get(None)==None
+	assert registry.isTag('INTEL') and not registry.isTag('i9')
+	pcList,unknownNames=registry.resolve(['x5','intel','nonsense','i9'])
+	assert [pc.name for pc in pcList]==['cadwork-x5','cadwork-i9'] and unknownNames==['nonsense']
+	assert [pc.name for pc in registry.resolve(['all'])[0]]==['cadwork-i9','cadwork-a1','cadwork-x5']
+	assert registry.powerBitMask==0x60
+
+
+def test_computersHaveDefaultOrOwnPulseProfile():
+	profile=PulseProfile(pressLength=0.3)
+	registry=Registry([computerConfig('i9',0x40),computerConfig('a1',0x20,pulseProfile=profile)],defaultProfile)
+	assert registry.get('i9').pulseProfile is defaultProfile and registry.get('a1').pulseProfile is profile
+
+
+@pytest.mark.parametrize('computerList',[
+	[computerConfig('i9',0x40,['x']),computerConfig('a1',0x20,['X'])],         # alias used twice
+	[computerConfig('i9',0x40),computerConfig('a1',0x60)],                      # power bit used twice
+	[computerConfig('i9',0x40,tags=['a1']),computerConfig('a1',0x20)],          # tag shadows name
+	[computerConfig('i9',0x40,['All'])],                                        # reserved name
+	[computerConfig('i9',0x40,tags=['ALL'])],                                   # reserved tag
+	[computerConfig('i9',0x40,operatingSystems=[OperatingSystem('win',['w'],'A',[],[]),
+	                                            OperatingSystem('linux',['W'],'B',[],[])])],  # os alias used twice
+	[computerConfig('i9',0x40,operatingSystems=[OperatingSystem('win',['win'],'/dev/sda1',[],[]),
+	                                            OperatingSystem('linux',['linux'],'/dev/SDA1',[],[])])],  # partition used twice
+])
+def test_configurationErrorsAreRefused(computerList):
+	with pytest.raises(ValueError):
+		Registry(computerList,defaultProfile)
+
+
+def test_computersWithoutPowerInputsDoNotCollide():
+	registry=Registry([computerConfig('i9',0),computerConfig('a1',0)],defaultProfile)
+	assert registry.powerBitMask==0
+
+
+# configuration reload
+
+def test_adoptKeepsRecordsOfRemainingComputers():
+	live=Registry([computerConfig('i9',0x40,['CoffeeLake'],tags=['intel']),computerConfig('a1',0x20)],defaultProfile)
+	i9=live.get('i9')
+	i9.status='ON'
+	i9.stream=object()
+	new=Registry([computerConfig('i9',0x40,['CL'],tags=['intel']),computerConfig('x5',0x01),
+	              computerConfig('a1',0x20)],defaultProfile)
+	added,removed,changed=new.adopt(live)
+	assert (added,removed,changed)==(['x5'],[],['i9'])
+	assert new.get('i9') is i9 and new.get('CL') is i9 and new.get('CoffeeLake')==None
+	assert i9.status=='ON' and i9.names==['i9','CL']
+	assert new.resolve(['intel'])[0]==[i9] and new.resolve(['all'])[0][0] is i9
+	assert new.get('a1') is live.get('a1')
+
+
+def test_adoptReportsRemovedComputers():
+	live=Registry([computerConfig('i9',0x40),computerConfig('a1',0x20)],defaultProfile)
+	new=Registry([computerConfig('a1',0x20,pulseProfile=PulseProfile(killHoldLimit=8))],defaultProfile)
+	assert new.adopt(live)==([],['i9'],['a1'])
+	assert new.computers==[live.get('a1')] and new.get('i9')==None